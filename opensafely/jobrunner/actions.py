@@ -13,6 +13,10 @@ class UnknownActionError(ProjectValidationError):
     pass
 
 
+class DependencyCycleError(ProjectValidationError):
+    pass
+
+
 # Tiny dataclass to capture the specification of a project action
 @dataclasses.dataclass
 class ActionSpecification:
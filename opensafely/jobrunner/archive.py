@@ -0,0 +1,185 @@
+"""
+Moving old jobs out of the main database and into config.ARCHIVE_DATABASE_FILE
+
+The job table only grows, but almost all of it is jobs which finished long ago
+and which the runner never looks at again. Here we move jobs which reached a
+final state more than config.JOB_ARCHIVE_AFTER_DAYS days ago into a separate
+archive database, in small batches so that the runner can carry on while we do
+it.
+
+We never archive the latest uncancelled job for each action in a workspace, or
+any job which an active job is waiting on. This means the queries the runner
+uses to schedule jobs never need to look in the archive. Lookups which need to
+know about every job there has ever been should also check
+`archived_job_exists()`.
+"""
+
+import logging
+import threading
+import time
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import database
+from opensafely.jobrunner.models import Job, State
+
+
+log = logging.getLogger(__name__)
+
+ARCHIVE_SCHEMA = "archive"
+ARCHIVED_STATES = [State.FAILED, State.SUCCEEDED]
+
+
+def archive_jobs(after_days=None, batch_size=None, pause=0):
+    """
+    Move jobs which finished more than `after_days` days ago into the archive,
+    `batch_size` jobs at a time, returning the number of jobs moved
+
+    Each batch is committed separately, pausing for `pause` seconds between
+    them to give the runner a chance to write.
+    """
+    if after_days is None:
+        after_days = config.JOB_ARCHIVE_AFTER_DAYS
+    if batch_size is None:
+        batch_size = config.JOB_ARCHIVE_BATCH_SIZE
+    start = time.monotonic()
+    cutoff = int(time.time()) - int(after_days * 24 * 60 * 60)
+    conn = attach_archive()
+    keep = get_jobs_to_keep(conn)
+
+    archived = 0
+    last_rowid = 0
+    while True:
+        rows = conn.execute(
+            f"""
+            SELECT rowid, id FROM job
+            WHERE state IN (?, ?)
+            AND completed_at IS NOT NULL AND completed_at < ?
+            AND rowid > ?
+            ORDER BY rowid
+            LIMIT {int(batch_size)}
+            """,
+            [state.value for state in ARCHIVED_STATES] + [cutoff, last_rowid],
+        ).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1][0]
+        job_ids = [job_id for _, job_id in rows if job_id not in keep]
+        if job_ids:
+            archived += move_jobs(conn, job_ids)
+            time.sleep(pause)
+
+    log.info(
+        f"Archived {archived} jobs older than {after_days} days"
+        f" in {time.monotonic() - start:.1f}s"
+    )
+    return archived
+
+
+def attach_archive():
+    """
+    Return the connection to the main database with the archive database
+    attached, creating or migrating the archive as needed
+    """
+    database.ensure_db(config.ARCHIVE_DATABASE_FILE)
+    conn = database.get_connection()
+    attached = [row[1] for row in conn.execute("PRAGMA database_list")]
+    if ARCHIVE_SCHEMA not in attached:
+        conn.execute(
+            f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA}",
+            [str(config.ARCHIVE_DATABASE_FILE)],
+        )
+    return conn
+
+
+def get_jobs_to_keep(conn):
+    """
+    Return the IDs of the jobs which the runner may still need to look at
+
+    These are the jobs `queries.calculate_workspace_state` would return for
+    each workspace, and the jobs that active jobs are waiting on.
+    """
+    rows = conn.execute(
+        """
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                PARTITION BY workspace, action
+                ORDER BY created_at DESC, rowid
+            ) AS _row_number
+            FROM job WHERE cancelled = 0
+        )
+        WHERE _row_number = 1
+        """
+    )
+    keep = {row[0] for row in rows}
+    active_jobs = database.iter_where(
+        Job,
+        columns=["wait_for_job_ids"],
+        state__in=[State.PENDING, State.RUNNING],
+    )
+    for job in active_jobs:
+        keep.update(job.wait_for_job_ids or [])
+    return keep
+
+
+def move_jobs(conn, job_ids):
+    """Copy the given jobs into the archive and then delete them"""
+    placeholders = ", ".join(["?"] * len(job_ids))
+    columns = database.get_codec(Job).columns
+    # In WAL mode, transactions which write to more than one database are
+    # only atomic for each database individually. So we copy the jobs in one
+    # transaction and delete them in another, which means that at worst a job
+    # might be in both databases until the next run.
+    with database.transaction():
+        conn.execute(
+            f"""
+            INSERT OR REPLACE INTO {ARCHIVE_SCHEMA}.job ({columns})
+            SELECT {columns} FROM main.job WHERE id IN ({placeholders})
+            """,
+            job_ids,
+        )
+    # Only delete jobs which haven't changed since we copied them. Anything
+    # which has will be copied again next time.
+    with database.transaction():
+        cursor = conn.execute(
+            f"""
+            DELETE FROM main.job WHERE id IN (
+                SELECT j.id FROM main.job AS j
+                JOIN {ARCHIVE_SCHEMA}.job AS a ON a.id = j.id
+                WHERE j.id IN ({placeholders})
+                AND j.state IS a.state
+                AND j.cancelled IS a.cancelled
+                AND j.updated_at IS a.updated_at
+                AND j.completed_at IS a.completed_at
+            )
+            """,
+            job_ids,
+        )
+    return cursor.rowcount
+
+
+def archived_job_exists(**query_params):
+    """Return whether any archived job matches `query_params`"""
+    if not config.ARCHIVE_DATABASE_FILE.exists():
+        return False
+    conn = database.get_connection(config.ARCHIVE_DATABASE_FILE)
+    where, params = database.query_params_to_sql(query_params)
+    cursor = conn.execute(f"SELECT EXISTS (SELECT 1 FROM job WHERE {where})", params)
+    return bool(cursor.fetchone()[0])
+
+
+def start_archive_thread(interval=None):
+    """Run `archive_jobs` every `interval` seconds in a background thread"""
+    if interval is None:
+        interval = config.JOB_ARCHIVE_INTERVAL
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                archive_jobs(pause=config.JOB_ARCHIVE_BATCH_PAUSE)
+            except Exception:
+                log.exception("Error archiving jobs")
+
+    thread = threading.Thread(target=loop, name="job-archive", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,38 @@
+"""
+Move old finished jobs from the main database into the archive database
+"""
+
+import argparse
+import sys
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.archive import archive_jobs
+from opensafely.jobrunner.lib import log_utils
+
+
+def run(argv):
+    log_utils.configure_logging()
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--after-days",
+        type=float,
+        default=config.JOB_ARCHIVE_AFTER_DAYS,
+        help="archive jobs which finished more than this many days ago",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=config.JOB_ARCHIVE_BATCH_SIZE,
+        help="number of jobs to move in each transaction",
+    )
+    args = parser.parse_args(argv)
+    archived = archive_jobs(
+        after_days=args.after_days,
+        batch_size=args.batch_size,
+        pause=config.JOB_ARCHIVE_BATCH_PAUSE,
+    )
+    print(f"Archived {archived} jobs")
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,199 @@
+"""
+Benchmark the scheduler's database queries under each SQLite connection profile
+
+For each size we build a database of synthetic jobs, mostly long finished with
+a few active, and then replay the queries the run loop makes on each tick,
+reporting latency percentiles for each kind of query.
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import database
+from opensafely.jobrunner.models import Job, State, StatusCode
+from opensafely.jobrunner.queries import calculate_workspace_state
+
+
+ACTIONS_PER_WORKSPACE = 20
+JOBS_PER_WORKSPACE = 200
+ACTIVE_JOBS = 50
+INSERT_BATCH_SIZE = 10000
+
+
+def run(argv):
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+        help="numbers of jobs in the databases to benchmark",
+    )
+    parser.add_argument(
+        "--profiles",
+        nargs="+",
+        choices=database.CONNECTION_PROFILES,
+        default=list(database.CONNECTION_PROFILES),
+        help="connection profiles to benchmark",
+    )
+    parser.add_argument(
+        "--ticks", type=int, default=100, help="number of run loop ticks to replay"
+    )
+    parser.add_argument(
+        "--dir",
+        type=Path,
+        help="directory to create the databases in (defaults to a temporary one)",
+    )
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmpdir:
+        for size in args.sizes:
+            filename = Path(tmpdir) / f"benchmark-{size}.sqlite"
+            populate(filename, size)
+            for profile in args.profiles:
+                timings = benchmark(filename, profile, args.ticks)
+                print(f"\n{size} jobs, {profile} profile")
+                print_timings(timings)
+
+
+def populate(filename, size, seed=0):
+    """Create a database of `size` synthetic jobs"""
+    rng = random.Random(seed)
+    with use_database(filename, "fast"):
+        database.ensure_db(filename)
+        now = int(time.time())
+        batch = []
+        for i in range(size):
+            batch.append(make_job(rng, i, size, now))
+            if len(batch) == INSERT_BATCH_SIZE:
+                insert_batch(batch)
+                batch = []
+        insert_batch(batch)
+
+
+def make_job(rng, i, size, now):
+    workspace = i // JOBS_PER_WORKSPACE
+    action = rng.randrange(ACTIONS_PER_WORKSPACE)
+    active = i >= size - ACTIVE_JOBS
+    if active:
+        state = rng.choice([State.PENDING, State.RUNNING])
+    else:
+        state = rng.choices([State.SUCCEEDED, State.FAILED], weights=[9, 1])[0]
+    created_at = now - (size - i) * 60
+    outputs = {
+        f"output/{action}/file_{n}.csv": "moderately_sensitive" for n in range(5)
+    }
+    return Job(
+        id=f"job{i:08}",
+        job_request_id=f"request{i // ACTIONS_PER_WORKSPACE:08}",
+        state=state,
+        repo_url=f"https://github.com/opensafely/workspace-{workspace}",
+        commit=f"{i:040x}",
+        workspace=f"workspace-{workspace}",
+        action=f"action_{action}",
+        requires_outputs_from=[f"action_{n}" for n in range(action)][-3:],
+        wait_for_job_ids=[f"job{n:08}" for n in range(max(i - 3, 0), i)],
+        run_command=f"python:latest analysis/action_{action}.py",
+        output_spec={"moderately_sensitive": {"output": f"output/{action}/*.csv"}},
+        outputs=None if active else outputs,
+        status_message="Completed successfully",
+        status_code=StatusCode.CREATED if active else StatusCode.SUCCEEDED,
+        created_at=created_at,
+        updated_at=created_at + 600,
+        started_at=created_at + 60,
+        completed_at=None if active else created_at + 600,
+        trace_context={"traceparent": f"00-{i:032x}-{i:016x}-01"},
+    )
+
+
+def insert_batch(jobs):
+    with database.transaction():
+        database.insert_many(jobs)
+
+
+def benchmark(filename, profile, ticks):
+    """Replay `ticks` run loop ticks, returning a dict of timings by query"""
+    timings = defaultdict(list)
+
+    def timed(name, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        timings[name].append(time.perf_counter() - start)
+        return result
+
+    with use_database(filename, profile):
+        for _ in range(ticks):
+            active_jobs = timed(
+                "active jobs",
+                database.find_where,
+                Job,
+                state__in=[State.PENDING, State.RUNNING],
+            )
+            for job in active_jobs:
+                timed(
+                    "awaited states",
+                    database.select_values,
+                    Job,
+                    "state",
+                    id__in=job.wait_for_job_ids,
+                )
+                timed(
+                    "running jobs",
+                    database.find_where,
+                    Job,
+                    columns=["workspace", "action", "requires_db"],
+                    state=State.RUNNING,
+                )
+                timed("workspace state", calculate_workspace_state, job.workspace)
+                job.status_message = f"Updated at {time.time()}"
+                timed("update job", database.update, job)
+            timed(
+                "request exists",
+                database.exists_where,
+                Job,
+                job_request_id=active_jobs[0].job_request_id if active_jobs else "",
+            )
+    return timings
+
+
+@contextmanager
+def use_database(filename, profile):
+    """Point the database module at `filename`, connecting with `profile`"""
+    previous = config.DATABASE_FILE, config.DATABASE_PROFILE
+    config.DATABASE_FILE, config.DATABASE_PROFILE = filename, profile
+    try:
+        yield
+    finally:
+        conn = database.CONNECTION_CACHE.__dict__.pop(filename, None)
+        if conn is not None:
+            conn.close()
+        config.DATABASE_FILE, config.DATABASE_PROFILE = previous
+
+
+def print_timings(timings):
+    print(f"{'query':<20}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for name, values in timings.items():
+        p50, p95, p99 = percentiles(values, [50, 95, 99])
+        print(
+            f"{name:<20}{len(values):>8}"
+            f"{p50 * 1000:>10.3f}{p95 * 1000:>10.3f}{p99 * 1000:>10.3f}"
+        )
+
+
+def percentiles(values, points):
+    if len(values) == 1:
+        return [values[0]] * len(points)
+    cut_points = statistics.quantiles(values, n=100, method="inclusive")
+    return [cut_points[point - 1] for point in points]
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
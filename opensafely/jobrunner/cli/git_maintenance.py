@@ -0,0 +1,34 @@
+"""
+Prune unused commits from the local git repos and repack them
+"""
+
+import argparse
+import sys
+import time
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.git_maintenance import format_size, maintain_repos
+from opensafely.jobrunner.lib import log_utils
+
+
+def run(argv):
+    log_utils.configure_logging()
+    parser = argparse.ArgumentParser(description=__doc__.partition("\n\n")[0])
+    parser.add_argument(
+        "--keep-days",
+        type=float,
+        default=config.GIT_MAINTENANCE_KEEP_DAYS,
+        help="keep commits used by jobs created within this many days",
+    )
+    args = parser.parse_args(argv)
+    start = time.monotonic()
+    results = maintain_repos(keep_days=args.keep_days)
+    reclaimed = sum(result.reclaimed for result in results)
+    print(
+        f"Reclaimed {format_size(reclaimed)} from {len(results)} repos"
+        f" in {time.monotonic() - start:.1f}s"
+    )
+
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
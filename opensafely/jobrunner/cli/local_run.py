@@ -25,6 +25,7 @@ import argparse
 import getpass
 import os
 import random
+import re
 import shlex
 import shutil
 import string
@@ -61,6 +62,7 @@ from opensafely.jobrunner.reusable_actions import (
     ReusableActionError,
     resolve_reusable_action_references,
 )
+from opensafely.jobrunner.run import forget_awaited_states
 from opensafely.jobrunner.run import main as run_main
 
 
@@ -258,7 +260,10 @@ def create_and_run_jobs(
     docker.LABEL = docker_label
     config.HIGH_PRIVACY_WORKSPACES_DIR = project_dir.parent
     config.DATABASE_FILE = project_dir / "metadata" / "db.sqlite"
+    config.ARCHIVE_DATABASE_FILE = project_dir / "metadata" / "archive.sqlite"
+    config.METRICS_FILE = project_dir / "metadata" / "metrics.sqlite"
     config.TMP_DIR = temp_dir
+    config.CHECKOUT_CACHE_DIR = temp_dir / "checkouts"
     config.JOB_LOG_DIR = temp_dir / "logs"
     config.BACKEND = "expectations"
     config.USING_DUMMY_DATA_BACKEND = True
@@ -267,6 +272,9 @@ def create_and_run_jobs(
     config.MAX_DB_WORKERS = concurrency
     config.DEFAULT_JOB_MEMORY_LIMIT = memory
     config.DEFAULT_JOB_CPU_COUNT = cpus
+    # Outputs are written straight into the researcher's project directory,
+    # where they expect to find them exactly as their actions wrote them
+    config.COMPRESS_HIGHLY_SENSITIVE_OUTPUTS = False
 
     # We want to fetch any reusable actions code directly from Github so as to
     # avoid pushing unnecessary traffic through the proxy
@@ -313,6 +321,8 @@ def create_and_run_jobs(
         {"cancelled": True, "state": State.FAILED},
         state__in=[State.RUNNING, State.PENDING],
     )
+    # That bypasses the run loop, so it mustn't rely on what it knew before
+    forget_awaited_states()
 
     try:
         job_request, jobs = create_job_request_and_jobs(
@@ -594,6 +604,10 @@ def get_docker_images(jobs):
     return full_docker_images
 
 
+# As added by `docker logs --timestamps`, e.g. "2021-01-01T12:00:00.000000000Z "
+DOCKER_TIMESTAMP_PREFIX = re.compile(r"^\d{4}-\d{2}-\d{2}T\S+Z ")
+
+
 def get_log_file_snippet(log_file, max_lines):
     try:
         contents = Path(log_file).read_text()
@@ -602,8 +616,12 @@ def get_log_file_snippet(log_file, max_lines):
     # As docker logs are timestamp-prefixed the first blank line marks the end
     # of the docker logs and the start of our "trailer"
     docker_logs = contents.partition("\n\n")[0]
-    # Strip off timestamp
-    log_lines = [line[31:] for line in docker_logs.splitlines()]
+    # Strip off timestamp, which lines we add ourselves (like the truncation
+    # marker) don't have
+    log_lines = [
+        DOCKER_TIMESTAMP_PREFIX.sub("", line, count=1)
+        for line in docker_logs.splitlines()
+    ]
     if len(log_lines) > max_lines:
         log_lines = log_lines[-max_lines:]
         truncated = True
@@ -50,6 +50,58 @@ WORKDIR = Path(os.environ.get("WORKDIR", default_work_dir)).resolve()
 DATABASE_FILE = WORKDIR / "db.sqlite"
 METRICS_FILE = WORKDIR / "metrics.sqlite"
 GIT_REPO_DIR = WORKDIR / "repos"
+# How long (in seconds) to trust our record of where a remote ref points, and
+# that a commit is not reachable from a ref. Reachable commits are cached for
+# good.
+GIT_REF_CACHE_TTL = float(os.environ.get("GIT_REF_CACHE_TTL", "60"))
+GIT_REACHABILITY_CACHE_TTL = float(os.environ.get("GIT_REACHABILITY_CACHE_TTL", "60"))
+# How often (in seconds) the runner prunes and repacks the local repos, 0 to
+# disable. Commits used by jobs created in the last GIT_MAINTENANCE_KEEP_DAYS
+# days are kept, as are any the runner has read from or checked out in the last
+# GIT_MAINTENANCE_GRACE_PERIOD seconds, whose jobs may not have been created yet.
+GIT_MAINTENANCE_INTERVAL = float(os.environ.get("GIT_MAINTENANCE_INTERVAL", "0"))
+GIT_MAINTENANCE_KEEP_DAYS = float(os.environ.get("GIT_MAINTENANCE_KEEP_DAYS", "30"))
+GIT_MAINTENANCE_GRACE_PERIOD = float(
+    os.environ.get("GIT_MAINTENANCE_GRACE_PERIOD", "3600")
+)
+# How often (in seconds) the runner moves jobs which finished more than
+# JOB_ARCHIVE_AFTER_DAYS days ago into ARCHIVE_DATABASE_FILE, 0 to disable. Jobs
+# are moved JOB_ARCHIVE_BATCH_SIZE at a time, pausing JOB_ARCHIVE_BATCH_PAUSE
+# seconds between batches.
+ARCHIVE_DATABASE_FILE = WORKDIR / "archive.sqlite"
+JOB_ARCHIVE_INTERVAL = float(os.environ.get("JOB_ARCHIVE_INTERVAL", "0"))
+JOB_ARCHIVE_AFTER_DAYS = float(os.environ.get("JOB_ARCHIVE_AFTER_DAYS", "90"))
+JOB_ARCHIVE_BATCH_SIZE = int(os.environ.get("JOB_ARCHIVE_BATCH_SIZE", "500"))
+JOB_ARCHIVE_BATCH_PAUSE = float(os.environ.get("JOB_ARCHIVE_BATCH_PAUSE", "0.1"))
+
+
+def parse_database_pragmas(value):
+    """Parse a comma separated list of name=value SQLite PRAGMAs"""
+    pragmas = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        name, _, pragma_value = (part.strip() for part in item.partition("="))
+        if not re.fullmatch(r"[a-z_]+", name) or not re.fullmatch(
+            r"-?\w+", pragma_value
+        ):
+            raise RuntimeError(f"DATABASE_PRAGMAS not in valid format: '{value}'")
+        pragmas[name] = pragma_value
+    return pragmas
+
+
+# How SQLite connections are tuned, see `database.CONNECTION_PROFILES`. The
+# "durable" profile syncs every commit to disk; "fast" trades the last few
+# commits before a power failure for cheaper writes. DATABASE_PRAGMAS overrides
+# individual settings, e.g. "cache_size=-32000,mmap_size=0".
+DATABASE_PROFILE = os.environ.get("DATABASE_PROFILE", "durable")
+if DATABASE_PROFILE not in ("durable", "fast"):
+    raise RuntimeError(
+        f"DATABASE_PROFILE must be durable or fast: '{DATABASE_PROFILE}'"
+    )
+DATABASE_PRAGMAS = parse_database_pragmas(os.environ.get("DATABASE_PRAGMAS", ""))
+# How long (in seconds) to wait for another connection's lock before failing
+DATABASE_BUSY_TIMEOUT = float(os.environ.get("DATABASE_BUSY_TIMEOUT", "5"))
 
 # valid archive formats
 ARCHIVE_FORMATS = (".tar.gz", ".tar.zstd", ".tar.xz")
@@ -65,6 +117,16 @@ PRIVATE_REPO_ACCESS_TOKEN = os.environ.get("PRIVATE_REPO_ACCESS_TOKEN", "")
 POLL_INTERVAL = float(os.environ.get("POLL_INTERVAL", "5"))
 JOB_LOOP_INTERVAL = float(os.environ.get("JOB_LOOP_INTERVAL", "1.0"))
 
+# Which LOOP_JOB spans the run loop records when it handles each active job:
+# "all" of them, or only "changes", where a job's state or status code changed,
+# handling it failed or the executor asked us to retry. With "changes", a
+# LOOP_SPAN_SAMPLE_RATE fraction of the other spans are still recorded, and the
+# rest are summarised in a single LOOP span for each loop.
+LOOP_SPANS = os.environ.get("LOOP_SPANS", "all")
+if LOOP_SPANS not in ("all", "changes"):
+    raise RuntimeError(f"LOOP_SPANS must be all or changes: '{LOOP_SPANS}'")
+LOOP_SPAN_SAMPLE_RATE = float(os.environ.get("LOOP_SPAN_SAMPLE_RATE", "0"))
+
 BACKEND = os.environ.get("BACKEND", "expectations")
 if not _is_valid_backend_name(BACKEND):
     raise RuntimeError(f"BACKEND not in valid format: '{BACKEND}'")
@@ -168,6 +230,18 @@ ALLOWED_GITHUB_ORGS = (
 # we don't want to push traffic via the proxy when running locally.
 GIT_PROXY_DOMAIN = "github-proxy.opensafely.org"
 
+# Fetch commits without their file contents, which git then fetches on demand
+# as they are needed. This needs a remote which supports partial clone, as
+# GitHub does.
+GIT_PARTIAL_FETCH = os.environ.get("GIT_PARTIAL_FETCH", "").lower() in truthy
+# Comma separated git pathspecs to leave out when checking out code for jobs,
+# e.g. large committed data files which no action needs
+GIT_CHECKOUT_EXCLUDE = [
+    path.strip()
+    for path in os.environ.get("GIT_CHECKOUT_EXCLUDE", "").split(",")
+    if path.strip()
+]
+
 
 def parse_job_resource_weights(config_file):
     """
@@ -201,7 +275,17 @@ def parse_job_resource_weights(config_file):
 JOB_RESOURCE_WEIGHTS = parse_job_resource_weights("job-resource-weights.ini")
 
 
+# Whether the runner samples the resource usage of running jobs into
+# METRICS_FILE, every STATS_POLL_INTERVAL seconds. Samples older than
+# METRICS_DOWNSAMPLE_AFTER_DAYS days are combined into one per
+# METRICS_DOWNSAMPLE_INTERVAL seconds, and deleted after METRICS_RETENTION_DAYS.
+RECORD_STATS = os.environ.get("RECORD_STATS", "").lower() in truthy
 STATS_POLL_INTERVAL = float(os.environ.get("STATS_POLL_INTERVAL", "10"))
+METRICS_DOWNSAMPLE_AFTER_DAYS = float(
+    os.environ.get("METRICS_DOWNSAMPLE_AFTER_DAYS", "1")
+)
+METRICS_DOWNSAMPLE_INTERVAL = int(os.environ.get("METRICS_DOWNSAMPLE_INTERVAL", "300"))
+METRICS_RETENTION_DAYS = float(os.environ.get("METRICS_RETENTION_DAYS", "90"))
 MAINTENANCE_POLL_INTERVAL = float(
     os.environ.get("MAINTENANCE_POLL_INTERVAL", "300")
 )  # 5 min
@@ -255,16 +339,37 @@ MEDIUM_PRIVACY_STORAGE_BASE = Path(
 HIGH_PRIVACY_WORKSPACES_DIR = HIGH_PRIVACY_STORAGE_BASE / "workspaces"
 MEDIUM_PRIVACY_WORKSPACES_DIR = MEDIUM_PRIVACY_STORAGE_BASE / "workspaces"
 JOB_LOG_DIR = HIGH_PRIVACY_STORAGE_BASE / "logs"
+# Maximum amount of container output we keep in a job's log, in bytes. Beyond
+# this, we keep the head and tail of the output and drop the middle.
+JOB_LOG_MAX_BYTES = int(os.environ.get("JOB_LOG_MAX_BYTES", 32 * 1024 * 1024))
 HIGH_PRIVACY_ARCHIVE_DIR = Path(
     os.environ.get("HIGH_PRIVACY_ARCHIVE_DIR", HIGH_PRIVACY_STORAGE_BASE / "archives")
 )
 
+# Opt-in zstd compression of large highly_sensitive outputs in the high privacy
+# workspace. Requires the zstandard package (the `compression` extra).
+COMPRESS_HIGHLY_SENSITIVE_OUTPUTS = (
+    os.environ.get("COMPRESS_HIGHLY_SENSITIVE_OUTPUTS", "false").lower().strip()
+    in truthy
+)
+# only compress files at least this big, in bytes
+COMPRESSION_MIN_SIZE = int(os.environ.get("COMPRESSION_MIN_SIZE", 64 * 1024 * 1024))
+COMPRESSION_LEVEL = int(os.environ.get("COMPRESSION_LEVEL", 3))
+# number of compression threads, negative means use all available cores
+COMPRESSION_THREADS = int(os.environ.get("COMPRESSION_THREADS", -1))
+
 # Automatically delete containers and volumes after they have been used
 CLEAN_UP_DOCKER_OBJECTS = True
 
 # use to checkout the repo
 TMP_DIR = WORKDIR / "temp"
 
+# checked out trees, shared by all the jobs which use the same commit
+CHECKOUT_CACHE_DIR = WORKDIR / "checkouts"
+CHECKOUT_CACHE_MAX_BYTES = int(
+    os.environ.get("CHECKOUT_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+)  # 1gb
+
 # docker specific exit codes we understand
 DOCKER_EXIT_CODES = {
     # 137 = 128+9, which means was killed by signal 9, SIGKILL
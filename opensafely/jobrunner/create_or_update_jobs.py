@@ -18,10 +18,15 @@ from opensafely._vendor.pipeline import (
 )
 
 from opensafely.jobrunner import config, tracing
-from opensafely.jobrunner.actions import get_action_specification
+from opensafely.jobrunner.actions import (
+    DependencyCycleError,
+    get_action_specification,
+)
+from opensafely.jobrunner.archive import archived_job_exists
 from opensafely.jobrunner.lib.database import (
     exists_where,
     insert,
+    insert_many,
     transaction,
     update_where,
 )
@@ -197,12 +202,18 @@ def get_new_jobs_to_run(job_request, pipeline_config, current_jobs):
     """
     # Build a dict mapping action names to job instances
     jobs_by_action = {job.action: job for job in current_jobs}
-    # Add new jobs to it by recursing through the dependency tree
-    for action in get_actions_to_run(job_request, pipeline_config):
-        recursively_build_jobs(jobs_by_action, job_request, pipeline_config, action)
+    # Add new jobs to it by walking the dependency graph
+    build_jobs(
+        jobs_by_action,
+        job_request,
+        pipeline_config,
+        get_actions_to_run(job_request, pipeline_config),
+    )
 
-    # Pick out the new jobs we've added and return them
-    return [job for job in jobs_by_action.values() if job not in current_jobs]
+    # Pick out the new jobs we've added and return them. Jobs compare by value,
+    # which is slow and not what we mean here, so we compare by identity.
+    current_job_ids = {id(job) for job in current_jobs}
+    return [job for job in jobs_by_action.values() if id(job) not in current_job_ids]
 
 
 def get_actions_to_run(job_request, pipeline_config):
@@ -213,34 +224,75 @@ def get_actions_to_run(job_request, pipeline_config):
         return job_request.requested_actions
 
 
-def recursively_build_jobs(jobs_by_action, job_request, pipeline_config, action):
+def build_jobs(jobs_by_action, job_request, pipeline_config, actions):
     """
-    Recursively populate the `jobs_by_action` dict with jobs
+    Populate the `jobs_by_action` dict with jobs for `actions`, and for any
+    actions they depend on which need to be run
+
+    We walk the dependency graph depth-first, so that every job is created
+    after the jobs it depends on. This is done iteratively rather than
+    recursively so that long chains of actions don't hit Python's recursion
+    limit.
 
     Args:
         jobs_by_action: A dict mapping action ID strings to Job instances
         job_request: An instance of JobRequest representing the job request.
         pipeline_config: A Pipeline instance representing the pipeline configuration.
-        action: The string ID of the action to be added as a job.
-    """
-    existing_job = jobs_by_action.get(action)
-    if existing_job and not job_should_be_rerun(job_request, existing_job):
-        return
-
-    action_spec = get_action_specification(
-        pipeline_config,
-        action,
-        using_dummy_data_backend=config.USING_DUMMY_DATA_BACKEND,
-    )
+        actions: The string IDs of the actions to be added as jobs.
 
-    # Walk over the dependencies of this action, creating any necessary jobs,
-    # and ensure that this job waits for its dependencies to finish before it
-    # starts
+    Raises:
+        DependencyCycleError: The actions' dependencies form a cycle.
+        UnknownActionError: An action was not found in the project.
+    """
+    action_specs = {}
+
+    def get_spec(action):
+        if action not in action_specs:
+            action_specs[action] = get_action_specification(
+                pipeline_config,
+                action,
+                using_dummy_data_backend=config.USING_DUMMY_DATA_BACKEND,
+            )
+        return action_specs[action]
+
+    for requested_action in actions:
+        stack = [requested_action]
+        # Maps the actions we're part way through building to an iterator over
+        # the dependencies we've still to visit. These are exactly the actions
+        # on the stack, in the same order.
+        in_progress = {}
+        while stack:
+            action = stack[-1]
+            if action not in in_progress:
+                existing_job = jobs_by_action.get(action)
+                if existing_job and not job_should_be_rerun(job_request, existing_job):
+                    stack.pop()
+                    continue
+                in_progress[action] = iter(get_spec(action).needs)
+
+            for required_action in in_progress[action]:
+                if required_action in in_progress:
+                    cycle = list(in_progress)
+                    cycle = cycle[cycle.index(required_action) :] + [required_action]
+                    raise DependencyCycleError(
+                        f"Actions depend on each other in a cycle: {' -> '.join(cycle)}"
+                    )
+                stack.append(required_action)
+                break
+            else:
+                # All its dependencies have been handled, so now we can add it
+                del in_progress[action]
+                stack.pop()
+                jobs_by_action[action] = build_job(
+                    jobs_by_action, job_request, action, get_spec(action)
+                )
+
+
+def build_job(jobs_by_action, job_request, action, action_spec):
+    # Ensure that this job waits for any of its dependencies which are yet to
+    # finish before it starts
     wait_for_job_ids = []
     for required_action in action_spec.needs:
-        recursively_build_jobs(
-            jobs_by_action, job_request, pipeline_config, required_action
-        )
         required_job = jobs_by_action[required_action]
         if required_job.state in [State.PENDING, State.RUNNING]:
             wait_for_job_ids.append(required_job.id)
@@ -267,9 +319,7 @@ def recursively_build_jobs(jobs_by_action, job_request, pipeline_config, action)
         updated_at=int(timestamp),
     )
     tracing.initialise_trace(job)
-
-    # Add it to the dictionary of scheduled jobs
-    jobs_by_action[action] = job
+    return job
 
 
 def job_should_be_rerun(job_request, job):
@@ -391,12 +441,13 @@ def create_job_from_exception(job_request, exception):
 def insert_into_database(job_request, jobs):
     with transaction():
         insert(SavedJobRequest(id=job_request.id, original=job_request.original))
-        for job in jobs:
-            insert(job)
+        insert_many(jobs)
 
 
 def related_jobs_exist(job_request):
-    return exists_where(Job, job_request_id=job_request.id)
+    return exists_where(Job, job_request_id=job_request.id) or archived_job_exists(
+        job_request_id=job_request.id
+    )
 
 
 def set_cancelled_flag_for_actions(job_request_id, actions):
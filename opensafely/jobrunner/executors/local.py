@@ -1,4 +1,5 @@
 import csv
+import dataclasses
 import datetime
 import json
 import logging
@@ -22,10 +23,19 @@ from opensafely.jobrunner.job_executor import (
     JobStatus,
     Privacy,
 )
-from opensafely.jobrunner.lib import datestr_to_ns_timestamp, docker, file_digest
-from opensafely.jobrunner.lib.git import checkout_commit
+from opensafely.jobrunner.lib import (
+    atomic_writer,
+    checkout_cache,
+    compression,
+    datestr_to_ns_timestamp,
+    docker,
+    file_digest,
+    log_capture,
+)
+from opensafely.jobrunner.lib.lru_dict import LRUDict
 from opensafely.jobrunner.lib.path_utils import list_dir_with_ignore_patterns
 from opensafely.jobrunner.lib.string_utils import tabulate
+from opensafely.jobrunner.metrics import get_job_metrics
 
 
 # Directory inside working directory where manifest and logs are created
@@ -38,8 +48,14 @@ MANIFEST_FILE = "manifest.json"
 # created
 TIMESTAMP_REFERENCE_FILE = ".opensafely-timestamp"
 
-# cache of result objects
-RESULTS = {}
+# Finalized results are kept in this directory under JOB_LOG_DIR, by job id, so
+# that they survive a restart of the job-runner between finalizing and the
+# results being collected. Unlike the job's logs they aren't split up by month,
+# so that we can always find them without knowing when the job was finalized.
+RESULTS_DIR = "results"
+
+# bounded in-memory cache of result objects, backed by RESULTS_DIR
+RESULTS = LRUDict(1000)
 LABEL = "jobrunner-local"
 
 log = logging.getLogger(__name__)
@@ -183,6 +199,10 @@ class LocalDockerAPI(ExecutorAPI):
                 ExecutorState.ERROR, f"Failed to start docker container: {exc}"
             )
 
+        log_capture.start_capture(
+            container_name(job_definition), get_log_dir(job_definition) / "logs.txt"
+        )
+
         return JobStatus(ExecutorState.EXECUTING)
 
     def finalize(self, job_definition):
@@ -236,7 +256,11 @@ class LocalDockerAPI(ExecutorAPI):
         else:
             log.info("Leaving container and volume in place for debugging")
 
+        log_capture.stop_capture(container_name(job_definition))
         RESULTS.pop(job_definition.id, None)
+        # The results have been collected by now, and job ids can be re-used
+        # (e.g. when a job is reset for a reboot), so don't leave them around
+        get_results_file(job_definition).unlink(missing_ok=True)
         return JobStatus(ExecutorState.UNKNOWN)
 
     def get_status(self, job_definition, timeout=15):
@@ -283,12 +307,15 @@ class LocalDockerAPI(ExecutorAPI):
 
         if container["State"]["Running"]:
             timestamp_ns = datestr_to_ns_timestamp(container["State"]["StartedAt"])
-            return JobStatus(ExecutorState.EXECUTING, timestamp_ns=timestamp_ns)
-        elif job_definition.id in RESULTS:
             return JobStatus(
-                ExecutorState.FINALIZED,
-                timestamp_ns=RESULTS[job_definition.id].timestamp_ns,
+                ExecutorState.EXECUTING,
+                timestamp_ns=timestamp_ns,
+                metrics=get_job_metrics(job_definition.id),
             )
+
+        results = load_results(job_definition)
+        if results is not None:
+            return JobStatus(ExecutorState.FINALIZED, timestamp_ns=results.timestamp_ns)
         else:
             # container present but not running, i.e. finished
             # Nb. this does not include prepared jobs, as they have a volume but not a container
@@ -296,14 +323,19 @@ class LocalDockerAPI(ExecutorAPI):
             return JobStatus(ExecutorState.EXECUTED, timestamp_ns=timestamp_ns)
 
     def get_results(self, job_definition):
-        if job_definition.id not in RESULTS:
+        results = load_results(job_definition)
+        if results is None:
             return JobStatus(ExecutorState.ERROR, "job has not been finalized")
 
-        return RESULTS[job_definition.id]
+        return results
 
     def delete_files(self, workspace, privacy, files):
         if privacy == Privacy.HIGH:
             root = get_high_privacy_workspace(workspace)
+            # outputs may be stored compressed in the high privacy workspace
+            files = list(files) + [
+                f"{name}{compression.COMPRESSED_SUFFIX}" for name in files
+            ]
         elif privacy == Privacy.MEDIUM:
             root = get_medium_privacy_workspace(workspace)
         else:
@@ -355,11 +387,18 @@ def prepare_job(job_definition):
 
     for filename in job_definition.inputs:
         log.info(f"Copying input file: {filename}")
-        if not (workspace_dir / filename).exists():
+        src, is_compressed = compression.resolve_stored_file(workspace_dir / filename)
+        if src is None:
             raise LocalDockerError(
                 f"The file {filename} doesn't exist in workspace {job_definition.workspace} as requested for job {job_definition.id}"
             )
-        volume_api.copy_to_volume(job_definition, workspace_dir / filename, filename)
+        if is_compressed:
+            try:
+                volume_api.copy_compressed_to_volume(job_definition, src, filename)
+            except compression.CompressionUnavailable as exc:
+                raise LocalDockerError(str(exc))
+        else:
+            volume_api.copy_to_volume(job_definition, src, filename)
 
     # Used to record state for telemetry, and also see `get_unmatched_outputs`
     volume_api.write_timestamp(job_definition, TIMESTAMP_REFERENCE_FILE)
@@ -452,12 +491,38 @@ def finalize_job(job_definition):
         )
         results.level4_excluded_files.update(**excluded)
 
-    RESULTS[job_definition.id] = results
+    write_results(job_definition, results)
 
     # for ease of testing
     return results
 
 
+def write_results(job_definition, results):
+    """Persist the results to the results dir and cache them."""
+    with atomic_writer(get_results_file(job_definition)) as tmp:
+        tmp.write_text(json.dumps(dataclasses.asdict(results)))
+    RESULTS[job_definition.id] = results
+
+
+def load_results(job_definition):
+    """Load the finalized results for a job, or None if it's not finalized."""
+    results = RESULTS.get(job_definition.id)
+    if results is not None:
+        return results
+
+    results_file = get_results_file(job_definition)
+    if not results_file.exists():
+        return None
+
+    results = JobResults(**json.loads(results_file.read_text()))
+    RESULTS[job_definition.id] = results
+    return results
+
+
+def get_results_file(job_definition):
+    return config.JOB_LOG_DIR / RESULTS_DIR / f"{job_definition.id}.json"
+
+
 def get_job_metadata(job_definition, outputs, container_metadata, results):
     # job_metadata is a big dict capturing everything we know about the state
     # of the job
@@ -484,7 +549,9 @@ def write_job_logs(
     """Copy logs to log dir and workspace."""
     # Dump useful info in log directory
     log_dir = get_log_dir(job_definition)
-    write_log_file(job_definition, job_metadata, log_dir / "logs.txt", excluded)
+    log_file = log_dir / "logs.txt"
+    write_log_file(job_definition, job_metadata, log_file, excluded)
+    log_capture.write_compressed_copy(log_file)
     with open(log_dir / "metadata.json", "w") as f:
         json.dump(job_metadata, f, indent=2)
 
@@ -493,12 +560,12 @@ def write_job_logs(
         workspace_log_file = (
             workspace_dir / METADATA_DIR / f"{job_definition.action}.log"
         )
-        volumes.copy_file(log_dir / "logs.txt", workspace_log_file)
+        volumes.link_or_copy_file(log_file, workspace_log_file)
         log.info(f"Logs written to: {workspace_log_file}")
 
         medium_privacy_dir = get_medium_privacy_workspace(job_definition.workspace)
         if medium_privacy_dir:
-            volumes.copy_file(
+            volumes.link_or_copy_file(
                 workspace_log_file,
                 medium_privacy_dir / METADATA_DIR / f"{job_definition.action}.log",
             )
@@ -520,6 +587,8 @@ def persist_outputs(job_definition, outputs, job_metadata):
         sizes[filename] = volumes.get_volume_api(job_definition).copy_from_volume(
             job_definition, filename, dst
         )
+        # any previous compressed version of this output is now stale
+        compression.compressed_path(dst).unlink(missing_ok=True)
 
     l4_files = [
         filename
@@ -541,6 +610,7 @@ def persist_outputs(job_definition, outputs, job_metadata):
 
     # local run currently does not have a level 4 directory, so exit early
     if not medium_privacy_dir:
+        compress_outputs(workspace_dir, outputs, sizes)
         return excluded_job_msgs
 
     # Copy out medium privacy files to L4
@@ -574,6 +644,12 @@ def persist_outputs(job_definition, outputs, job_metadata):
             csv_counts=csv_metadata.get(filename),
         )
 
+    # We compress after gathering metadata, so that the size and content hash
+    # in the manifest are always those of the uncompressed file
+    compressed_sizes = compress_outputs(workspace_dir, outputs, sizes)
+    for filename, compressed_size in compressed_sizes.items():
+        new_outputs[filename]["compressed_size"] = compressed_size
+
     # Update manifest with file metdata
     manifest = read_manifest_file(medium_privacy_dir, job_definition.workspace)
     manifest["outputs"].update(**new_outputs)
@@ -582,6 +658,20 @@ def persist_outputs(job_definition, outputs, job_metadata):
     return excluded_job_msgs
 
 
+def compress_outputs(workspace_dir, outputs, sizes):
+    """Compress any large highly_sensitive outputs in the workspace, if enabled.
+
+    Returns a dict mapping filenames to their compressed size.
+    """
+    compressed_sizes = {}
+    for filename, level in outputs.items():
+        if not compression.should_compress(sizes[filename], level):
+            continue
+        log.info(f"Compressing output file: {filename}")
+        compressed_sizes[filename] = compression.compress_file(workspace_dir / filename)
+    return compressed_sizes
+
+
 def get_output_metadata(
     abspath,
     level,
@@ -606,6 +696,7 @@ def get_output_metadata(
         "repo": repo,
         "commit": commit,
         "size": stat.st_size,
+        "compressed_size": None,
         "timestamp": stat.st_mtime,
         "content_hash": content_hash,
         "excluded": excluded,
@@ -784,7 +875,7 @@ def write_log_file(job_definition, job_metadata, filename, excluded):
     some useful metadata about the job and its outputs
     """
     filename.parent.mkdir(parents=True, exist_ok=True)
-    docker.write_logs_to_file(container_name(job_definition), filename)
+    log_capture.collect_logs(container_name(job_definition), filename)
     outputs = sorted(job_metadata["outputs"].items())
     with open(filename, "a") as f:
         f.write("\n\n")
@@ -824,16 +915,19 @@ def copy_git_commit_to_volume(job_definition, repo_url, commit, extra_dirs):
     config.TMP_DIR.mkdir(parents=True, exist_ok=True)
     with tempfile.TemporaryDirectory(dir=config.TMP_DIR) as tmpdir:
         tmpdir = Path(tmpdir)
-        checkout_commit(repo_url, commit, tmpdir)
         # Because `docker cp` can't create parent directories automatically, we
         # make sure parent directories exist for all the files we're going to
         # copy in later
         for directory in extra_dirs:
             tmpdir.joinpath(directory).mkdir(parents=True, exist_ok=True)
         try:
-            volumes.get_volume_api(job_definition).copy_to_volume(
-                job_definition, tmpdir, ".", timeout=60
-            )
+            volume_api = volumes.get_volume_api(job_definition)
+            # Jobs in the same request share a commit, so we check it out once
+            # and copy the files straight from there
+            with checkout_cache.cached_checkout(repo_url, commit) as checkout:
+                volume_api.copy_to_volume(job_definition, checkout, ".", timeout=60)
+            if extra_dirs:
+                volume_api.copy_to_volume(job_definition, tmpdir, ".", timeout=60)
         except docker.DockerTimeoutError:
             # Aborting a `docker cp` into a container at the wrong time can
             # leave the container in a completely broken state where any
@@ -9,7 +9,7 @@ from collections import defaultdict
 from pathlib import Path
 
 from opensafely.jobrunner import config
-from opensafely.jobrunner.lib import atomic_writer, docker
+from opensafely.jobrunner.lib import atomic_writer, compression, docker
 
 
 logger = logging.getLogger(__name__)
@@ -29,6 +29,24 @@ def copy_file(source, dest, follow_symlinks=True):
     return dest.stat().st_size
 
 
+def link_or_copy_file(source, dest):
+    """Atomically hardlink `source` to `dest`, falling back to copying.
+
+    This is for files which are written once and never modified in place, so
+    it's safe for the two paths to share an inode. Hardlinks aren't possible
+    across filesystems, in which case we copy.
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with atomic_writer(dest) as tmp:
+            os.link(source, tmp)
+    except OSError:
+        return copy_file(source, dest)
+
+    return dest.stat().st_size
+
+
 def docker_volume_name(job):
     return f"os-volume-{job.id}"
 
@@ -51,6 +69,14 @@ class DockerVolumeAPI:
     def copy_to_volume(job, src, dst, timeout=None):
         docker.copy_to_volume(docker_volume_name(job), src, dst, timeout)
 
+    def copy_compressed_to_volume(job, src, dst, timeout=None):
+        # docker cp can't decompress for us, so stage a decompressed copy first
+        config.TMP_DIR.mkdir(parents=True, exist_ok=True)
+        with tempfile.TemporaryDirectory(dir=config.TMP_DIR) as tmpdir:
+            staged = Path(tmpdir) / Path(dst).name
+            compression.decompress_file(src, staged)
+            docker.copy_to_volume(docker_volume_name(job), staged, dst, timeout)
+
     def copy_from_volume(job, src, dst, timeout=None):
         return docker.copy_from_volume(docker_volume_name(job), src, dst, timeout)
 
@@ -139,6 +165,10 @@ class BindMountVolumeAPI:
         else:
             copy_file(src, volume / dst)
 
+    def copy_compressed_to_volume(job, src, dst, timeout=None):
+        # We don't respect the timeout. Decompress straight into the volume.
+        compression.decompress_file(src, host_volume_path(job) / dst)
+
     def copy_from_volume(job, src, dst, timeout=None):
         # this is only used to copy final outputs/logs.
         path = host_volume_path(job) / src
@@ -0,0 +1,181 @@
+"""
+Housekeeping for the local git repos in config.GIT_REPO_DIR
+
+Every commit we fetch leaves behind its objects and a `fetched/<sha>` sentinel
+tag (see `git.commit_already_fetched`), so the repos grow without bound and
+ref operations get slower. Here we prune the sentinel tags for commits which no
+active or recent job uses, and then repack and prune the repos so that the
+objects only those commits needed are deleted.
+"""
+
+import dataclasses
+import itertools
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import git
+from opensafely.jobrunner.lib.database import iter_where
+from opensafely.jobrunner.lib.subprocess_utils import subprocess_run
+from opensafely.jobrunner.models import Job, State
+
+
+log = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class RepoMaintenanceResult:
+    repo_dir: Path
+    tags_pruned: int
+    size_before: int
+    size_after: int
+    duration: float
+
+    @property
+    def reclaimed(self):
+        return self.size_before - self.size_after
+
+
+def maintain_repos(keep_days=None):
+    """
+    Prune and repack every local repo, returning a list of RepoMaintenanceResult
+
+    Commits used by active jobs, or by any job created in the last `keep_days`
+    days, are kept. So are commits this process has used in the last
+    config.GIT_MAINTENANCE_GRACE_PERIOD seconds, as we read a job request's
+    project file before we create its jobs.
+    """
+    if keep_days is None:
+        keep_days = config.GIT_MAINTENANCE_KEEP_DAYS
+    start = time.monotonic()
+    keep = get_commits_in_use(keep_days)
+    results = []
+    for repo_dir in sorted(config.GIT_REPO_DIR.glob("*.git")):
+        try:
+            result = maintain_repo(repo_dir, keep.get(repo_dir, set()))
+        except Exception:
+            log.exception(f"Error maintaining {repo_dir}")
+            continue
+        log.info(
+            f"Pruned {result.tags_pruned} commits from {repo_dir.name}, reclaiming"
+            f" {format_size(result.reclaimed)} in {result.duration:.1f}s"
+        )
+        results.append(result)
+    reclaimed = sum(result.reclaimed for result in results)
+    log.info(
+        f"Reclaimed {format_size(reclaimed)} from {len(results)} repos"
+        f" in {time.monotonic() - start:.1f}s"
+    )
+    return results
+
+
+def get_commits_in_use(keep_days):
+    """Return a dict mapping local repo dirs to the set of commits to keep"""
+    cutoff = int(time.time()) - int(keep_days * 24 * 60 * 60)
+    columns = ["repo_url", "commit", "action_repo_url", "action_commit"]
+    jobs = itertools.chain(
+        iter_where(Job, columns=columns, state__in=[State.PENDING, State.RUNNING]),
+        iter_where(Job, columns=columns, created_at__gte=cutoff),
+    )
+    keep = {}
+    for job in jobs:
+        for repo_url, commit in [
+            (job.repo_url, job.commit),
+            (job.action_repo_url, job.action_commit),
+        ]:
+            if repo_url and commit:
+                keep.setdefault(git.get_local_repo_dir(repo_url), set()).add(commit)
+    return keep
+
+
+def maintain_repo(repo_dir, keep):
+    start = time.monotonic()
+    size_before = get_dir_size(repo_dir)
+    with git.repo_lock(repo_dir):
+        # `ensure_commit_fetched` skips the lock for commits it has already
+        # seen, so forget them before deciding what to keep. Anything used from
+        # now on has to wait for us, and anything used before now is either in
+        # `keep` already or recently used.
+        git.forget_fetched_commits(repo_dir)
+        keep = keep | git.get_recently_used_commits(
+            repo_dir, config.GIT_MAINTENANCE_GRACE_PERIOD
+        )
+        prune_refs = [
+            ref
+            for ref in list_sentinel_tags(repo_dir)
+            if ref.rpartition("/")[2] not in keep
+        ]
+        if prune_refs:
+            subprocess_run(
+                ["git", "update-ref", "--stdin"],
+                input="".join(f"delete {ref}\n" for ref in prune_refs),
+                check=True,
+                capture_output=True,
+                text=True,
+                cwd=repo_dir,
+            )
+        git.forget_fetched_commits(repo_dir)
+        # Make sure nothing holds on to packs we're about to delete
+        git.close_cat_file_process(repo_dir)
+        for command in [
+            ["git", "pack-refs", "--all", "--prune"],
+            ["git", "repack", "-a", "-d", "--quiet"],
+            ["git", "prune", "--expire=now"],
+        ]:
+            subprocess_run(command, check=True, capture_output=True, cwd=repo_dir)
+    return RepoMaintenanceResult(
+        repo_dir=repo_dir,
+        tags_pruned=len(prune_refs),
+        size_before=size_before,
+        size_after=get_dir_size(repo_dir),
+        duration=time.monotonic() - start,
+    )
+
+
+def list_sentinel_tags(repo_dir):
+    response = subprocess_run(
+        [
+            "git",
+            "for-each-ref",
+            "--format=%(refname)",
+            f"refs/tags/{git.SENTINEL_TAG_PREFIX}",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=repo_dir,
+    )
+    return response.stdout.splitlines()
+
+
+def get_dir_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+def format_size(size):
+    return f"{size / (1024 * 1024):.1f}MB"
+
+
+def start_maintenance_thread(interval=None):
+    """Run `maintain_repos` every `interval` seconds in a background thread"""
+    if interval is None:
+        interval = config.GIT_MAINTENANCE_INTERVAL
+
+    def loop():
+        while True:
+            time.sleep(interval)
+            try:
+                maintain_repos()
+            except Exception:
+                log.exception("Error running git maintenance")
+
+    thread = threading.Thread(target=loop, name="git-maintenance", daemon=True)
+    thread.start()
+    return thread
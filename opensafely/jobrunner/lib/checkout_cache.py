@@ -0,0 +1,167 @@
+"""
+An on-disk cache of checked out git trees, keyed by repo and commit.
+
+Every job in a job request runs against the same commit, so rather than doing
+a full checkout for each job we check the commit out once into the cache and
+copy the files straight out of it. Cached trees are never modified once
+created.
+
+The cache is bounded by config.CHECKOUT_CACHE_MAX_BYTES, evicting the least
+recently used trees first.
+"""
+
+import hashlib
+import logging
+import os
+import secrets
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from pathlib import Path
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib.git import checkout_commit
+from opensafely.jobrunner.lib.string_utils import project_name_from_url
+
+
+log = logging.getLogger(__name__)
+
+# Per-entry locks, so that only one thread populates a given tree at a time
+LOCKS = defaultdict(threading.Lock)
+LOCKS_LOCK = threading.Lock()
+
+# The number of threads reading each tree, which mustn't be evicted until they
+# have finished. Only used while holding LOCKS_LOCK.
+READERS = defaultdict(int)
+
+# sizes of cached trees in bytes, by path
+SIZES = {}
+
+
+def cache_path(repo_url, commit_sha):
+    # As with the local repo dirs, the repo name is just for convenience: the
+    # commit sha and the paths left out of the checkout identify the tree
+    name = commit_sha
+    if config.GIT_CHECKOUT_EXCLUDE:
+        excludes = "\n".join(config.GIT_CHECKOUT_EXCLUDE).encode("utf8")
+        name += "-" + hashlib.sha256(excludes).hexdigest()[:16]
+    return config.CHECKOUT_CACHE_DIR / project_name_from_url(repo_url) / name
+
+
+def get_lock(path):
+    with LOCKS_LOCK:
+        return LOCKS[path]
+
+
+@contextmanager
+def cached_checkout(repo_url, commit_sha):
+    """
+    Yield the path to a checkout of `repo_url` as of `commit_sha`, populating
+    the cache if needed
+
+    The returned tree must not be modified.
+    """
+    path = cache_path(repo_url, commit_sha)
+    while not start_reading(path):
+        with get_lock(path):
+            if not path.exists():
+                populate(repo_url, commit_sha, path)
+    try:
+        yield path
+    finally:
+        with LOCKS_LOCK:
+            READERS[path] -= 1
+            if not READERS[path]:
+                del READERS[path]
+    evict(keep=path)
+
+
+def start_reading(path):
+    """
+    Count ourselves as reading the tree at `path`, returning False if there is
+    no such tree
+    """
+    # Eviction checks for readers while holding the same lock, so the tree
+    # can't disappear between here and counting ourselves
+    with LOCKS_LOCK:
+        if not path.exists():
+            return False
+        READERS[path] += 1
+    # mark as recently used
+    os.utime(path)
+    return True
+
+
+def populate(repo_url, commit_sha, path):
+    log.info(f"Checking out {repo_url}@{commit_sha} into cache")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = Path(tempfile.mkdtemp(dir=path.parent, prefix=f".{commit_sha}."))
+    try:
+        checkout_commit(repo_url, commit_sha, tmp)
+        try:
+            tmp.rename(path)
+        except OSError:
+            # another process got there first, which is fine
+            if not path.exists():
+                raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def evict(keep=None):
+    """Remove least recently used trees until the cache is within its budget"""
+    entries = [
+        path
+        for path in config.CHECKOUT_CACHE_DIR.glob("*/*")
+        if not path.name.startswith(".")
+    ]
+    sizes = {path: get_size(path) for path in entries}
+    total = sum(sizes.values())
+    for path in sorted(entries, key=get_mtime):
+        if total <= config.CHECKOUT_CACHE_MAX_BYTES:
+            break
+        if path == keep:
+            continue
+        with LOCKS_LOCK:
+            # skip anything that's currently being populated or read
+            if path in LOCKS and LOCKS[path].locked() or READERS.get(path):
+                continue
+            LOCKS.pop(path, None)
+            deleting = move_aside(path)
+        if deleting:
+            log.info(f"Evicted {path} from checkout cache")
+            shutil.rmtree(deleting, ignore_errors=True)
+        total -= sizes[path]
+
+
+def get_size(path):
+    if path not in SIZES:
+        size = 0
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+        SIZES[path] = size
+    return SIZES[path]
+
+
+def get_mtime(path):
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return 0
+
+
+def move_aside(path):
+    """
+    Move the tree at `path` somewhere it can be deleted from without anything
+    seeing it partially deleted, returning where to, or None if it's gone
+    """
+    SIZES.pop(path, None)
+    tmp = path.with_name(f".{path.name}.{secrets.token_hex(8)}.deleting")
+    try:
+        path.rename(tmp)
+    except FileNotFoundError:
+        return None
+    return tmp
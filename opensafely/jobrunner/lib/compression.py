@@ -0,0 +1,110 @@
+"""
+Transparent zstd compression for files stored at rest.
+
+The zstandard package is an optional dependency (install the
+`opensafely[compression]` extra), as it is only needed on backends that opt in
+to compressing highly sensitive outputs via config.COMPRESS_HIGHLY_SENSITIVE_OUTPUTS.
+Unlike our other dependencies it isn't vendored, as it is a compiled extension;
+see DEVELOPERS.md.
+"""
+
+import logging
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import atomic_writer
+
+
+try:
+    import zstandard
+
+    ZSTD_AVAILABLE = True
+except ImportError:
+    zstandard = None
+    ZSTD_AVAILABLE = False
+
+
+log = logging.getLogger(__name__)
+
+if config.COMPRESS_HIGHLY_SENSITIVE_OUTPUTS and not ZSTD_AVAILABLE:
+    log.warning(
+        "COMPRESS_HIGHLY_SENSITIVE_OUTPUTS is set but zstandard is not installed,"
+        " so outputs will be stored uncompressed"
+    )
+
+COMPRESSED_SUFFIX = ".zst"
+
+# buffer size used when streaming data through the (de)compressor
+CHUNK_SIZE = 2**20
+
+
+class CompressionUnavailable(Exception):
+    pass
+
+
+def compressed_path(path):
+    """Return the path a compressed copy of `path` is stored at."""
+    return path.with_name(path.name + COMPRESSED_SUFFIX)
+
+
+def should_compress(size, privacy_level):
+    """Do we want to store an output of this size and privacy level compressed?"""
+    if not config.COMPRESS_HIGHLY_SENSITIVE_OUTPUTS:
+        return False
+    if privacy_level != "highly_sensitive":
+        return False
+    if size < config.COMPRESSION_MIN_SIZE:
+        return False
+    # we warn about this once, when this module is loaded
+    return ZSTD_AVAILABLE
+
+
+def _ensure_available():
+    if not ZSTD_AVAILABLE:
+        raise CompressionUnavailable(
+            "zstandard is not installed, cannot handle compressed files"
+        )
+
+
+def compress_file(src, dst=None):
+    """Compress `src` to `dst`, and remove `src` once that has succeeded.
+
+    Compression is multi-threaded according to config.COMPRESSION_THREADS.
+    Returns the size of the compressed file.
+    """
+    _ensure_available()
+    if dst is None:
+        dst = compressed_path(src)
+    compressor = zstandard.ZstdCompressor(
+        level=config.COMPRESSION_LEVEL, threads=config.COMPRESSION_THREADS
+    )
+    with atomic_writer(dst) as tmp:
+        with src.open("rb") as fin, tmp.open("wb") as fout:
+            compressor.copy_stream(fin, fout, read_size=CHUNK_SIZE)
+    src.unlink()
+    return dst.stat().st_size
+
+
+def decompress_file(src, dst):
+    """Decompress `src` to `dst`, leaving `src` in place.
+
+    Returns the size of the decompressed file.
+    """
+    _ensure_available()
+    decompressor = zstandard.ZstdDecompressor()
+    with atomic_writer(dst) as tmp:
+        with src.open("rb") as fin, tmp.open("wb") as fout:
+            decompressor.copy_stream(fin, fout, read_size=CHUNK_SIZE)
+    return dst.stat().st_size
+
+
+def resolve_stored_file(path):
+    """Return the path a file is actually stored at, and whether it is compressed.
+
+    Returns (None, False) if neither the plain nor the compressed file exists.
+    """
+    if path.exists():
+        return path, False
+    compressed = compressed_path(path)
+    if compressed.exists():
+        return compressed, True
+    return None, False
@@ -18,6 +18,7 @@ from enum import Enum
 from pathlib import Path
 
 from opensafely.jobrunner import config
+from opensafely.jobrunner.lib.lru_dict import LRUDict
 
 
 log = logging.getLogger(__name__)
@@ -25,6 +26,23 @@ log = logging.getLogger(__name__)
 CONNECTION_CACHE = threading.local()
 TABLES = {}
 MIGRATIONS = {}
+# Precomputed field conversions, by dataclass. See `get_codec()`.
+CODECS = {}
+# The same conversions, by dataclass field
+FIELD_CONVERTERS = {}
+# Generated SQL, keyed by the shape of the query that produced it. The values
+# used in queries are always passed as parameters, so the same statement can be
+# reused for any query with the same operation, table and parameter names.
+SQL_CACHE = LRUDict(1000)
+SQL_CACHE_LOCK = threading.Lock()
+# The number of rows to read from the database at a time when iterating
+FETCH_SIZE = 500
+# Instances read from or written to the database keep the encoded values of
+# their fields as of then under this attribute. See `update()`.
+SAVED_VALUES = "_saved_values"
+# The number of writes made through this module. See `data_version()`.
+LOCAL_WRITES = 0
+LOCAL_WRITES_LOCK = threading.Lock()
 
 
 def databaseclass(cls):
@@ -34,6 +52,10 @@ def databaseclass(cls):
     fields = {f.name for f in dataclasses.fields(dc)}
     assert "id" in fields, "must have primary key 'id'"
     TABLES[dc.__tablename__] = dc
+    for field in dataclasses.fields(dc):
+        if field.type in (list, dict):
+            setattr(dc, field.name, LazyJSONField(field.name, field.default))
+    CODECS[dc] = Codec(dc, lazy_json=True)
     return dc
 
 
@@ -43,6 +65,20 @@ def migration(version, sql):
     MIGRATIONS[version] = sql
 
 
+def cached_sql(key, generate):
+    """
+    Return the SQL for `key` from the cache, calling `generate()` to create it
+    if it's not there
+    """
+    with SQL_CACHE_LOCK:
+        sql = SQL_CACHE.get(key)
+    if sql is None:
+        sql = generate()
+        with SQL_CACHE_LOCK:
+            SQL_CACHE[key] = sql
+    return sql
+
+
 def generate_insert_sql(item):
     table = item.__tablename__
     fields = dataclasses.fields(item)
@@ -52,59 +88,213 @@ def generate_insert_sql(item):
     return sql, fields
 
 
+def get_insert_sql(itemclass):
+    return cached_sql(("insert", itemclass), lambda: generate_insert_sql(itemclass))
+
+
 def insert(item):
-    sql, fields = generate_insert_sql(item)
+    sql, fields = get_insert_sql(item.__class__)
+    values = encode_field_values(fields, item)
+
+    get_connection().execute(sql, values)
+    record_write()
+    mark_saved(item, fields, values)
 
-    get_connection().execute(sql, encode_field_values(fields, item))
+
+def insert_many(items):
+    """
+    Insert several items of the same class using a single prepared statement
+
+    Callers wanting the inserts to be atomic should wrap this in a
+    `transaction()`.
+    """
+    items = list(items)
+    if not items:
+        return
+    itemclass = items[0].__class__
+    assert all(item.__class__ is itemclass for item in items)
+    sql, fields = get_insert_sql(itemclass)
+    values = [encode_field_values(fields, item) for item in items]
+
+    get_connection().executemany(sql, values)
+    record_write()
+    for item, item_values in zip(items, values):
+        mark_saved(item, fields, item_values)
 
 
 def upsert(item):
     assert item.id
-    insert_sql, fields = generate_insert_sql(item)
 
-    updates = ", ".join(f"{escape(field.name)} = ?" for field in fields)
-    # Note: technically we update the id on conflict with this approach, which
-    # is unnecessary, but it does not hurt and simplifies updates and params
-    # parts of the query.
-    sql = f"""
-        {insert_sql}
-        ON CONFLICT(id) DO UPDATE SET {updates}
-    """
+    def generate():
+        insert_sql, fields = generate_insert_sql(item.__class__)
+        updates = ", ".join(f"{escape(field.name)} = ?" for field in fields)
+        # Note: technically we update the id on conflict with this approach,
+        # which is unnecessary, but it does not hurt and simplifies updates and
+        # params parts of the query.
+        sql = f"""
+            {insert_sql}
+            ON CONFLICT(id) DO UPDATE SET {updates}
+        """
+        return sql, fields
+
+    sql, fields = cached_sql(("upsert", item.__class__), generate)
     params = encode_field_values(fields, item)
     # pass params twice, once for INSERT and once for UPDATE
     get_connection().execute(sql, params + params)
+    record_write()
+    mark_saved(item, fields, params)
 
 
 def update(item, exclude_fields=None):
+    """
+    Write the fields of `item` to the database, apart from `exclude_fields`
+
+    If `item` was read from or written to the database, only the fields which
+    have changed since then are written, and nothing is written if none have.
+    """
     assert item.id
     exclude_fields = exclude_fields or []
-    update_fields = [
-        f.name for f in dataclasses.fields(item) if f.name not in exclude_fields
-    ]
-    update_dict = {f: getattr(item, f) for f in update_fields}
-    update_where(item.__class__, update_dict, id=item.id)
+    fields = [f for f in dataclasses.fields(item) if f.name not in exclude_fields]
+    values = encode_field_values(fields, item)
+    saved = item.__dict__.get(SAVED_VALUES)
+    if saved is not None:
+        # Fields which weren't read in the first place (see `find_where`'s
+        # `columns`) are never written
+        changed = [
+            (field, value)
+            for field, value in zip(fields, values)
+            if field.name in saved and saved[field.name] != value
+        ]
+        if not changed:
+            return
+        fields = [field for field, _ in changed]
+        values = [value for _, value in changed]
+    write_fields(item.__class__, fields, values, {"id": item.id})
+    mark_saved(item, fields, values)
 
 
 def update_where(itemclass, update_dict, **query_params):
-    table = itemclass.__tablename__
     fields = [f for f in dataclasses.fields(itemclass) if f.name in update_dict]
     assert len(fields) == len(update_dict)
-    updates = ", ".join(f"{escape(field.name)} = ?" for field in fields)
-    update_params = encode_field_values(fields, update_dict)
-    where, where_params = query_params_to_sql(query_params)
-    get_connection().execute(
-        f"UPDATE {escape(table)} SET {updates} WHERE {where}",
-        update_params + where_params,
+    write_fields(
+        itemclass, fields, encode_field_values(fields, update_dict), query_params
     )
 
 
-def find_where(itemclass, **query_params):
-    table = itemclass.__tablename__
-    fields = dataclasses.fields(itemclass)
+def write_fields(itemclass, fields, values, query_params):
+    """Set the given fields to their encoded `values` where `query_params` match"""
+    where, where_params = query_params_to_sql(query_params)
+    names = tuple(field.name for field in fields)
+
+    def generate():
+        table = itemclass.__tablename__
+        updates = ", ".join(f"{escape(name)} = ?" for name in names)
+        return f"UPDATE {escape(table)} SET {updates} WHERE {where}"
+
+    sql = cached_sql(("update", itemclass, names, where), generate)
+    get_connection().execute(sql, values + where_params)
+    record_write()
+
+
+def mark_saved(item, fields, values):
+    """
+    Record that the given fields of `item` match their encoded `values` in the
+    database, so `update()` can tell which fields have changed since
+    """
+    saved = item.__dict__.get(SAVED_VALUES, {})
+    # Replace rather than modify, as copies of the item share the dict
+    item.__dict__[SAVED_VALUES] = {
+        **saved,
+        **{field.name: value for field, value in zip(fields, values)},
+    }
+
+
+def rebuild(item):
+    """
+    Return a new instance built from the values `item` was read from the
+    database with, which shares none of its decoded JSON values
+
+    `item` must have been read with all its columns.
+    """
+    codec = get_codec(item.__class__)
+    saved = item.__dict__[SAVED_VALUES]
+    return codec.row_decoder()([saved[field.name] for field in codec.fields])
+
+
+def find_where(itemclass, columns=None, **query_params):
+    """
+    Return a list of `itemclass` instances matching `query_params`
+
+    If `columns` is given, only those columns are fetched and the remaining
+    fields are left with their default values. This is for callers which only
+    need a few fields, and the instances shouldn't be written back.
+    """
+    return list(iter_where(itemclass, columns, **query_params))
+
+
+def iter_where(itemclass, columns=None, **query_params):
+    """
+    Like `find_where`, but yield the instances as they are read from the
+    database rather than reading them all into memory first
+
+    The query runs when iteration starts. Callers shouldn't write to the table
+    they're iterating over until they've finished.
+    """
+    codec = get_codec(itemclass)
+    if columns is not None:
+        columns = tuple(columns)
+        assert all(column in codec.decoders for column in columns), columns
     where, params = query_params_to_sql(query_params)
-    sql = f"SELECT * FROM {escape(table)} WHERE {where}"
-    cursor = get_connection().execute(sql, params)
-    return [itemclass(*decode_field_values(fields, row)) for row in cursor]
+
+    def generate():
+        if columns is None:
+            select = codec.columns
+        else:
+            select = ", ".join(escape(column) for column in columns)
+        return f"SELECT {select} FROM {escape(itemclass.__tablename__)} WHERE {where}"
+
+    sql = cached_sql(("find", itemclass, columns, where), generate)
+    decode_row = codec.row_decoder(columns)
+    for row in iter_rows(sql, params):
+        yield decode_row(row)
+
+
+def find_latest_where(itemclass, partition_by, order_by, **query_params):
+    """
+    Return the item with the greatest `order_by` value for each distinct value
+    of `partition_by`, amongst those matching `query_params`
+
+    Ties are broken in favour of the earliest inserted item.
+    """
+    return list(iter_latest_where(itemclass, partition_by, order_by, **query_params))
+
+
+def iter_latest_where(itemclass, partition_by, order_by, **query_params):
+    """
+    Like `find_latest_where`, but yield the items in order of `partition_by`
+    as they are read
+    """
+    codec = get_codec(itemclass)
+    where, params = query_params_to_sql(query_params)
+
+    def generate():
+        table = escape(itemclass.__tablename__)
+        return f"""
+            SELECT {codec.columns} FROM (
+                SELECT {codec.columns}, ROW_NUMBER() OVER (
+                    PARTITION BY {escape(partition_by)}
+                    ORDER BY {escape(order_by)} DESC, rowid
+                ) AS _row_number
+                FROM {table} WHERE {where}
+            )
+            WHERE _row_number = 1
+            ORDER BY {escape(partition_by)}
+        """
+
+    sql = cached_sql(("latest", itemclass, partition_by, order_by, where), generate)
+    decode_row = codec.row_decoder()
+    for row in iter_rows(sql, params):
+        yield decode_row(row)
 
 
 def find_all(itemclass):  # pragma: nocover
@@ -125,29 +315,103 @@ def find_one(itemclass, **query_params):
 
 
 def exists_where(itemclass, **query_params):
-    table = itemclass.__tablename__
     where, params = query_params_to_sql(query_params)
-    sql = f"SELECT EXISTS (SELECT 1 FROM {escape(table)} WHERE {where})"
+    sql = cached_sql(
+        ("exists", itemclass, where),
+        lambda: (
+            f"SELECT EXISTS (SELECT 1 FROM {escape(itemclass.__tablename__)} WHERE {where})"
+        ),
+    )
     cursor = get_connection().execute(sql, params)
     return bool(cursor.fetchone()[0])
 
 
 def count_where(itemclass, **query_params):
-    table = itemclass.__tablename__
     where, params = query_params_to_sql(query_params)
-    sql = f"SELECT COUNT(*) FROM {escape(table)} WHERE {where}"
+    sql = cached_sql(
+        ("count", itemclass, where),
+        lambda: f"SELECT COUNT(*) FROM {escape(itemclass.__tablename__)} WHERE {where}",
+    )
     cursor = get_connection().execute(sql, params)
     return cursor.fetchone()[0]
 
 
 def select_values(itemclass, column, **query_params):
-    table = itemclass.__tablename__
+    return list(iter_values(itemclass, column, **query_params))
+
+
+def iter_values(itemclass, column, **query_params):
+    """Like `select_values`, but yield the values as they are read"""
     fields = [f for f in dataclasses.fields(itemclass) if f.name == column]
     assert fields
     where, params = query_params_to_sql(query_params)
-    sql = f"SELECT {escape(column)} FROM {escape(table)} WHERE {where}"
+    sql = cached_sql(
+        ("select", itemclass, column, where),
+        lambda: (
+            f"SELECT {escape(column)} FROM {escape(itemclass.__tablename__)} WHERE {where}"
+        ),
+    )
+    decode = get_codec(itemclass).decoders[column]
+    for (value,) in iter_rows(sql, params):
+        if decode is None or value is None:
+            yield value
+        else:
+            yield decode(value)
+
+
+def iter_rows(sql, params):
+    """Yield the rows returned by `sql`, fetching FETCH_SIZE rows at a time"""
     cursor = get_connection().execute(sql, params)
-    return [decode_field_values(fields, row)[0] for row in cursor]
+    try:
+        while rows := cursor.fetchmany(FETCH_SIZE):
+            yield from rows
+    finally:
+        # Release the statement promptly if the caller stops iterating early
+        cursor.close()
+
+
+def record_write():
+    global LOCAL_WRITES
+    with LOCAL_WRITES_LOCK:
+        LOCAL_WRITES += 1
+
+
+def data_version(filename=None):
+    """
+    Return a value which changes whenever the database might have changed
+
+    SQLite's data_version changes whenever another connection commits a write,
+    but not for writes made on the connection itself, so we also count the
+    writes made through this module. Writes made by executing SQL directly on
+    this thread's connection aren't noticed.
+    """
+    filename = filename_or_get_default(filename)
+    conn = get_connection(filename)
+    version = conn.execute("PRAGMA data_version").fetchone()[0]
+    # data_version values are only comparable for the same connection
+    return filename, id(conn), version, LOCAL_WRITES
+
+
+class VersionedCache:
+    """
+    Caches the result of calling `fetch()` until the database might have
+    changed, as given by `data_version()`
+    """
+
+    def __init__(self, fetch):
+        self.fetch = fetch
+        self.clear()
+
+    def get(self):
+        version = data_version()
+        cached_version, value = self._cached
+        if version != cached_version:
+            value = self.fetch()
+            self._cached = version, value
+        return value
+
+    def clear(self):
+        self._cached = None, None
 
 
 def transaction():
@@ -178,7 +442,7 @@ def get_connection(filename=None):
     # Looks icky but is documented `threading.local` usage
     cache = CONNECTION_CACHE.__dict__
     if filename not in cache:
-        conn = sqlite3.connect(filename, uri=True)
+        conn = sqlite3.connect(filename, uri=True, timeout=config.DATABASE_BUSY_TIMEOUT)
         # Enable autocommit so changes made outside of a transaction still get
         # persisted to disk. We can use explicit transactions when we need
         # atomicity.
@@ -192,10 +456,40 @@ def get_connection(filename=None):
         # some other process to write the db (e.g. a backfill), then we should
         # stop job-runner.
         conn.execute("PRAGMA journal_mode=WAL")
+        for name, value in get_connection_pragmas().items():
+            conn.execute(f"PRAGMA {name}={value}")
 
     return cache[filename]
 
 
+# PRAGMAs applied to every connection, by config.DATABASE_PROFILE
+CONNECTION_PROFILES = {
+    # Every commit is synced to disk before it returns, so nothing is lost even
+    # on power failure
+    "durable": {
+        "synchronous": "FULL",
+        # negative sizes are in KiB
+        "cache_size": -16000,
+        "temp_store": "MEMORY",
+        "mmap_size": 0,
+    },
+    # Commits are only synced to disk at WAL checkpoints. A power failure can
+    # lose the most recent commits, but can't corrupt the database.
+    "fast": {
+        "synchronous": "NORMAL",
+        "cache_size": -64000,
+        "temp_store": "MEMORY",
+        "mmap_size": 256 * 1024 * 1024,
+    },
+}
+
+
+def get_connection_pragmas():
+    pragmas = dict(CONNECTION_PROFILES[config.DATABASE_PROFILE])
+    pragmas.update(config.DATABASE_PRAGMAS)
+    return pragmas
+
+
 class MigrationNeeded(Exception):
     pass
 
@@ -299,33 +593,49 @@ def query_params_to_sql(params):
     """
     Turn a dict of query parameters into a pair of (SQL string, SQL values).
     All parameters are implicitly ANDed together, and there's a bit of magic to
-    handle `field__in=list_of_values` queries, LIKE queries and Enum classes.
+    handle `field__in=list_of_values` queries, LIKE queries, `field__gte=value`
+    queries and Enum classes.
     """
     if not params:
         return "1 = 1", []
 
-    parts = []
     values = []
-
+    # The SQL only depends on the parameter names and the number of values in
+    # any `__in` lists
+    shape = []
     for key, value in params.items():
         if key.endswith("__in"):
-            field = key[:-4]
-            placeholders = ", ".join(["?"] * len(value))
-            parts.append(f"{escape(field)} IN ({placeholders})")
             values.extend(value)
-        elif key.endswith("__like"):
-            field = key[:-6]
-            parts.append(f"{escape(field)} LIKE ?")
-            values.append(value)
+            shape.append((key, len(value)))
         else:
-            parts.append(f"{escape(key)} = ?")
             values.append(value)
+            shape.append((key, None))
+
+    where = cached_sql(("where", tuple(shape)), lambda: generate_where_sql(shape))
 
     # Bit of a hack: convert any Enum instances to their values so we can use
     # them in querying
     values = [v.value if isinstance(v, Enum) else v for v in values]
 
-    return " AND ".join(parts), values
+    return where, values
+
+
+def generate_where_sql(shape):
+    parts = []
+    for key, length in shape:
+        if key.endswith("__in"):
+            field = key[:-4]
+            placeholders = ", ".join(["?"] * length)
+            parts.append(f"{escape(field)} IN ({placeholders})")
+        elif key.endswith("__like"):
+            field = key[:-6]
+            parts.append(f"{escape(field)} LIKE ?")
+        elif key.endswith("__gte"):
+            field = key[:-5]
+            parts.append(f"{escape(field)} >= ?")
+        else:
+            parts.append(f"{escape(key)} = ?")
+    return " AND ".join(parts)
 
 
 def escape(s):
@@ -336,38 +646,154 @@ def escape(s):
     return '"{}"'.format(s.replace('"', '""'))
 
 
+def get_codec(itemclass):
+    # databaseclasses have their codecs built when they're defined, but this
+    # also lets us work with plain dataclasses
+    if itemclass not in CODECS:
+        CODECS[itemclass] = Codec(itemclass)
+    return CODECS[itemclass]
+
+
+class Codec:
+    """
+    Conversions between a dataclass's field values and the values we store in
+    SQLite, worked out once per class rather than for every value
+
+    Decoders are None for fields which are stored as-is.
+    """
+
+    def __init__(self, itemclass, lazy_json=False):
+        self.itemclass = itemclass
+        self.fields = dataclasses.fields(itemclass)
+        self.columns = ", ".join(escape(field.name) for field in self.fields)
+        self.decoders = {
+            field.name: get_field_converters(field)[1] for field in self.fields
+        }
+        # The decoders used when building instances from rows. With lazy_json
+        # the class must have a LazyJSONField for each JSON field, which will
+        # decode them on first access.
+        self.row_decoders = dict(self.decoders)
+        if lazy_json:
+            for field in self.fields:
+                if field.type in (list, dict):
+                    self.row_decoders[field.name] = EncodedJSON
+        self._row_decoder_cache = {}
+
+    def row_decoder(self, columns=None):
+        """
+        Return a function which builds an instance from a row containing
+        `columns`, or all the fields in order if `columns` is None
+        """
+        if columns not in self._row_decoder_cache:
+            self._row_decoder_cache[columns] = self._make_row_decoder(columns)
+        return self._row_decoder_cache[columns]
+
+    def _make_row_decoder(self, columns):
+        names = columns or [field.name for field in self.fields]
+        decoders = [
+            (i, self.row_decoders[name])
+            for i, name in enumerate(names)
+            if self.row_decoders[name] is not None
+        ]
+        itemclass = self.itemclass
+
+        def decode_row(row):
+            values = list(row)
+            saved = dict(zip(names, values))
+            for i, decoder in decoders:
+                if values[i] is not None:
+                    values[i] = decoder(values[i])
+            if columns is None:
+                item = itemclass(*values)
+            else:
+                item = itemclass(**dict(zip(columns, values)))
+            item.__dict__[SAVED_VALUES] = saved
+            return item
+
+        return decode_row
+
+
+class EncodedJSON(str):
+    """A JSON value read from the database which hasn't been decoded yet"""
+
+
+class LazyJSONField:
+    """
+    Descriptor for the JSON fields of databaseclasses
+
+    Values read from the database are stored as EncodedJSON and only decoded
+    when the field is first accessed, as most callers never look at most of
+    them. Values which are never accessed are written back to the database as
+    they are.
+    """
+
+    def __init__(self, name, default):
+        self.name = name
+        self.default = default
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self.default
+        try:
+            value = obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+        if isinstance(value, EncodedJSON):
+            value = obj.__dict__[self.name] = json.loads(value)
+        return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
+def field_converters(field):
+    # Dicts and lists get encoded as JSON
+    if field.type in (list, dict):
+        return encode_json, json.loads
+    # Enums get encoded as their string/int values
+    if issubclass(field.type, Enum):
+        return enum_value, field.type
+    return None, None
+
+
+def encode_json(value):
+    if isinstance(value, EncodedJSON):
+        return str(value)
+    return json.dumps(value)
+
+
+def enum_value(value):
+    return value.value
+
+
+def get_field_converters(field):
+    """Return the (encoder, decoder) pair for a dataclass field"""
+    if field not in FIELD_CONVERTERS:
+        FIELD_CONVERTERS[field] = field_converters(field)
+    return FIELD_CONVERTERS[field]
+
+
 def encode_field_values(fields, item):
     """
     Takes a list of dataclass fields and a dataclass instance or dict and
     returns the field values as a list with the appropriate conversions applied
     """
     values = []
-    get_value = getattr if not isinstance(item, dict) else dict.__getitem__
+    get_value = get_raw_value if not isinstance(item, dict) else dict.__getitem__
     for field in fields:
         value = get_value(item, field.name)
-        # Dicts and lists get encoded as JSON
-        if field.type in (list, dict) and value is not None:
-            value = json.dumps(value)
-        # Enums get encoded as their string/int values
-        elif issubclass(field.type, Enum) and value is not None:
-            value = value.value
+        if value is not None:
+            encoder = get_field_converters(field)[0]
+            if encoder is not None:
+                value = encoder(value)
         values.append(value)
     return values
 
 
-def decode_field_values(fields, row):
-    """
-    Takes a list of dataclass fields and a SQLite row (or any dict-like) and
-    returns field values as a list with the appropriate conversions applied
-    """
-    values = []
-    for field in fields:
-        value = row[field.name]
-        # Dicts and lists get decoded from JSON
-        if field.type in (list, dict) and value is not None:
-            value = json.loads(value)
-        # Enums get transformed back from their string/int values
-        elif issubclass(field.type, Enum) and value is not None:
-            value = field.type(value)
-        values.append(value)
-    return values
+def get_raw_value(item, name):
+    # Read straight from the instance where we can, so that JSON values which
+    # haven't been decoded don't need to be
+    try:
+        return item.__dict__[name]
+    except KeyError:
+        return getattr(item, name)
@@ -397,6 +397,67 @@ def container_inspect(name, key="", none_if_not_exists=False, timeout=None):
     return json.loads(response.stdout)
 
 
+def container_stats(timeout=DEFAULT_TIMEOUT, prefix=""):
+    """
+    Return the current resource usage of every running container whose name
+    starts with `prefix`, as a dict mapping container names to their usage
+
+    CPU usage is a percentage of one CPU, and memory and block I/O are in bytes.
+    Containers which are starting or stopping report "--" for their usage, and
+    are left out.
+
+    See: https://docs.docker.com/engine/reference/commandline/stats/
+    """
+    response = docker(
+        ["stats", "--no-stream", "--no-trunc", "--format", "{{json .}}"],
+        check=True,
+        capture_output=True,
+        text=True,
+        timeout=timeout,
+    )
+    stats = {}
+    for line in response.stdout.splitlines():
+        if not line.strip():
+            continue
+        row = json.loads(line)
+        if not row["Name"].startswith(prefix):
+            continue
+        block_read, _, block_write = row["BlockIO"].partition("/")
+        try:
+            stats[row["Name"]] = {
+                "cpu_percentage": float(row["CPUPerc"].rstrip("%")),
+                "memory_used": parse_size(row["MemUsage"].partition("/")[0]),
+                "block_read": parse_size(block_read),
+                "block_write": parse_size(block_write),
+            }
+        except ValueError:
+            logger.debug(f"Skipping unparseable stats for {row['Name']}: {row}")
+    return stats
+
+
+# Docker reports memory in binary units and I/O in decimal ones
+SIZE_UNITS = {
+    "b": 1,
+    "kb": 1000,
+    "mb": 1000**2,
+    "gb": 1000**3,
+    "tb": 1000**4,
+    "kib": 1024,
+    "mib": 1024**2,
+    "gib": 1024**3,
+    "tib": 1024**4,
+}
+
+
+def parse_size(size):
+    """Convert a size like "1.5MiB" to a number of bytes"""
+    match = re.fullmatch(r"\s*([\d.]+)\s*([a-zA-Z]*)\s*", size)
+    unit = (match.group(2).lower() or "b") if match else None
+    if unit not in SIZE_UNITS:
+        raise ValueError(f"Unrecognised size: '{size}'")
+    return int(float(match.group(1)) * SIZE_UNITS[unit])
+
+
 def run(
     name,
     args,
@@ -479,19 +540,6 @@ def kill(name):
             raise
 
 
-def write_logs_to_file(container_name, filename):
-    with open(filename, "wb") as f:
-        # the --tail 100000 acts as an upper bound for large log outputs. It
-        # ensures that streaming the logs via docker does not take too long and
-        # cause the command to timeout. Some logs is better than none.
-        docker(
-            ["container", "logs", "--timestamps", "--tail", "100000", container_name],
-            check=True,
-            stdout=f,
-            stderr=subprocess.STDOUT,
-        )
-
-
 def pull(image, quiet=False):
     try:
         docker(
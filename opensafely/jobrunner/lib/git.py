@@ -2,16 +2,23 @@
 Utility functions for interacting with git
 """
 
+import atexit
+import json
 import logging
 import os
 import subprocess
+import threading
 import time
+from collections import defaultdict
+from concurrent.futures import Future
+from contextlib import contextmanager
 from pathlib import Path, PurePath
 from urllib.parse import urlparse, urlunparse
 
 from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import atomic_writer
 from opensafely.jobrunner.lib.string_utils import project_name_from_url
-from opensafely.jobrunner.lib.subprocess_utils import subprocess_run
+from opensafely.jobrunner.lib.subprocess_utils import subprocess_run, to_str
 
 
 log = logging.getLogger(__name__)
@@ -30,6 +37,10 @@ NEVER_PROMPT_FOR_AUTH_ENV = dict(
 )
 
 
+# Name of the remote we configure for partial fetches, see `git_env`
+PROMISOR_REMOTE = "origin"
+
+
 class GitError(Exception):
     pass
 
@@ -52,6 +63,28 @@ def read_file_from_repo(repo_url, commit_sha, path):
     """
     repo_dir = get_local_repo_dir(repo_url)
     ensure_commit_fetched(repo_dir, repo_url, commit_sha)
+    # The batch protocol is line-based so can't express paths with newlines in
+    if "\n" in path:
+        return show_file(repo_dir, repo_url, commit_sha, path)
+    cat_file = get_cat_file_process(repo_dir, env=git_env(repo_url))
+    try:
+        object_type, contents = cat_file.read(f"{commit_sha}:{path}")
+        if object_type is None and cat_file.read(commit_sha)[0] is None:
+            raise GitError(f"Commit {commit_sha} not found")
+    except GitError:
+        log.exception(f"Error reading from {repo_url} @ {commit_sha}")
+        raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
+    if object_type is None:
+        raise GitFileNotFoundError(f"File '{path}' not found in repository")
+    if object_type != "blob":
+        # Leave `git show` to decide how to present anything else (e.g. trees)
+        return show_file(repo_dir, repo_url, commit_sha, path)
+    # Note the response here is bytes not text as git doesn't know what
+    # encoding the file is supposed to have
+    return contents
+
+
+def show_file(repo_dir, repo_url, commit_sha, path):
     try:
         response = subprocess_run(
             ["git", "show", f"{commit_sha}:{path}"],
@@ -65,40 +98,171 @@ def read_file_from_repo(repo_url, commit_sha, path):
         else:
             log.exception(f"Error reading from {repo_url} @ {commit_sha}")
             raise GitError(f"Error reading from {repo_url} @ {commit_sha}")
-    # Note the response here is bytes not text as git doesn't know what
-    # encoding the file is supposed to have
     return response.stdout
 
 
+class CatFileProcess:
+    """
+    A long-running `git cat-file --batch` process for reading objects from a
+    local repo, which saves spawning a new git process for every read.
+
+    Requests are serialised with a lock, so a single instance can be shared
+    between threads. If the process dies or gets out of step with us, we
+    restart it and retry once.
+    """
+
+    def __init__(self, repo_dir, env=None):
+        self.repo_dir = repo_dir
+        self.env = env
+        self.process = None
+        self.lock = threading.Lock()
+
+    def read(self, object_name):
+        """
+        Return (type, contents) for the named object, or (None, None) if it
+        doesn't exist
+        """
+        with self.lock:
+            try:
+                return self._read(object_name)
+            except (OSError, ValueError, GitError):
+                log.warning(f"Restarting git cat-file process for {self.repo_dir}")
+                self._close()
+            try:
+                return self._read(object_name)
+            except (OSError, ValueError) as e:
+                self._close()
+                raise GitError(f"Error reading from {self.repo_dir}: {e}")
+            except GitError:
+                self._close()
+                raise
+
+    def close(self):
+        with self.lock:
+            self._close()
+
+    def _read(self, object_name):
+        if self.process is None or self.process.poll() is not None:
+            self.process = subprocess.Popen(
+                ["git", "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                cwd=to_str(self.repo_dir),
+                env=self.env,
+            )
+        self.process.stdin.write(object_name.encode("utf-8") + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header.endswith(b"\n"):
+            raise GitError("Unexpected end of output from git cat-file")
+        # Missing objects are reported as "<object_name> missing"
+        if header.endswith((b" missing\n", b" ambiguous\n")):
+            return None, None
+        _, object_type, size = header.split()
+        size = int(size)
+        # contents are followed by a newline
+        contents = self.process.stdout.read(size + 1)
+        if len(contents) != size + 1:
+            raise GitError("Unexpected end of output from git cat-file")
+        return object_type.decode("ascii"), contents[:-1]
+
+    def _close(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=5)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill()
+            self.process.wait()
+        finally:
+            self.process.stdout.close()
+            self.process = None
+
+
+CAT_FILE_PROCESSES = {}
+CAT_FILE_PROCESSES_LOCK = threading.Lock()
+
+
+def get_cat_file_process(repo_dir, env=None):
+    with CAT_FILE_PROCESSES_LOCK:
+        if repo_dir not in CAT_FILE_PROCESSES:
+            CAT_FILE_PROCESSES[repo_dir] = CatFileProcess(repo_dir, env=env)
+        return CAT_FILE_PROCESSES[repo_dir]
+
+
+def close_cat_file_process(repo_dir):
+    with CAT_FILE_PROCESSES_LOCK:
+        process = CAT_FILE_PROCESSES.pop(repo_dir, None)
+    if process:
+        process.close()
+
+
+@atexit.register
+def close_cat_file_processes():
+    with CAT_FILE_PROCESSES_LOCK:
+        processes = list(CAT_FILE_PROCESSES.values())
+        CAT_FILE_PROCESSES.clear()
+    for process in processes:
+        process.close()
+
+
 def checkout_commit(repo_url, commit_sha, target_dir):
     """
     Checkout the contents of `repo_url` as of `commit_sha` into `target_dir`
+
+    Any paths in config.GIT_CHECKOUT_EXCLUDE are left out, which in partial
+    fetch mode means their contents are never downloaded at all.
     """
     repo_dir = get_local_repo_dir(repo_url)
     ensure_commit_fetched(repo_dir, repo_url, commit_sha)
     os.makedirs(target_dir, exist_ok=True)
-    subprocess_run(
-        [
-            "git",
-            f"--work-tree={target_dir}",
-            "checkout",
-            "--quiet",
-            "--force",
-            commit_sha,
-        ],
-        check=True,
-        # Set GIT_DIR rather than changing working directory so that
-        # `target_dir` gets correctly resolved
-        env=dict(os.environ, GIT_DIR=repo_dir),
-    )
+    pathspecs = []
+    if config.GIT_CHECKOUT_EXCLUDE:
+        pathspecs = ["--", "."] + [
+            f":(exclude){path}" for path in config.GIT_CHECKOUT_EXCLUDE
+        ]
+    # Checking out writes to the repo's index, so must be done under the lock
+    with repo_lock(repo_dir):
+        subprocess_run(
+            [
+                "git",
+                f"--work-tree={target_dir}",
+                "checkout",
+                "--quiet",
+                "--force",
+                commit_sha,
+                *pathspecs,
+            ],
+            check=True,
+            # Set GIT_DIR rather than changing working directory so that
+            # `target_dir` gets correctly resolved
+            env=dict(git_env(repo_url), GIT_DIR=repo_dir),
+        )
 
 
 def commit_reachable_from_ref(repo_url, commit_sha, ref):
     """
     Given a `ref` (branch name, tag, etc) on a remote repo, check whether the
     supplied commit is reachable from that ref.
+
+    Commits are immutable and refs (generally) only move forwards, so once a
+    commit is reachable we remember that indefinitely. Negative results are
+    only remembered for config.GIT_REACHABILITY_CACHE_TTL seconds.
     """
-    ref_sha = get_sha_from_remote_ref(repo_url, ref)
+    cache_key = f"reachable {repo_url} {commit_sha} {ref}"
+    reachable = ref_cache_get(cache_key, ttl=config.GIT_REACHABILITY_CACHE_TTL)
+    if reachable is None:
+        reachable = _commit_reachable_from_ref(repo_url, commit_sha, ref)
+        ref_cache_set(cache_key, reachable)
+    return reachable
+
+
+def _commit_reachable_from_ref(repo_url, commit_sha, ref):
+    # We always want the current position of the ref here, otherwise a commit
+    # pushed since we last looked would be wrongly reported as unreachable
+    ref_sha = get_sha_from_remote_ref(repo_url, ref, use_cache=False)
     # The easy case and the case I expect to be hit almost every time as the UI
     # currently only supports running against the branch head
     if commit_sha == ref_sha:
@@ -109,22 +273,26 @@ def commit_reachable_from_ref(repo_url, commit_sha, ref):
     # commits on the assumption that it's probably one of those. If that fails
     # we fetch the entire branch history.
     repo_dir = get_local_repo_dir(repo_url)
-    ensure_git_init(repo_dir)
-    fetch_commit(repo_dir, repo_url, ref_sha, depth=10)
-    if commit_is_ancestor(repo_dir, commit_sha, ref_sha):
-        return True
-    # The below is a git magic number meaning "infinite depth". See:
-    # https://git-scm.com/docs/shallow
-    fetch_commit(repo_dir, repo_url, ref_sha, depth=2147483647)
-    return commit_is_ancestor(repo_dir, commit_sha, ref_sha)
-
-
-def get_sha_from_remote_ref(repo_url, ref):
+    with repo_lock(repo_dir):
+        ensure_git_init(repo_dir)
+        fetch_commit(repo_dir, repo_url, ref_sha, depth=10)
+        if commit_is_ancestor(repo_dir, commit_sha, ref_sha):
+            return True
+        # The below is a git magic number meaning "infinite depth". See:
+        # https://git-scm.com/docs/shallow
+        fetch_commit(repo_dir, repo_url, ref_sha, depth=2147483647)
+        return commit_is_ancestor(repo_dir, commit_sha, ref_sha)
+
+
+def get_sha_from_remote_ref(repo_url, ref, use_cache=True):
     """Gets the SHA of the commit associated with the ref at the repo URL.
 
+    Results are cached for config.GIT_REF_CACHE_TTL seconds.
+
     Args:
         repo_url: A repo URL.
         ref: A ref, such as a branch name, tag name, etc.
+        use_cache: Whether a previously cached result can be used.
 
     Returns:
         The SHA of the commit. For example, if the ref is an annotated tag, then the SHA
@@ -134,6 +302,11 @@ def get_sha_from_remote_ref(repo_url, ref):
         GitRepoNotReachableError: We couldn't read from the remote repo
         GitUnknownRefError: We couldn't find the specified ref in the remote repo
     """
+    cache_key = f"ref {repo_url} {ref}"
+    if use_cache:
+        sha = ref_cache_get(cache_key, ttl=config.GIT_REF_CACHE_TTL)
+        if sha is not None:
+            return sha
     # If `ref` matches an annotated tag, then `deref_ref` will match the associated
     # commit.
     deref_ref = f"{ref}^{{}}"
@@ -166,10 +339,84 @@ def get_sha_from_remote_ref(repo_url, ref):
         f"refs/tags/{ref}",  # Lightweight tag
     ]:
         if target_ref in results:
+            ref_cache_set(cache_key, results[target_ref])
             return results[target_ref]
     raise GitUnknownRefError(f"Could not find ref '{ref}' in {repo_url}")
 
 
+# Cache of remote ref lookups and reachability checks, persisted as a JSON
+# file alongside the local repos so it survives restarts. Maps keys to
+# `[value, timestamp]` pairs.
+REF_CACHE_FILE = "ref-cache.json"
+# The most entries we keep in the ref cache, dropping the oldest beyond that
+REF_CACHE_MAX_ENTRIES = 10000
+REF_CACHES = {}
+REF_CACHE_LOCK = threading.Lock()
+
+
+def _load_ref_cache():
+    path = config.GIT_REPO_DIR / REF_CACHE_FILE
+    if path not in REF_CACHES:
+        try:
+            REF_CACHES[path] = json.loads(path.read_text())
+        except (OSError, ValueError):
+            REF_CACHES[path] = {}
+    return path, REF_CACHES[path]
+
+
+def ref_cache_get(key, ttl):
+    """
+    Return the cached value for `key`, or None if there isn't one
+
+    Values older than `ttl` seconds are ignored, except for True which (in our
+    usage) never expires.
+    """
+    with REF_CACHE_LOCK:
+        _, cache = _load_ref_cache()
+        entry = cache.get(key)
+    if entry is None:
+        return None
+    value, timestamp = entry
+    if value is not True and time.time() - timestamp > ttl:
+        return None
+    return value
+
+
+def ref_cache_set(key, value):
+    with REF_CACHE_LOCK:
+        path, cache = _load_ref_cache()
+        cache[key] = [value, time.time()]
+        _prune_ref_cache(cache)
+        try:
+            with atomic_writer(path) as tmp:
+                tmp.write_text(json.dumps(cache))
+        except OSError:
+            # It's only a cache, we can carry on without persisting it
+            log.exception(f"Error writing {path}")
+
+
+def _prune_ref_cache(cache):
+    """
+    Remove entries which have expired, and then the oldest entries if there are
+    still more than REF_CACHE_MAX_ENTRIES
+    """
+    cutoff = time.time() - max(
+        config.GIT_REF_CACHE_TTL, config.GIT_REACHABILITY_CACHE_TTL
+    )
+    expired = [
+        key
+        for key, (value, timestamp) in cache.items()
+        if value is not True and timestamp < cutoff
+    ]
+    for key in expired:
+        del cache[key]
+    excess = len(cache) - REF_CACHE_MAX_ENTRIES
+    if excess > 0:
+        oldest = sorted(cache, key=lambda key: cache[key][1])[:excess]
+        for key in oldest:
+            del cache[key]
+
+
 def _parse_ls_remote_output(output):
     lines = [line.split() for line in output.splitlines()]
     return {line[1]: line[0] for line in lines}
@@ -186,18 +433,97 @@ def get_local_repo_dir(repo_url):
     return config.GIT_REPO_DIR / Path(repo_name).with_suffix(".git")
 
 
+# Operations which modify a local repo (fetching, tagging, checking out) are
+# serialised per repo dir. Different repos can be worked on concurrently.
+REPO_LOCKS = defaultdict(threading.RLock)
+REPO_LOCKS_LOCK = threading.Lock()
+
+# Fetches currently in progress, by (repo_dir, commit_sha), so that concurrent
+# requests for the same commit share a single fetch
+IN_PROGRESS_FETCHES = {}
+IN_PROGRESS_FETCHES_LOCK = threading.Lock()
+
+
+@contextmanager
+def repo_lock(repo_dir):
+    with REPO_LOCKS_LOCK:
+        lock = REPO_LOCKS[repo_dir]
+    with lock:
+        yield
+
+
+# When each commit in each repo dir was last asked for, so that maintenance
+# doesn't prune commits which are about to be read or checked out but which no
+# job refers to yet (see `get_recently_used_commits`)
+COMMITS_LAST_USED = defaultdict(dict)
+
+
 def ensure_commit_fetched(repo_dir, repo_url, commit_sha):
-    ensure_git_init(repo_dir)
-    # It's safe to keep re-fetching the same commit, but it requires
-    # talking to the remote repo every time so it's better to avoid it if
-    # we can
-    if not commit_already_fetched(repo_dir, commit_sha):
-        fetch_commit(repo_dir, repo_url, commit_sha)
+    # This must happen before the check below so that maintenance, which
+    # forgets FETCHED_COMMITS before looking at this, can't miss it
+    COMMITS_LAST_USED[repo_dir][commit_sha] = time.time()
+    # Avoid taking any locks at all in the common case
+    if commit_sha in FETCHED_COMMITS.get(repo_dir, ()):
+        return
+
+    key = (repo_dir, commit_sha)
+    with IN_PROGRESS_FETCHES_LOCK:
+        fetch = IN_PROGRESS_FETCHES.get(key)
+        if fetch is None:
+            fetch = IN_PROGRESS_FETCHES[key] = Future()
+            in_charge = True
+        else:
+            in_charge = False
+
+    if not in_charge:
+        # Wait for whoever is in charge, and share their success or failure
+        return fetch.result()
+
+    try:
+        with repo_lock(repo_dir):
+            ensure_git_init(repo_dir)
+            # It's safe to keep re-fetching the same commit, but it requires
+            # talking to the remote repo every time so it's better to avoid it if
+            # we can
+            if not commit_already_fetched(repo_dir, commit_sha):
+                fetch_commit(repo_dir, repo_url, commit_sha)
+    except Exception as e:
+        fetch.set_exception(e)
+        raise
+    else:
+        fetch.set_result(None)
+    finally:
+        with IN_PROGRESS_FETCHES_LOCK:
+            del IN_PROGRESS_FETCHES[key]
+
+
+def get_recently_used_commits(repo_dir, within):
+    """
+    Return the commits in `repo_dir` passed to `ensure_commit_fetched` in the
+    last `within` seconds, forgetting about any used before that
+    """
+    cutoff = time.time() - within
+    last_used = COMMITS_LAST_USED[repo_dir]
+    recent = set()
+    for commit_sha, timestamp in list(last_used.items()):
+        if timestamp >= cutoff:
+            recent.add(commit_sha)
+        else:
+            last_used.pop(commit_sha, None)
+    return recent
 
 
 def ensure_git_init(repo_dir):
     if not os.path.exists(repo_dir / "config"):
         subprocess_run(["git", "init", "--bare", "--quiet", repo_dir], check=True)
+        # Anything we knew about a previous repo at this path is now wrong
+        forget_fetched_commits(repo_dir)
+
+
+# Fully fetched commits in each repo dir, loaded from the sentinel tags on
+# first use (see `commit_already_fetched`)
+FETCHED_COMMITS = {}
+FETCHED_COMMITS_LOCK = threading.Lock()
 
 
 def commit_already_fetched(repo_dir, commit_sha):
@@ -213,23 +539,49 @@ def commit_already_fetched(repo_dir, commit_sha):
     passes but attempting to check out the commit will fail. To work around
     this we create a special "sentinel" tag for each commit to indicate that
     the entire fetch process has completed successfully.
+
+    The sentinel tags are read once per repo dir and then kept in memory, so
+    checking the same commits again doesn't need a subprocess.
     """
+    return commit_sha in get_fetched_commits(repo_dir)
+
+
+def get_fetched_commits(repo_dir):
+    with FETCHED_COMMITS_LOCK:
+        if repo_dir not in FETCHED_COMMITS:
+            FETCHED_COMMITS[repo_dir] = load_fetched_commits(repo_dir)
+        return FETCHED_COMMITS[repo_dir]
+
+
+def load_fetched_commits(repo_dir):
     response = subprocess_run(
         [
             "git",
-            "tag",
-            "--list",
-            SENTINEL_TAG_PREFIX + commit_sha,
-            "--points-at",
-            commit_sha,
-            "--format",
-            "exists",
+            "for-each-ref",
+            "--format=%(refname:strip=3) %(objectname)",
+            f"refs/tags/{SENTINEL_TAG_PREFIX}",
         ],
         check=True,
         capture_output=True,
+        text=True,
         cwd=repo_dir,
     )
-    return response.stdout.strip() == b"exists"
+    fetched = set()
+    for line in response.stdout.splitlines():
+        tagged_sha, _, target_sha = line.partition(" ")
+        # Only count tags which point at the commit they are named for
+        if tagged_sha == target_sha:
+            fetched.add(tagged_sha)
+    return fetched
+
+
+def forget_fetched_commits(repo_dir):
+    """
+    Drop the in-memory record of fetched commits for `repo_dir`, so that it
+    gets reloaded from the sentinel tags next time
+    """
+    with FETCHED_COMMITS_LOCK:
+        FETCHED_COMMITS.pop(repo_dir, None)
 
 
 def mark_commmit_as_fetched(repo_dir, commit_sha):
@@ -249,6 +601,9 @@ def mark_commmit_as_fetched(repo_dir, commit_sha):
         capture_output=True,
         cwd=repo_dir,
     )
+    with FETCHED_COMMITS_LOCK:
+        if repo_dir in FETCHED_COMMITS:
+            FETCHED_COMMITS[repo_dir].add(commit_sha)
 
 
 def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
@@ -264,7 +619,11 @@ def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
     max_retries = 5
     sleep = 4
     attempt = 1
-    authenticated_url = add_access_token_and_proxy(repo_url)
+    if config.GIT_PARTIAL_FETCH:
+        enable_partial_clone(repo_dir)
+        source = ["--filter=blob:none", PROMISOR_REMOTE]
+    else:
+        source = [add_access_token_and_proxy(repo_url)]
     while True:
         try:
             subprocess_run(
@@ -274,13 +633,13 @@ def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
                     "--force",
                     "--depth",
                     str(depth),
-                    authenticated_url,
+                    *source,
                     commit_sha,
                 ],
                 check=True,
                 capture_output=True,
                 cwd=repo_dir,
-                env=NEVER_PROMPT_FOR_AUTH_ENV,
+                env=git_env(repo_url),
             )
             mark_commmit_as_fetched(repo_dir, commit_sha)
             break
@@ -305,6 +664,38 @@ def fetch_commit(repo_dir, repo_url, commit_sha, depth=1):
                 raise GitError(f"Error fetching commit {commit_sha} from {repo_url}")
 
 
+def git_env(repo_url):
+    """
+    Return the environment for git commands which may need to talk to `repo_url`
+
+    In partial fetch mode, local repos have commits and trees but not file
+    contents, which git fetches on demand from a "promisor" remote. We
+    configure that remote in the environment rather than in the repo's config
+    file so that the access token in the URL never gets written to disk.
+    """
+    env = dict(NEVER_PROMPT_FOR_AUTH_ENV)
+    if config.GIT_PARTIAL_FETCH:
+        settings = {
+            f"remote.{PROMISOR_REMOTE}.url": add_access_token_and_proxy(repo_url),
+            f"remote.{PROMISOR_REMOTE}.promisor": "true",
+            f"remote.{PROMISOR_REMOTE}.partialclonefilter": "blob:none",
+        }
+        env["GIT_CONFIG_COUNT"] = str(len(settings))
+        for i, (key, value) in enumerate(settings.items()):
+            env[f"GIT_CONFIG_KEY_{i}"] = key
+            env[f"GIT_CONFIG_VALUE_{i}"] = value
+    return env
+
+
+def enable_partial_clone(repo_dir):
+    """Allow `repo_dir` to contain partially fetched commits"""
+    for key, value in [
+        ("core.repositoryformatversion", "1"),
+        ("extensions.partialClone", PROMISOR_REMOTE),
+    ]:
+        subprocess_run(["git", "config", key, value], check=True, cwd=repo_dir)
+
+
 def commit_is_ancestor(repo_dir, ancestor_sha, descendant_sha):
     response = subprocess_run(
         ["git", "merge-base", "--is-ancestor", ancestor_sha, descendant_sha],
@@ -0,0 +1,252 @@
+"""
+Capture the output of job containers to disk while they run.
+
+Rather than fetching all of a container's logs from Docker once it has
+finished, we stream `docker container logs --follow` into the job's log file
+from the moment the container starts. The amount of output we keep is bounded:
+we keep the head and the tail of the output, up to a total byte budget, with a
+marker in between recording how much was dropped.
+
+If the job-runner restarts while a job is running, the capture thread is lost.
+In that case we fall back to reading all the logs from Docker in one go when
+the job is finalized, but still streamed through the same byte budget.
+"""
+
+import collections
+import gzip
+import logging
+import secrets
+import shutil
+import subprocess
+import threading
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import atomic_writer, docker
+from opensafely.jobrunner.lib.subprocess_utils import to_str
+
+
+log = logging.getLogger(__name__)
+
+TRUNCATION_MARKER = "[... {dropped} bytes of log output truncated ...]\n"
+
+# how much we read from docker at a time
+CHUNK_SIZE = 64 * 1024
+
+# How long to wait for a capture to finish once the container has exited. The
+# `--follow` stream ends as soon as the container stops, so this is generous.
+CAPTURE_TIMEOUT = 60
+
+# currently running captures, by container name
+CAPTURES = {}
+
+
+class BoundedLogWriter:
+    """Write a stream of log output to a file, keeping at most `max_bytes`.
+
+    The first half of the budget is written straight to disk as it arrives.
+    After that, we keep a rolling window of the most recent output in memory,
+    which is written out after a truncation marker when the writer is closed.
+
+    Output goes to a temporary file which replaces `path` when the writer is
+    closed. Published copies of the log are hardlinks to `path`, so writing to
+    it in place would overwrite them if a job is re-run.
+    """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.head_budget = max_bytes // 2
+        self.tail_budget = max_bytes - self.head_budget
+        self.head_size = 0
+        self.head_ends_with_newline = True
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.dropped = 0
+        self.abandoned = False
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.tmp = path.with_suffix(path.suffix + f".{secrets.token_hex(8)}.tmp")
+        self.fp = self.tmp.open("wb")
+
+    def write(self, data):
+        if self.head_size < self.head_budget:
+            head = data[: self.head_budget - self.head_size]
+            self.fp.write(head)
+            self.head_size += len(head)
+            self.head_ends_with_newline = head.endswith(b"\n")
+            data = data[len(head) :]
+
+        if not data:
+            return
+
+        self.tail.append(data)
+        self.tail_size += len(data)
+        while self.tail_size > self.tail_budget:
+            excess = self.tail_size - self.tail_budget
+            first = self.tail[0]
+            if len(first) <= excess:
+                self.tail.popleft()
+                dropped = len(first)
+            else:
+                self.tail[0] = first[excess:]
+                dropped = excess
+            self.tail_size -= dropped
+            self.dropped += dropped
+
+    def abandon(self):
+        """Make sure nothing we've written ever replaces `path`."""
+        with self.lock:
+            self.abandoned = True
+
+    def close(self):
+        tail = b"".join(self.tail)
+        if self.dropped:
+            # don't start the tail with a partial line
+            newline = tail.find(b"\n")
+            if newline != -1:
+                self.dropped += newline + 1
+                tail = tail[newline + 1 :]
+            if not self.head_ends_with_newline:
+                self.fp.write(b"\n")
+            marker = TRUNCATION_MARKER.format(dropped=self.dropped)
+            self.fp.write(marker.encode("utf8"))
+        self.fp.write(tail)
+        self.fp.close()
+        with self.lock:
+            if self.abandoned:
+                self.tmp.unlink(missing_ok=True)
+            else:
+                self.tmp.replace(self.path)
+
+
+def logs_command(container_name, follow):
+    args = ["docker", "container", "logs", "--timestamps"]
+    if follow:
+        args.append("--follow")
+    args.append(container_name)
+    return [to_str(arg) for arg in args]
+
+
+def stream_logs(
+    container_name, writer, follow=False, process_callback=None, timeout=None
+):
+    """Stream the container's logs to `writer`.
+
+    If `timeout` seconds pass before docker finishes, it is killed and we raise
+    DockerTimeoutError. Returns True if docker exited successfully.
+    """
+    timer = None
+    try:
+        process = subprocess.Popen(
+            logs_command(container_name, follow),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+        )
+        if process_callback:
+            process_callback(process)
+        if timeout is not None:
+            timer = threading.Timer(timeout, process.kill)
+            timer.start()
+        with process:
+            for chunk in iter(lambda: process.stdout.read1(CHUNK_SIZE), b""):
+                writer.write(chunk)
+    finally:
+        if timer:
+            timer.cancel()
+        writer.close()
+    if timer and timer.finished.is_set() and process.returncode != 0:
+        raise docker.DockerTimeoutError(f"Timed out reading logs for {container_name}")
+    return process.returncode == 0
+
+
+class LogCapture:
+    """Background capture of a running container's logs."""
+
+    def __init__(self, container_name, path):
+        self.container_name = container_name
+        self.path = path
+        self.process = None
+        self.succeeded = False
+        self.writer = BoundedLogWriter(path, config.JOB_LOG_MAX_BYTES)
+        self.thread = threading.Thread(
+            target=self.run, name=f"logs-{container_name}", daemon=True
+        )
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        try:
+            self.succeeded = stream_logs(
+                self.container_name,
+                self.writer,
+                follow=True,
+                process_callback=self.set_process,
+            )
+        except Exception:
+            log.exception(f"Error capturing logs for {self.container_name}")
+
+    def set_process(self, process):
+        self.process = process
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.kill()
+        self.thread.join(timeout=CAPTURE_TIMEOUT)
+        if self.thread.is_alive():
+            # Leave the thread to finish in its own time, but make sure it
+            # can't later overwrite whatever we write to `path` instead
+            log.warning(f"Abandoning log capture for {self.container_name}")
+            self.writer.abandon()
+
+    def wait(self, timeout=CAPTURE_TIMEOUT):
+        """Wait for the capture to finish, returning True if it was successful."""
+        self.thread.join(timeout=timeout)
+        if self.thread.is_alive():
+            log.warning(f"Timed out waiting for logs from {self.container_name}")
+            self.stop()
+            return False
+        return self.succeeded
+
+
+def start_capture(container_name, path):
+    """Start capturing the logs of a just-started container to `path`."""
+    stop_capture(container_name)
+    capture = LogCapture(container_name, path)
+    CAPTURES[container_name] = capture
+    capture.start()
+    return capture
+
+
+def stop_capture(container_name):
+    capture = CAPTURES.pop(container_name, None)
+    if capture:
+        capture.stop()
+
+
+def collect_logs(container_name, path):
+    """Write the complete (bounded) logs of a finished container to `path`.
+
+    Uses the output of the background capture if there is one, otherwise reads
+    the logs from docker directly.
+    """
+    capture = CAPTURES.pop(container_name, None)
+    if capture and capture.wait():
+        if capture.path != path:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(capture.path, path)
+        return
+
+    writer = BoundedLogWriter(path, config.JOB_LOG_MAX_BYTES)
+    if not stream_logs(container_name, writer, timeout=docker.DEFAULT_TIMEOUT):
+        raise subprocess.CalledProcessError(
+            1, logs_command(container_name, follow=False)
+        )
+
+
+def write_compressed_copy(path):
+    """Write a gzipped archive copy of `path` alongside it."""
+    dst = path.with_name(path.name + ".gz")
+    with atomic_writer(dst) as tmp:
+        with path.open("rb") as fin, gzip.open(tmp, "wb") as fout:
+            shutil.copyfileobj(fin, fout)
+    return dst
@@ -0,0 +1,206 @@
+"""
+Recording the resource usage of running jobs into config.METRICS_FILE
+
+A background thread samples the CPU, memory and block I/O of every job
+container every config.STATS_POLL_INTERVAL seconds. Recent samples are kept as
+they are, which is what we need to tell how a running job is doing. Older ones
+are combined into one sample per config.METRICS_DOWNSAMPLE_INTERVAL seconds for
+each job, which is plenty for tuning worker counts and resource limits, and
+eventually deleted.
+
+The metrics database is separate from the main one so that sampling never
+competes with the run loop for its write lock.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import database, docker
+
+
+log = logging.getLogger(__name__)
+
+# How often (in seconds) to downsample and delete old samples
+COMPACT_INTERVAL = 60 * 60
+# Job containers are named by `executors.local.container_name`
+CONTAINER_PREFIX = "os-job-"
+
+# Each row covers `duration` seconds of a job's life, starting at `timestamp`.
+# Samples as taken have a `resolution` of 0, and downsampled ones have the
+# width of the interval they were combined over. CPU usage is a percentage of
+# one CPU, and memory and block I/O are in bytes.
+METRICS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS job_sample (
+        job_id TEXT,
+        resolution INT,
+        timestamp INT,
+        duration INT,
+        cpu_percentage REAL,
+        cpu_peak REAL,
+        memory_used INT,
+        block_read INT,
+        block_write INT,
+        PRIMARY KEY (job_id, resolution, timestamp)
+    ) WITHOUT ROWID;
+
+    CREATE INDEX IF NOT EXISTS idx_job_sample__timestamp
+        ON job_sample (resolution, timestamp);
+"""
+
+
+# Metrics files we've already created the schema in
+SCHEMA_CREATED = set()
+
+
+def get_connection():
+    """Return a connection to the metrics database, creating it if needed"""
+    conn = database.get_connection(config.METRICS_FILE)
+    # Creating the schema is idempotent, so it doesn't matter if two threads
+    # race to do it first
+    if config.METRICS_FILE not in SCHEMA_CREATED:
+        conn.executescript(METRICS_SCHEMA)
+        SCHEMA_CREATED.add(config.METRICS_FILE)
+    return conn
+
+
+def record_stats(timeout=None):
+    """Sample the resource usage of every running job, returning the number"""
+    if timeout is None:
+        timeout = config.STATS_POLL_INTERVAL
+    stats = docker.container_stats(timeout=timeout, prefix=CONTAINER_PREFIX)
+    timestamp = int(time.time())
+    duration = int(config.STATS_POLL_INTERVAL)
+    rows = [
+        (
+            name[len(CONTAINER_PREFIX) :],
+            timestamp,
+            duration,
+            usage["cpu_percentage"],
+            usage["cpu_percentage"],
+            usage["memory_used"],
+            usage["block_read"],
+            usage["block_write"],
+        )
+        for name, usage in stats.items()
+    ]
+    conn = get_connection()
+    with conn:
+        conn.executemany(
+            """
+            INSERT OR REPLACE INTO job_sample (
+                job_id, resolution, timestamp, duration, cpu_percentage,
+                cpu_peak, memory_used, block_read, block_write
+            ) VALUES (?, 0, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            rows,
+        )
+    return len(rows)
+
+
+def compact_stats(now=None):
+    """Downsample old samples and delete those past the retention period"""
+    if now is None:
+        now = int(time.time())
+    interval = config.METRICS_DOWNSAMPLE_INTERVAL
+    # Only downsample whole intervals, so that each is only combined once
+    cutoff = now - int(config.METRICS_DOWNSAMPLE_AFTER_DAYS * 24 * 60 * 60)
+    cutoff -= cutoff % interval
+    expired = now - int(config.METRICS_RETENTION_DAYS * 24 * 60 * 60)
+    conn = get_connection()
+    with conn:
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO job_sample (
+                job_id, resolution, timestamp, duration, cpu_percentage,
+                cpu_peak, memory_used, block_read, block_write
+            )
+            SELECT
+                job_id,
+                :interval,
+                timestamp - timestamp % :interval AS start,
+                SUM(duration),
+                SUM(cpu_percentage * duration) / SUM(duration),
+                MAX(cpu_peak),
+                MAX(memory_used),
+                MAX(block_read),
+                MAX(block_write)
+            FROM job_sample
+            WHERE resolution = 0 AND timestamp < :cutoff
+            GROUP BY job_id, start
+            """,
+            {"interval": interval, "cutoff": cutoff},
+        )
+        conn.execute(
+            "DELETE FROM job_sample WHERE resolution = 0 AND timestamp < ?",
+            [cutoff],
+        )
+        conn.execute("DELETE FROM job_sample WHERE timestamp < ?", [expired])
+
+
+def get_job_metrics(job_id):
+    """
+    Return a summary of a job's resource usage so far, or an empty dict if we
+    haven't sampled it
+    """
+    if not config.METRICS_FILE.exists():
+        return {}
+    conn = database.get_connection(config.METRICS_FILE)
+    try:
+        summary = conn.execute(
+            """
+            SELECT
+                SUM(duration) AS duration,
+                SUM(cpu_percentage * duration) / SUM(duration) AS cpu_mean,
+                MAX(cpu_peak) AS cpu_peak,
+                MAX(memory_used) AS mem_peak,
+                MAX(block_read) AS block_read,
+                MAX(block_write) AS block_write
+            FROM job_sample WHERE job_id = ?
+            """,
+            [job_id],
+        ).fetchone()
+        latest = conn.execute(
+            """
+            SELECT cpu_percentage AS cpu_sample, memory_used AS mem_sample
+            FROM job_sample WHERE job_id = ? AND resolution = 0
+            ORDER BY timestamp DESC LIMIT 1
+            """,
+            [job_id],
+        ).fetchone()
+    except sqlite3.OperationalError as e:
+        # The recording thread may not have created the table yet
+        if "no such table" in str(e):
+            return {}
+        raise
+    if summary["duration"] is None:
+        return {}
+    metrics = dict(summary)
+    if latest is not None:
+        metrics.update(latest)
+    return metrics
+
+
+def start_stats_thread(interval=None):
+    """Run `record_stats` every `interval` seconds in a background thread"""
+    if interval is None:
+        interval = config.STATS_POLL_INTERVAL
+
+    def loop():
+        last_compacted = None
+        while True:
+            start = time.monotonic()
+            try:
+                record_stats()
+                if last_compacted is None or start - last_compacted >= COMPACT_INTERVAL:
+                    compact_stats()
+                    last_compacted = start
+            except Exception:
+                log.exception("Error recording job stats")
+            time.sleep(max(interval - (time.monotonic() - start), 0))
+
+    thread = threading.Thread(target=loop, name="record-stats", daemon=True)
+    thread.start()
+    return thread
@@ -179,6 +179,9 @@ class Job:
         -- that it always stays relatively small even as the set of historical jobs
         -- grows.
         CREATE INDEX idx_job__state ON job (state) WHERE state NOT IN ('failed', 'succeeded');
+
+        -- Used to find the latest job for each action in a workspace
+        CREATE INDEX idx_job__workspace_action ON job (workspace, action, created_at);
     """
 
     migration(
@@ -203,6 +206,13 @@ class Job:
         """,
     )
 
+    migration(
+        4,
+        """
+        CREATE INDEX idx_job__workspace_action ON job (workspace, action, created_at);
+        """,
+    )
+
     id: str = None  # noqa: A003
     job_request_id: str = None
     state: State = None
@@ -267,9 +277,6 @@ class Job:
     # does the job require db access
     requires_db: bool = False
 
-    # used to cache the job_request json by the tracing code
-    _job_request = None
-
     def __post_init__(self):
         # Generate a Job ID based on the Job Request ID and action. This means
         # we will always generate the same set of job IDs from a given Job
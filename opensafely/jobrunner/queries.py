@@ -1,10 +1,16 @@
 import sqlite3
 import time
-from itertools import groupby
-from operator import attrgetter
 
-from opensafely.jobrunner.lib.database import find_all, find_one, find_where, upsert
-from opensafely.jobrunner.models import Flag, Job
+from opensafely.jobrunner.lib.database import (
+    VersionedCache,
+    find_all,
+    find_one,
+    find_where,
+    iter_latest_where,
+    rebuild,
+    upsert,
+)
+from opensafely.jobrunner.models import Flag, Job, State
 
 
 def calculate_workspace_state(workspace):
@@ -14,18 +20,41 @@ def calculate_workspace_state(workspace):
     '__error__'; these are dummy jobs created only to help us communicate failure states back to the job-server (see
     create_or_update_jobs.create_failed_job()).
     """
-    all_jobs = find_where(Job, workspace=workspace, cancelled=False)
-    latest_jobs = []
-    for action, jobs in group_by(all_jobs, attrgetter("action")):
-        if action == "__error__":
-            continue
-        ordered_jobs = sorted(jobs, key=attrgetter("created_at"), reverse=True)
-        latest_jobs.append(ordered_jobs[0])
-    return latest_jobs
+    return list(iter_workspace_state(workspace))
 
 
-def group_by(iterable, key):
-    return groupby(sorted(iterable, key=key), key=key)
+def iter_workspace_state(workspace, **query_params):
+    """
+    Like `calculate_workspace_state`, but yield the jobs in order of action as
+    they are read, optionally only for those matching `query_params`
+    """
+    latest_jobs = iter_latest_where(
+        Job,
+        "action",
+        "created_at",
+        workspace=workspace,
+        cancelled=False,
+        **query_params,
+    )
+    for job in latest_jobs:
+        if job.action != "__error__":
+            yield job
+
+
+def get_active_jobs():
+    """
+    Return all pending and running jobs
+
+    The run loop asks for these on every tick, so we only query for them when
+    the database might have changed. Callers get their own copies of the jobs,
+    rebuilt from what we read, which they're free to modify.
+    """
+    return [rebuild(job) for job in ACTIVE_JOBS.get()]
+
+
+ACTIVE_JOBS = VersionedCache(
+    lambda: find_where(Job, state__in=[State.PENDING, State.RUNNING])
+)
 
 
 def get_flag(name):
@@ -38,13 +67,19 @@ def get_flag_value(name, default=None):
     # Note: fail gracefully if the flags table does not exist
     # This means we don't need to worry about it in local_run.
     try:
-        return get_flag(name).value
-    except ValueError:
-        return default
+        flag = FLAGS.get().get(name)
     except sqlite3.OperationalError as e:
         if "no such table" in str(e):
             return default
         raise
+    if flag is None:
+        return default
+    return flag.value
+
+
+# The run loop checks flags for every job on every tick, so we read them all at
+# once and only again when the database might have changed
+FLAGS = VersionedCache(lambda: {flag.id: flag for flag in find_all(Flag)})
 
 
 def set_flag(name, value, timestamp=None):
@@ -1,6 +1,8 @@
 import dataclasses
 import shlex
 import textwrap
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 
 from opensafely._vendor.pipeline.models import is_database_action
 
@@ -14,6 +16,10 @@ from opensafely.jobrunner.lib.github_validators import (
 from opensafely.jobrunner.lib.yaml_utils import YAMLError, parse_yaml
 
 
+# How many reusable action repos we fetch from at once
+MAX_FETCH_WORKERS = 4
+
+
 class ReusableActionError(Exception):
     """Represents a study developer-friendly reusable action error.
 
@@ -37,6 +43,9 @@ def resolve_reusable_action_references(jobs):
           reusable action
         * adding a reference to the reusable action's repo and commit
 
+    Each distinct reusable action version is only fetched once, however many
+    jobs use it, and different reusable actions are fetched concurrently.
+
     Args:
         jobs: list of Job instances
 
@@ -46,9 +55,19 @@ def resolve_reusable_action_references(jobs):
     Raises:
         ReusableActionError
     """
+    fetched = fetch_reusable_actions(jobs)
+
+    def get_fetched(image, tag):
+        result = fetched[image, tag]
+        if isinstance(result, ReusableActionError):
+            raise result
+        return result
+
     for job in jobs:
         try:
-            run_command, repo_url, commit = handle_reusable_action(job.run_command)
+            run_command, repo_url, commit = handle_reusable_action(
+                job.run_command, fetch=get_fetched
+            )
         except ReusableActionError as e:
             # Annotate the exception with the context of the action in which it
             # occured
@@ -59,7 +78,56 @@ def resolve_reusable_action_references(jobs):
         job.action_commit = commit
 
 
-def handle_reusable_action(run_command):
+def fetch_reusable_actions(jobs):
+    """
+    Fetch every reusable action used by `jobs`
+
+    Returns a dict mapping (image, tag) to either the ReusableAction or the
+    ReusableActionError we got when fetching it, so that errors can be reported
+    against the job which triggered them.
+    """
+    tags_by_image = defaultdict(set)
+    for job in jobs:
+        try:
+            image, tag = parse_image_and_tag(job.run_command)
+        except (ValueError, IndexError):
+            # This will get reported when we come to handle the job itself
+            continue
+        if image not in config.ALLOWED_IMAGES:
+            tags_by_image[image].add(tag)
+
+    # Versions of the same action live in the same repo, so we fetch those one
+    # after another to avoid running concurrent git operations on the same
+    # local repo
+    def fetch_all_tags(image):
+        results = {}
+        for tag in sorted(tags_by_image[image]):
+            try:
+                results[tag] = fetch_reusable_action(image, tag)
+            except ReusableActionError as e:
+                results[tag] = e
+        return results
+
+    results = {}
+    if tags_by_image:
+        workers = min(len(tags_by_image), MAX_FETCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for image, image_results in zip(
+                tags_by_image, executor.map(fetch_all_tags, tags_by_image)
+            ):
+                for tag, result in image_results.items():
+                    results[image, tag] = result
+
+    return results
+
+
+def parse_image_and_tag(run_command):
+    run_args = shlex.split(run_command)
+    image, tag = run_args[0].split(":")
+    return image, tag
+
+
+def handle_reusable_action(run_command, fetch=None):
     """
     If `run_command` refers to a reusable action then rewrite it appropriately
     and return it along with the repo_url and commit of the reusable action.
@@ -67,6 +135,8 @@ def handle_reusable_action(run_command):
 
     Args:
         run_command: Action's run command as a string
+        fetch: Function used to fetch the reusable action, defaults to
+            `fetch_reusable_action`
 
     Returns: tuple consisting of
         - rewritten_run_command: string
@@ -76,14 +146,17 @@ def handle_reusable_action(run_command):
     Raises:
         ReusableActionError: Something was wrong with the reusable action
     """
+    if fetch is None:
+        fetch = fetch_reusable_action
+
     run_args = shlex.split(run_command)
-    image, tag = run_args[0].split(":")
+    image, tag = parse_image_and_tag(run_command)
 
     if image in config.ALLOWED_IMAGES:
         # This isn't a reusable action, nothing to do
         return run_command, None, None
 
-    reusable_action = fetch_reusable_action(image, tag)
+    reusable_action = fetch(image, tag)
     new_run_args = apply_reusable_action(run_args, reusable_action)
     new_run_command = shlex.join(new_run_args)
     return new_run_command, reusable_action.repo_url, reusable_action.commit
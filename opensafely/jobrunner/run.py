@@ -8,12 +8,15 @@ import collections
 import datetime
 import logging
 import os
+import random
 import sys
 import time
 import traceback
 
 from opensafely.jobrunner import config, tracing
+from opensafely.jobrunner.archive import start_archive_thread
 from opensafely.jobrunner.executors import get_executor_api
+from opensafely.jobrunner.git_maintenance import start_maintenance_thread
 from opensafely.jobrunner.job_executor import (
     ExecutorAPI,
     ExecutorRetry,
@@ -23,10 +26,19 @@ from opensafely.jobrunner.job_executor import (
     Study,
 )
 from opensafely.jobrunner.lib import ns_timestamp_to_datetime
-from opensafely.jobrunner.lib.database import find_where, select_values, update
+from opensafely.jobrunner.lib.database import (
+    find_where,
+    transaction,
+    update,
+)
 from opensafely.jobrunner.lib.log_utils import configure_logging, set_log_context
+from opensafely.jobrunner.metrics import start_stats_thread
 from opensafely.jobrunner.models import Job, State, StatusCode
-from opensafely.jobrunner.queries import calculate_workspace_state, get_flag_value
+from opensafely.jobrunner.queries import (
+    get_active_jobs,
+    get_flag_value,
+    iter_workspace_state,
+)
 from opensafely.jobrunner.tracing import trace
 
 
@@ -34,6 +46,19 @@ log = logging.getLogger(__name__)
 tracer = trace.get_tracer("loop")
 
 EXECUTOR_RETRIES = {}
+# The states of the jobs that each pending job is waiting on, and the reverse
+# mapping from each awaited job to the ids of the jobs waiting on it. We read
+# these once per pending job and then keep them up to date in `set_code` as the
+# awaited jobs progress, rather than querying for them on every loop. Anything
+# which changes job states some other way must call `forget_awaited_states`.
+AWAITED_STATES = {}
+DEPENDENTS = collections.defaultdict(set)
+# The status codes and durations of the LOOP_JOB spans we didn't record during
+# the current loop. See `trace_handle_job`.
+UNRECORDED_LOOP_SPANS = []
+# Jobs whose timestamps have been refreshed during the current loop, which are
+# written together at the end of it. See `set_code`.
+PENDING_HEARTBEATS = {}
 
 
 class RetriesExceeded(Exception):
@@ -52,6 +77,15 @@ def main(exit_callback=lambda _: False):
     log.debug("jobrunner.run loop started")
     api = get_executor_api()
 
+    if config.GIT_MAINTENANCE_INTERVAL:
+        start_maintenance_thread()
+
+    if config.JOB_ARCHIVE_INTERVAL:
+        start_archive_thread()
+
+    if config.RECORD_STATS:
+        start_stats_thread()
+
     while True:
         active_jobs = handle_jobs(api)
 
@@ -63,42 +97,47 @@ def main(exit_callback=lambda _: False):
 
 def handle_jobs(api: ExecutorAPI | None):
     log.debug("Querying database for active jobs")
-    active_jobs = find_where(Job, state__in=[State.PENDING, State.RUNNING])
+    active_jobs = get_active_jobs()
     log.debug("Done query")
 
     running_for_workspace = collections.defaultdict(int)
     handled_jobs = []
+    start_ns = time.time_ns()
 
-    while active_jobs:
-        # We need to re-sort on each loop because the number of running jobs per
-        # workspace will change as we work our way through
-        active_jobs.sort(
-            key=lambda job: (
-                # Process all running jobs first. Once we've processed all of these, the
-                # counts in `running_for_workspace` will be up-to-date.
-                0 if job.state == State.RUNNING else 1,
-                # Then process PENDING jobs in order of how many are running in the
-                # workspace. This gives a fairer allocation of capacity among
-                # workspaces.
-                running_for_workspace[job.workspace],
-                # DB jobs are more important than cpu jobs
-                0 if job.requires_db else 1,
-                # Finally use job age as a tie-breaker
-                job.created_at,
+    try:
+        while active_jobs:
+            # We need to re-sort on each loop because the number of running jobs per
+            # workspace will change as we work our way through
+            active_jobs.sort(
+                key=lambda job: (
+                    # Process all running jobs first. Once we've processed all of these, the
+                    # counts in `running_for_workspace` will be up-to-date.
+                    0 if job.state == State.RUNNING else 1,
+                    # Then process PENDING jobs in order of how many are running in the
+                    # workspace. This gives a fairer allocation of capacity among
+                    # workspaces.
+                    running_for_workspace[job.workspace],
+                    # DB jobs are more important than cpu jobs
+                    0 if job.requires_db else 1,
+                    # Finally use job age as a tie-breaker
+                    job.created_at,
+                )
             )
-        )
-        job = active_jobs.pop(0)
+            job = active_jobs.pop(0)
 
-        # `set_log_context` ensures that all log messages triggered anywhere
-        # further down the stack will have `job` set on them
-        with set_log_context(job=job):
-            handle_single_job(job, api)
+            # `set_log_context` ensures that all log messages triggered anywhere
+            # further down the stack will have `job` set on them
+            with set_log_context(job=job):
+                handle_single_job(job, api)
 
-        # Add running jobs to the workspace count
-        if job.state == State.RUNNING:
-            running_for_workspace[job.workspace] += 1
+            # Add running jobs to the workspace count
+            if job.state == State.RUNNING:
+                running_for_workspace[job.workspace] += 1
 
-        handled_jobs.append(job)
+            handled_jobs.append(job)
+    finally:
+        write_heartbeats()
+        record_loop_summary(start_ns)
 
     return handled_jobs
 
@@ -180,27 +219,86 @@ def handle_single_job(job, api):
 
 
 def trace_handle_job(job, api, mode, paused):
-    """Call handle job with tracing."""
+    """Call handle job with tracing.
+
+    Depending on config.LOOP_SPANS, the LOOP_JOB span may only be recorded if
+    something happened to the job. We can't know that until the job has been
+    handled, so in that case we handle it with no current span and start the
+    LOOP_JOB span afterwards, backdated to when we started, if we record it at
+    all. Any spans started while handling the job are then roots of their own
+    traces, rather than children of a span which is never exported.
+    """
     attrs = {
         "job.initial_state": job.state.name,
         "job.initial_code": job.status_code.name,
     }
 
-    with tracer.start_as_current_span("LOOP_JOB") as span:
+    start_ns = time.time_ns()
+    if config.LOOP_SPANS == "all":
+        span = tracer.start_span("LOOP_JOB", start_time=start_ns)
         tracing.set_span_metadata(span, job, extra=attrs)
-        try:
+    else:
+        span = trace.INVALID_SPAN
+
+    try:
+        with trace.use_span(
+            span, record_exception=False, set_status_on_exception=False
+        ):
             synchronous_transition = handle_job(job, api, mode, paused)
-        except Exception as exc:
-            span.set_status(trace.Status(trace.StatusCode.ERROR, str(exc)))
-            span.record_exception(exc)
-            raise
-        else:
-            span.set_attribute("job.final_state", job.state.name)
-            span.set_attribute("job.final_code", job.status_code.name)
+    except Exception as exc:
+        if not span.is_recording():
+            span = start_loop_job_span(job, attrs, start_ns)
+        span.set_status(trace.Status(trace.StatusCode.ERROR, str(exc)))
+        span.record_exception(exc)
+        span.end()
+        raise
 
+    changed = job.status_code.name != attrs["job.initial_code"]
+    if not span.is_recording():
+        if not should_record_loop_span(job, changed):
+            UNRECORDED_LOOP_SPANS.append((job.status_code, time.time_ns() - start_ns))
+            return synchronous_transition
+        span = start_loop_job_span(job, attrs, start_ns)
+
+    span.set_attribute("job.final_state", job.state.name)
+    span.set_attribute("job.final_code", job.status_code.name)
+    span.end()
     return synchronous_transition
 
 
+def start_loop_job_span(job, attrs, start_ns):
+    span = tracer.start_span("LOOP_JOB", start_time=start_ns)
+    tracing.set_span_metadata(span, job, extra=attrs)
+    return span
+
+
+def should_record_loop_span(job, changed):
+    if changed:
+        return True
+    # handle_job records retries here until the executor stops asking for them
+    if job.id in EXECUTOR_RETRIES:
+        return True
+    return random.random() < config.LOOP_SPAN_SAMPLE_RATE
+
+
+def record_loop_summary(start_ns):
+    """Record a LOOP span summarising any LOOP_JOB spans we didn't record"""
+    if config.LOOP_SPANS == "all" or not UNRECORDED_LOOP_SPANS:
+        return
+    durations = [duration for _, duration in UNRECORDED_LOOP_SPANS]
+    attrs = {
+        "loop.unrecorded_jobs": len(durations),
+        "loop.unrecorded_duration_ms": sum(durations) / 1e6,
+        "loop.unrecorded_max_duration_ms": max(durations, default=0) / 1e6,
+    }
+    codes = collections.Counter(code for code, _ in UNRECORDED_LOOP_SPANS)
+    for code, count in codes.items():
+        attrs[f"loop.unrecorded_jobs.{code.name}"] = count
+    UNRECORDED_LOOP_SPANS.clear()
+    span = tracer.start_span("LOOP", start_time=start_ns, attributes=attrs)
+    span.end()
+
+
 def handle_job(job, api, mode=None, paused=None):
     """Handle an active job.
 
@@ -483,15 +581,14 @@ def get_obsolete_files(job_definition, outputs):
     these will end up being stored on.
     """
     keep_files = {str(name).lower() for name in outputs}
-    obsolete = []
-
-    for existing in list_outputs_from_action(
+    existing_files = list_outputs_from_action(
         job_definition.workspace, job_definition.action
-    ):
-        name = str(existing).lower()
-        if name not in keep_files:
-            obsolete.append(str(existing))
-    return obsolete
+    )
+    return [
+        str(existing)
+        for existing in existing_files
+        if str(existing).lower() not in keep_files
+    ]
 
 
 def job_to_job_definition(job):
@@ -566,10 +663,39 @@ def get_states_of_awaited_jobs(job):
     if not job_ids:
         return []
 
-    log.debug("Querying database for state of dependencies")
-    states = select_values(Job, "state", id__in=job_ids)
-    log.debug("Done query")
-    return states
+    states = AWAITED_STATES.get(job.id)
+    if states is None:
+        log.debug("Querying database for state of dependencies")
+        awaited_jobs = find_where(Job, columns=["id", "state"], id__in=job_ids)
+        log.debug("Done query")
+        states = {awaited.id: awaited.state for awaited in awaited_jobs}
+        AWAITED_STATES[job.id] = states
+        for awaited_id in states:
+            DEPENDENTS[awaited_id].add(job.id)
+    return list(states.values())
+
+
+def update_awaited_states(job):
+    """
+    Record `job`'s new state for the jobs waiting on it, and stop tracking the
+    jobs it was waiting on if it's no longer pending
+    """
+    for dependent_id in DEPENDENTS.get(job.id, ()):
+        AWAITED_STATES[dependent_id][job.id] = job.state
+    if job.state != State.PENDING:
+        for awaited_id in AWAITED_STATES.pop(job.id, {}):
+            DEPENDENTS[awaited_id].discard(job.id)
+            if not DEPENDENTS[awaited_id]:
+                del DEPENDENTS[awaited_id]
+
+
+def forget_awaited_states():
+    """
+    Drop the states of awaited jobs we are keeping track of, so that they are
+    read from the database again
+    """
+    AWAITED_STATES.clear()
+    DEPENDENTS.clear()
 
 
 def mark_job_as_failed(job, code, message, error=None, **attrs):
@@ -651,6 +777,7 @@ def set_code(
         # use higher precision timestamp for state change time
         job.status_code_updated_at = timestamp_ns
         update_job(job)
+        update_awaited_states(job)
 
         if new_status_code.is_final_code:
             # transitioning to a final state, so just record that state
@@ -669,9 +796,7 @@ def set_code(
     # active without writing to the database every single time we poll
     elif timestamp_s - job.updated_at >= 60:
         job.updated_at = timestamp_s
-        log.debug("Updating job timestamp")
-        update_job(job)
-        log.debug("Update done")
+        PENDING_HEARTBEATS[job.id] = job
         # For long running jobs we don't want to fill the logs up with "Job X
         # is still running" messages, but it is useful to have semi-regular
         # confirmations in the logs that it is still running. The below will
@@ -682,7 +807,9 @@ def set_code(
 
 def get_reason_job_not_started(job):
     log.debug("Querying for running jobs")
-    running_jobs = find_where(Job, state=State.RUNNING)
+    running_jobs = find_where(
+        Job, columns=["workspace", "action", "requires_db"], state=State.RUNNING
+    )
     log.debug("Query done")
     used_resources = sum(
         get_job_resource_weight(running_job) for running_job in running_jobs
@@ -719,9 +846,8 @@ def get_reason_job_not_started(job):
 
 
 def list_outputs_from_action(workspace, action):
-    for job in calculate_workspace_state(workspace):
-        if job.action == action:
-            return job.output_files
+    for job in iter_workspace_state(workspace, action=action):
+        return job.output_files
 
     # The action has never been run before
     return []
@@ -740,6 +866,19 @@ def get_job_resource_weight(job, weights=config.JOB_RESOURCE_WEIGHTS):
     return 1
 
 
+def write_heartbeats():
+    """Write all the timestamps refreshed during this loop in one transaction"""
+    if not PENDING_HEARTBEATS:
+        return
+    jobs = list(PENDING_HEARTBEATS.values())
+    PENDING_HEARTBEATS.clear()
+    log.debug(f"Updating {len(jobs)} job timestamps")
+    with transaction():
+        for job in jobs:
+            update_job(job)
+    log.debug("Update done")
+
+
 def update_job(job):
     # The cancelled field is written by the sync thread and we should never update it. The sync thread never updates
     # any other fields after it has created the job, so we're always safe to modify them.
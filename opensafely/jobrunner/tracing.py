@@ -1,5 +1,6 @@
 import logging
 import os
+import threading
 import warnings
 from datetime import datetime
 
@@ -30,6 +31,7 @@ except ImportError:
 
 from opensafely.jobrunner import config, models
 from opensafely.jobrunner.lib import database, warn_assertions
+from opensafely.jobrunner.lib.lru_dict import LRUDict
 
 
 logger = logging.getLogger(__name__)
@@ -304,20 +306,46 @@ def set_span_metadata(span, job, error=None, results=None, extra=None):
         span.record_exception(error)
 
 
+# Span attributes from the original job request, by job request id. See
+# `get_job_request_attributes`.
+JOB_REQUEST_ATTRIBUTES = LRUDict(1000)
+JOB_REQUEST_ATTRIBUTES_LOCK = threading.Lock()
+
+
+def get_job_request_attributes(job_request_id):
+    """
+    Return the span attributes taken from the original job request
+
+    The run loop reads its jobs afresh from the database, so we cache these
+    across all the jobs for a request rather than query for them and decode
+    the whole request for every span.
+    """
+    with JOB_REQUEST_ATTRIBUTES_LOCK:
+        attributes = JOB_REQUEST_ATTRIBUTES.get(job_request_id)
+    if attributes is not None:
+        return attributes
+
+    try:
+        original = database.find_one(models.SavedJobRequest, id=job_request_id).original
+    except ValueError:
+        # Jobs are traced before their request is saved when we record
+        # failures to create them, so we don't cache this
+        original = {}
+    attributes = {
+        "job.user": original.get("created_by", "unknown"),
+        "job.project": original.get("project", "unknown"),
+        "job.orgs": ",".join(original.get("orgs", [])),
+    }
+    if original:
+        with JOB_REQUEST_ATTRIBUTES_LOCK:
+            JOB_REQUEST_ATTRIBUTES[job_request_id] = attributes
+    return attributes
+
+
 def trace_attributes(job, results=None):
     """These attributes are added to every span in order to slice and dice by
     each as needed.
     """
-    # grab job request metadata, caching it on the job instance to avoid excess
-    # queries/jsoning
-    if job._job_request is None:
-        try:
-            job._job_request = database.find_one(
-                models.SavedJobRequest, id=job.job_request_id
-            ).original
-        except ValueError:
-            job._job_request = {}
-
     # Note: no commit attribute because local_run jobs don't have a commit
     attrs = {
         "job.backend": config.BACKEND,
@@ -326,9 +354,7 @@ def trace_attributes(job, results=None):
         "job.workspace": job.workspace,
         "job.action": job.action,
         "job.run_command": job.run_command,
-        "job.user": job._job_request.get("created_by", "unknown"),
-        "job.project": job._job_request.get("project", "unknown"),
-        "job.orgs": ",".join(job._job_request.get("orgs", [])),
+        **get_job_request_attributes(job.job_request_id),
         "job.state": job.state.name,
         "job.message": job.status_message,
         # convert float seconds to ns integer
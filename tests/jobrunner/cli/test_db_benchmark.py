@@ -0,0 +1,14 @@
+from opensafely.jobrunner.cli import db_benchmark
+from opensafely.jobrunner.lib import database
+
+
+def test_db_benchmark(tmp_path, capsys):
+    db_benchmark.run(["--sizes", "300", "--ticks", "2", "--dir", str(tmp_path)])
+
+    output = capsys.readouterr().out
+    for profile in database.CONNECTION_PROFILES:
+        assert f"300 jobs, {profile} profile" in output
+    for query in ["active jobs", "workspace state", "update job"]:
+        assert query in output
+    # the databases are cleaned up
+    assert not list(tmp_path.iterdir())
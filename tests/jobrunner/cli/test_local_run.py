@@ -261,3 +261,23 @@ def test_filter_log_messages():
         {"status_code": local_run.StatusCode.WAITING_ON_DEPENDENCIES}
     )
     assert local_run.filter_log_messages(record) is False
+
+
+def test_get_log_file_snippet(tmp_path):
+    log_file = tmp_path / "logs.txt"
+    log_file.write_text(
+        "2021-01-01T12:00:00.000000000Z first line\n"
+        "[... 1234 bytes of log output truncated ...]\n"
+        "2021-01-01T12:00:01.000000000Z last line\n"
+        "\n"
+        "outputs:\n"
+    )
+
+    assert local_run.get_log_file_snippet(log_file, max_lines=10) == (
+        "first line\n[... 1234 bytes of log output truncated ...]\nlast line",
+        False,
+    )
+    assert local_run.get_log_file_snippet(log_file, max_lines=1) == (
+        "last line",
+        True,
+    )
@@ -11,10 +11,10 @@ import pytest
 from opentelemetry.sdk.trace.export import SimpleSpanProcessor
 
 import opensafely.jobrunner
-from opensafely.jobrunner import config, tracing
+from opensafely.jobrunner import config, metrics, queries, run, tracing
 from opensafely.jobrunner.executors import volumes
 from opensafely.jobrunner.job_executor import Study
-from opensafely.jobrunner.lib import database
+from opensafely.jobrunner.lib import database, git
 from opensafely.jobrunner.lib.subprocess_utils import subprocess_run
 from tests.jobrunner.factories import TEST_EXPORTER
 
@@ -39,6 +39,18 @@ def clear_state():
     # local docker API maintains results cache as a module global, so clear it.
     opensafely.jobrunner.executors.local.RESULTS.clear()
     database.CONNECTION_CACHE.__dict__.clear()
+    queries.ACTIVE_JOBS.clear()
+    queries.FLAGS.clear()
+    run.PENDING_HEARTBEATS.clear()
+    run.AWAITED_STATES.clear()
+    run.DEPENDENTS.clear()
+    tracing.JOB_REQUEST_ATTRIBUTES.clear()
+    run.UNRECORDED_LOOP_SPANS.clear()
+    git.close_cat_file_processes()
+    git.FETCHED_COMMITS.clear()
+    git.COMMITS_LAST_USED.clear()
+    git.REF_CACHES.clear()
+    metrics.SCHEMA_CREATED.clear()
     # clear any exported spans
     TEST_EXPORTER.clear()
 
@@ -49,8 +61,15 @@ def tmp_work_dir(request, monkeypatch, tmp_path):
     monkeypatch.setattr(
         "opensafely.jobrunner.config.DATABASE_FILE", tmp_path / "db.sqlite"
     )
+    monkeypatch.setattr(
+        "opensafely.jobrunner.config.ARCHIVE_DATABASE_FILE", tmp_path / "archive.sqlite"
+    )
+    monkeypatch.setattr(
+        "opensafely.jobrunner.config.METRICS_FILE", tmp_path / "metrics.sqlite"
+    )
     config_vars = [
         "TMP_DIR",
+        "CHECKOUT_CACHE_DIR",
         "GIT_REPO_DIR",
         "HIGH_PRIVACY_STORAGE_BASE",
         "MEDIUM_PRIVACY_STORAGE_BASE",
@@ -0,0 +1,119 @@
+import os
+import threading
+from pathlib import Path
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import checkout_cache
+
+
+REPO_FIXTURE = str(Path(__file__).parents[1].resolve() / "fixtures/git-repo")
+COMMIT = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+
+
+def test_cached_checkout(tmp_work_dir, tmp_path, monkeypatch):
+    calls = []
+    checkout_commit = checkout_cache.checkout_commit
+
+    def counting_checkout_commit(*args):
+        calls.append(args)
+        return checkout_commit(*args)
+
+    monkeypatch.setattr(checkout_cache, "checkout_commit", counting_checkout_commit)
+
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        assert path == config.CHECKOUT_CACHE_DIR / "git-repo" / COMMIT
+        assert [f.name for f in path.iterdir()] == ["project.yaml"]
+
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        assert (path / "project.yaml").read_bytes().startswith(b"version: '1.0'")
+
+    assert len(calls) == 1
+    # no temporary dirs left lying around
+    assert list(path.parent.iterdir()) == [path]
+    # and nothing is left in use
+    assert checkout_cache.READERS == {}
+
+
+def test_cached_checkout_keyed_by_excludes(tmp_work_dir, monkeypatch):
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        assert (path / "project.yaml").exists()
+
+    # changing what's left out means checking out again
+    monkeypatch.setattr(config, "GIT_CHECKOUT_EXCLUDE", ["data"])
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as excluded:
+        assert excluded.parent == path.parent
+        assert excluded != path
+        assert (excluded / "project.yaml").exists()
+
+
+def test_cached_checkout_concurrent(tmp_work_dir, monkeypatch):
+    calls = []
+    checkout_commit = checkout_cache.checkout_commit
+
+    def counting_checkout_commit(*args):
+        calls.append(args)
+        return checkout_commit(*args)
+
+    monkeypatch.setattr(checkout_cache, "checkout_commit", counting_checkout_commit)
+
+    def prepare():
+        with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+            assert (path / "project.yaml").exists()
+
+    threads = [threading.Thread(target=prepare) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+
+
+def make_entry(name, size, mtime):
+    path = config.CHECKOUT_CACHE_DIR / "repo" / name
+    path.mkdir(parents=True)
+    (path / "file").write_bytes(b"x" * size)
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def test_evict_least_recently_used(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "CHECKOUT_CACHE_MAX_BYTES", 250)
+    oldest = make_entry("a", 100, 1000)
+    older = make_entry("b", 100, 2000)
+    newest = make_entry("c", 100, 3000)
+
+    checkout_cache.evict()
+
+    assert not oldest.exists()
+    assert older.exists()
+    assert newest.exists()
+    assert set(newest.parent.iterdir()) == {older, newest}
+
+
+def test_evict_skips_kept_and_in_use(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "CHECKOUT_CACHE_MAX_BYTES", 0)
+    kept = make_entry("a", 100, 1000)
+    in_use = make_entry("b", 100, 2000)
+    other = make_entry("c", 100, 3000)
+
+    with checkout_cache.get_lock(in_use):
+        checkout_cache.evict(keep=kept)
+
+    assert kept.exists()
+    assert in_use.exists()
+    assert not other.exists()
+
+
+def test_evict_skips_trees_being_read(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "CHECKOUT_CACHE_MAX_BYTES", 0)
+    with checkout_cache.cached_checkout(REPO_FIXTURE, COMMIT) as path:
+        checkout_cache.evict()
+        assert path.exists()
+
+    # evicted once we've finished with it, along with everything we knew
+    # about it
+    checkout_cache.evict()
+    assert not path.exists()
+    assert path not in checkout_cache.LOCKS
+    assert path not in checkout_cache.SIZES
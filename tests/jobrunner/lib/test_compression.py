@@ -0,0 +1,62 @@
+import pytest
+
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import compression
+
+
+def test_compress_decompress_roundtrip(tmp_path):
+    src = tmp_path / "output" / "input.csv"
+    src.parent.mkdir()
+    src.write_bytes(b"patient_id,age\n" + b"1,42\n" * 10000)
+
+    size = compression.compress_file(src)
+
+    compressed = tmp_path / "output" / "input.csv.zst"
+    assert not src.exists()
+    assert compressed.exists()
+    assert size == compressed.stat().st_size
+    assert size < 10000
+
+    dst = tmp_path / "decompressed.csv"
+    assert compression.decompress_file(compressed, dst) == 15 + 5 * 10000
+    assert dst.read_bytes() == b"patient_id,age\n" + b"1,42\n" * 10000
+    # source is left in place
+    assert compressed.exists()
+
+
+def test_resolve_stored_file(tmp_path):
+    path = tmp_path / "file.csv"
+    assert compression.resolve_stored_file(path) == (None, False)
+
+    compression.compressed_path(path).write_bytes(b"")
+    assert compression.resolve_stored_file(path) == (
+        tmp_path / "file.csv.zst",
+        True,
+    )
+
+    path.write_text("plain")
+    assert compression.resolve_stored_file(path) == (path, False)
+
+
+@pytest.mark.parametrize(
+    "enabled,size,level,expected",
+    [
+        (False, 1000, "highly_sensitive", False),
+        (True, 1000, "highly_sensitive", True),
+        (True, 999, "highly_sensitive", False),
+        (True, 1000, "moderately_sensitive", False),
+    ],
+)
+def test_should_compress(monkeypatch, enabled, size, level, expected):
+    monkeypatch.setattr(config, "COMPRESS_HIGHLY_SENSITIVE_OUTPUTS", enabled)
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZE", 1000)
+    assert compression.should_compress(size, level) is expected
+
+
+def test_should_compress_unavailable(monkeypatch):
+    monkeypatch.setattr(config, "COMPRESS_HIGHLY_SENSITIVE_OUTPUTS", True)
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZE", 0)
+    monkeypatch.setattr(compression, "ZSTD_AVAILABLE", False)
+    assert compression.should_compress(1, "highly_sensitive") is False
+    with pytest.raises(compression.CompressionUnavailable):
+        compression.decompress_file(None, None)
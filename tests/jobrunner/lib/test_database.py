@@ -1,19 +1,34 @@
+import dataclasses
 import logging
 import sqlite3
+from unittest import mock
 
 import pytest
 
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import database
 from opensafely.jobrunner.lib.database import (
+    CODECS,
     CONNECTION_CACHE,
+    SQL_CACHE,
+    EncodedJSON,
     MigrationNeeded,
+    VersionedCache,
     count_where,
+    data_version,
     ensure_db,
     ensure_valid_db,
     exists_where,
+    find_latest_where,
     find_one,
+    find_where,
     generate_insert_sql,
+    get_codec,
     get_connection,
     insert,
+    insert_many,
+    iter_values,
+    iter_where,
     migrate_db,
     query_params_to_sql,
     select_values,
@@ -75,6 +90,30 @@ def test_insert_in_transaction_fail(tmp_work_dir):
         find_one(Job, job_request_id__in=["bar123", "baz123"])
 
 
+def test_insert_many(tmp_work_dir):
+    jobs = [
+        Job(id=f"foo{i}", job_request_id="bar123", output_spec={"hello": [i]})
+        for i in range(3)
+    ]
+    insert_many(jobs)
+
+    found = find_where(Job, job_request_id="bar123")
+    assert sorted(found, key=lambda job: job.id) == jobs
+
+
+def test_insert_many_no_items(tmp_work_dir):
+    insert_many([])
+    assert count_where(Job) == 0
+
+
+def test_insert_many_in_transaction_fail(tmp_work_dir):
+    with pytest.raises(sqlite3.IntegrityError):
+        with transaction():
+            insert_many([Job(id="foo1"), Job(id="foo2"), Job(id="foo1")])
+
+    assert count_where(Job) == 0
+
+
 def test_generate_insert_sql(tmp_work_dir):
     job = Job(id="foo123", action="foo")
     sql, _ = generate_insert_sql(job)
@@ -93,6 +132,51 @@ def test_update(tmp_work_dir):
     assert find_one(Job, id="foo123").action == "bar"
 
 
+def test_update_only_writes_changed_fields(tmp_work_dir):
+    insert(Job(id="foo123", action="foo", commit="commit-of-glory"))
+    job = find_one(Job, id="foo123")
+    # simulate another writer changing a field we haven't touched
+    conn = sqlite3.connect(config.DATABASE_FILE)
+    with conn:
+        conn.execute("UPDATE job SET 'commit' = 'commit-of-doom'")
+    conn.close()
+
+    job.action = "bar"
+    update(job)
+
+    j = find_one(Job, id="foo123")
+    assert j.action == "bar"
+    assert j.commit == "commit-of-doom"
+
+
+def test_update_detects_modified_json_fields(tmp_work_dir):
+    insert(Job(id="foo123", outputs={"a.csv": "highly_sensitive"}))
+    job = find_one(Job, id="foo123")
+    job.outputs["b.csv"] = "moderately_sensitive"
+    update(job)
+    assert find_one(Job, id="foo123").outputs == {
+        "a.csv": "highly_sensitive",
+        "b.csv": "moderately_sensitive",
+    }
+
+
+def test_update_without_changes_does_not_write(tmp_work_dir):
+    job = Job(id="foo123", action="foo")
+    insert(job)
+    version = data_version()
+    job.action = "foo"
+    update(job)
+    assert data_version() == version
+
+
+def test_update_untracked_item_writes_all_fields(tmp_work_dir):
+    insert(Job(id="foo123", action="foo", commit="commit-of-glory"))
+    update(Job(id="foo123", action="bar"))
+    j = find_one(Job, id="foo123")
+    assert j.action == "bar"
+    assert j.commit is None
+
+
 def test_upsert_insert(tmp_work_dir):
     job = Job(id="foo123", action="bar")
     upsert(job)
@@ -294,6 +378,7 @@ def test_ensure_valid_db(tmp_path):
         ({}, "1 = 1", []),
         ({"doubutsu": "neko"}, '"doubutsu" = ?', ["neko"]),
         ({"doubutsu__like": "ne%"}, '"doubutsu" LIKE ?', ["ne%"]),
+        ({"toshi__gte": 3}, '"toshi" >= ?', [3]),
         (
             {"doubutsu__in": ["neko", "kitsune", "nezumi"]},
             '"doubutsu" IN (?, ?, ?)',
@@ -311,3 +396,192 @@ def test_query_params_to_sql(params, expected_sql_string, expected_sql_values):
     sql_string, sql_values = query_params_to_sql(params)
     assert sql_string == expected_sql_string
     assert sql_values == expected_sql_values
+
+
+def test_codecs_built_for_database_classes():
+    codec = CODECS[Job]
+    assert codec.decoders["state"] is State
+    assert codec.decoders["output_spec"] is not None
+    assert codec.decoders["action"] is None
+
+
+def test_queries_with_the_same_shape_share_sql(tmp_work_dir):
+    SQL_CACHE.clear()
+    insert(Job(id="foo1", state=State.PENDING))
+    insert(Job(id="foo2", state=State.RUNNING))
+
+    assert find_one(Job, state=State.PENDING).id == "foo1"
+    cache_size = len(SQL_CACHE)
+    assert find_one(Job, state=State.RUNNING).id == "foo2"
+    assert len(SQL_CACHE) == cache_size
+
+    # a different number of values in an IN clause is a different shape
+    assert len(find_where(Job, id__in=["foo1"])) == 1
+    assert len(find_where(Job, id__in=["foo1", "foo2"])) == 2
+
+
+def test_find_where_column_order_differs_from_fields(tmp_work_dir):
+    @dataclasses.dataclass
+    class Thing:
+        __tablename__ = "thing"
+
+        id: str
+        state: State = None
+        data: dict = None
+        name: str = None
+
+    conn = get_connection()
+    conn.execute("CREATE TABLE thing (name TEXT, data TEXT, state TEXT, id TEXT)")
+    thing = Thing(id="t1", state=State.FAILED, data={"a": [1]}, name="name")
+    insert(thing)
+
+    assert find_one(Thing, id="t1") == thing
+    assert select_values(Thing, "data") == [{"a": [1]}]
+    assert get_codec(Thing).decoders["state"] is State
+
+
+def test_find_where_columns(tmp_work_dir):
+    insert(
+        Job(
+            id="foo1",
+            state=State.RUNNING,
+            workspace="workspace",
+            action="action",
+            outputs={"output.csv": "highly_sensitive"},
+        )
+    )
+
+    (job,) = find_where(Job, columns=["state", "workspace"], id="foo1")
+
+    assert job.state == State.RUNNING
+    assert job.workspace == "workspace"
+    assert job.action is None
+    assert job.outputs is None
+
+
+def test_find_where_unknown_column(tmp_work_dir):
+    with pytest.raises(AssertionError):
+        find_where(Job, columns=["state", "nope"])
+
+
+def test_iter_where_fetches_in_chunks(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(database, "FETCH_SIZE", 2)
+    insert_many([Job(id=f"foo{i}", state=State.PENDING) for i in range(5)])
+    fetches = []
+    fetchmany = sqlite3.Cursor.fetchmany
+
+    class RecordingCursor(sqlite3.Cursor):
+        def fetchmany(self, size):
+            rows = fetchmany(self, size)
+            fetches.append(len(rows))
+            return rows
+
+    conn = get_connection()
+    monkeypatch.setattr(
+        database,
+        "get_connection",
+        lambda: mock.Mock(
+            execute=lambda sql, params: conn.cursor(RecordingCursor).execute(
+                sql, params
+            )
+        ),
+    )
+
+    jobs = iter_where(Job, state=State.PENDING)
+    assert fetches == []
+    assert next(jobs).id == "foo0"
+    assert fetches == [2]
+    assert [job.id for job in jobs] == ["foo1", "foo2", "foo3", "foo4"]
+    assert fetches == [2, 2, 1, 0]
+
+
+def test_iter_values(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(database, "FETCH_SIZE", 2)
+    insert_many([Job(id=f"foo{i}", state=State.PENDING) for i in range(5)])
+    insert(Job(id="bar", state=State.RUNNING))
+    assert list(iter_values(Job, "state", id__like="foo%")) == [State.PENDING] * 5
+
+
+def test_json_fields_decoded_lazily(tmp_work_dir):
+    insert(Job(id="foo1", outputs={"output.csv": "highly_sensitive"}))
+
+    job = find_one(Job, id="foo1")
+    assert isinstance(job.__dict__["outputs"], EncodedJSON)
+    assert job.outputs == {"output.csv": "highly_sensitive"}
+    assert job.__dict__["outputs"] == {"output.csv": "highly_sensitive"}
+    assert Job.outputs is None
+
+
+def test_undecoded_json_fields_written_back_unchanged(tmp_work_dir):
+    insert(Job(id="foo1", outputs={"output.csv": "highly_sensitive"}))
+
+    job = find_one(Job, id="foo1")
+    job.status_message = "updated"
+    update(job)
+
+    assert isinstance(job.__dict__["outputs"], EncodedJSON)
+    updated = find_one(Job, id="foo1")
+    assert updated.status_message == "updated"
+    assert updated.outputs == {"output.csv": "highly_sensitive"}
+
+
+def test_rebuild(tmp_work_dir):
+    insert(Job(id="foo1", outputs={"output.csv": "highly_sensitive"}))
+    job = find_one(Job, id="foo1")
+    job.outputs["other.csv"] = "moderately_sensitive"
+
+    rebuilt = database.rebuild(job)
+
+    assert rebuilt.id == "foo1"
+    assert isinstance(rebuilt.__dict__["outputs"], EncodedJSON)
+    assert rebuilt.outputs == {"output.csv": "highly_sensitive"}
+
+
+def test_find_latest_where(tmp_work_dir):
+    for i, (action, created_at) in enumerate(
+        [("a", 1), ("a", 3), ("a", 2), ("b", 5), ("b", 4)]
+    ):
+        insert(Job(id=f"job{i}", action=action, created_at=created_at))
+    insert(Job(id="other", action="a", created_at=10, cancelled=True))
+
+    latest = find_latest_where(Job, "action", "created_at", cancelled=False)
+
+    assert [(job.action, job.id) for job in latest] == [("a", "job1"), ("b", "job3")]
+
+
+def test_get_connection_applies_profile(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "DATABASE_PROFILE", "fast")
+    monkeypatch.setattr(config, "DATABASE_PRAGMAS", {"cache_size": "-1234"})
+    conn = get_connection(tmp_path / "db.sqlite")
+
+    # 1 is NORMAL
+    assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+    assert conn.execute("PRAGMA cache_size").fetchone()[0] == -1234
+
+
+def test_data_version(tmp_work_dir):
+    version = data_version()
+    assert data_version() == version
+
+    # writes through this module
+    insert(Job(id="foo1"))
+    assert data_version() != version
+    version = data_version()
+
+    # writes by other connections
+    other = sqlite3.connect(config.DATABASE_FILE, isolation_level=None)
+    other.execute("DELETE FROM job")
+    assert data_version() != version
+
+
+def test_versioned_cache(tmp_work_dir):
+    fetch = mock.Mock(side_effect=lambda: count_where(Job))
+    cache = VersionedCache(fetch)
+
+    assert cache.get() == 0
+    assert cache.get() == 0
+    assert fetch.call_count == 1
+
+    insert(Job(id="foo1"))
+    assert cache.get() == 1
+    assert fetch.call_count == 2
@@ -1,3 +1,4 @@
+import json
 import subprocess
 
 import pytest
@@ -27,6 +28,84 @@ def test_basic_volume_interaction(tmp_path, docker_cleanup):
     docker.delete_volume(volume)
 
 
+def test_container_stats(monkeypatch):
+    rows = [
+        {
+            "Name": "os-job-abc",
+            "CPUPerc": "101.50%",
+            "MemUsage": "1.5GiB / 7.7GiB",
+            "BlockIO": "12.3MB / 0B",
+        },
+        {
+            "Name": "other",
+            "CPUPerc": "0.00%",
+            "MemUsage": "512KiB / 7.7GiB",
+            "BlockIO": "1kB / 2kB",
+        },
+    ]
+
+    def run(args, timeout, **kwargs):
+        stdout = "".join(json.dumps(row) + "\n" for row in rows)
+        return subprocess.CompletedProcess(args, 0, stdout=stdout)
+
+    monkeypatch.setattr(docker, "subprocess_run", run)
+
+    assert docker.container_stats() == {
+        "os-job-abc": {
+            "cpu_percentage": 101.5,
+            "memory_used": int(1.5 * 1024**3),
+            "block_read": 12_300_000,
+            "block_write": 0,
+        },
+        "other": {
+            "cpu_percentage": 0.0,
+            "memory_used": 512 * 1024,
+            "block_read": 1000,
+            "block_write": 2000,
+        },
+    }
+
+
+def test_container_stats_filters_and_skips_unparseable(monkeypatch):
+    rows = [
+        {
+            "Name": "os-job-abc",
+            "CPUPerc": "1.00%",
+            "MemUsage": "1MiB / 7.7GiB",
+            "BlockIO": "0B / 0B",
+        },
+        # still starting up
+        {
+            "Name": "os-job-def",
+            "CPUPerc": "--",
+            "MemUsage": "-- / --",
+            "BlockIO": "-- / --",
+        },
+        # not ours, so it's not parsed at all
+        {"Name": "other", "CPUPerc": "??", "MemUsage": "??", "BlockIO": "??"},
+    ]
+
+    def run(args, timeout, **kwargs):
+        stdout = "".join(json.dumps(row) + "\n" for row in rows)
+        return subprocess.CompletedProcess(args, 0, stdout=stdout)
+
+    monkeypatch.setattr(docker, "subprocess_run", run)
+
+    assert docker.container_stats(prefix="os-job-") == {
+        "os-job-abc": {
+            "cpu_percentage": 1.0,
+            "memory_used": 1024**2,
+            "block_read": 0,
+            "block_write": 0,
+        },
+    }
+
+
+def test_parse_size_invalid():
+    with pytest.raises(ValueError):
+        docker.parse_size("1.5 parsecs")
+
+
 def test_disk_space_detection(monkeypatch):
     def error(stdout, stderr):
         def run(args, timeout, **kwargs):
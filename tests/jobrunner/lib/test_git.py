@@ -1,19 +1,33 @@
+import json
 import os
+import threading
+import time
 from pathlib import Path
 
 import pytest
 
+from opensafely.jobrunner import config
+from opensafely.jobrunner.lib import git
 from opensafely.jobrunner.lib.git import (
+    CatFileProcess,
+    GitError,
+    GitFileNotFoundError,
     GitRepoNotReachableError,
     GitUnknownRefError,
     checkout_commit,
     commit_already_fetched,
     commit_reachable_from_ref,
+    ensure_commit_fetched,
     ensure_git_init,
     fetch_commit,
+    forget_fetched_commits,
+    get_cat_file_process,
+    get_local_repo_dir,
     get_sha_from_remote_ref,
+    mark_commmit_as_fetched,
     read_file_from_repo,
 )
+from opensafely.jobrunner.lib.subprocess_utils import subprocess_run
 
 
 REPO_FIXTURE = str(Path(__file__).parents[1].resolve() / "fixtures/git-repo")
@@ -134,6 +148,52 @@ def test_read_file_from_repo_local(tmp_work_dir):
     assert output.startswith(b"version: '1.0'")
 
 
+def test_read_file_from_repo_local_reuses_process(tmp_work_dir):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    read_file_from_repo(REPO_FIXTURE, commit_sha, "project.yaml")
+    process = get_cat_file_process(get_local_repo_dir(REPO_FIXTURE)).process
+    output = read_file_from_repo(REPO_FIXTURE, commit_sha, "project.yaml")
+    assert output.startswith(b"version: '1.0'")
+    assert get_cat_file_process(get_local_repo_dir(REPO_FIXTURE)).process is process
+
+
+def test_read_file_from_repo_local_missing_file(tmp_work_dir):
+    with pytest.raises(GitFileNotFoundError):
+        read_file_from_repo(
+            REPO_FIXTURE,
+            "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74",
+            "no-such-file.yaml",
+        )
+
+
+def test_cat_file_process(tmp_path):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    repo_dir = tmp_path / "repo"
+    ensure_git_init(repo_dir)
+    fetch_commit(repo_dir, REPO_FIXTURE, commit_sha)
+    cat_file = CatFileProcess(repo_dir)
+
+    object_type, contents = cat_file.read(f"{commit_sha}:project.yaml")
+    assert object_type == "blob"
+    assert contents.startswith(b"version: '1.0'")
+    assert cat_file.read(f"{commit_sha}:missing file.txt") == (None, None)
+    assert cat_file.read(commit_sha)[0] == "commit"
+
+    # restarts if the process dies
+    cat_file.process.kill()
+    cat_file.process.wait()
+    assert cat_file.read(f"{commit_sha}:project.yaml")[1] == contents
+
+    cat_file.close()
+    assert cat_file.process is None
+
+
+def test_cat_file_process_bad_repo(tmp_path):
+    cat_file = CatFileProcess(tmp_path / "not-a-repo")
+    with pytest.raises(GitError):
+        cat_file.read("HEAD")
+
+
 def test_checkout_commit_local(tmp_work_dir, tmp_path):
     target_dir = tmp_path / "files"
     checkout_commit(
@@ -160,6 +220,62 @@ def test_get_sha_from_remote_ref_local_missing_repo(tmp_work_dir):
         get_sha_from_remote_ref(MISSING_REPO, "v1")
 
 
+def no_subprocesses(*args, **kwargs):
+    raise AssertionError(f"Unexpected subprocess call: {args}")
+
+
+def test_get_sha_from_remote_ref_local_cached(tmp_work_dir, monkeypatch):
+    sha = get_sha_from_remote_ref(REPO_FIXTURE, "v1")
+
+    # cached in memory and on disk, so this doesn't need to run git
+    with monkeypatch.context() as m:
+        m.setattr(git, "subprocess_run", no_subprocesses)
+        assert get_sha_from_remote_ref(REPO_FIXTURE, "v1") == sha
+        git.REF_CACHES.clear()
+        assert get_sha_from_remote_ref(REPO_FIXTURE, "v1") == sha
+        with pytest.raises(AssertionError):
+            get_sha_from_remote_ref(REPO_FIXTURE, "v1", use_cache=False)
+
+    # expired
+    monkeypatch.setattr(config, "GIT_REF_CACHE_TTL", -1)
+    monkeypatch.setattr(git, "subprocess_run", no_subprocesses)
+    with pytest.raises(AssertionError):
+        get_sha_from_remote_ref(REPO_FIXTURE, "v1")
+
+
+def test_ref_cache_set_prunes_entries(tmp_work_dir, monkeypatch, freezer):
+    monkeypatch.setattr(config, "GIT_REF_CACHE_TTL", 60)
+    monkeypatch.setattr(config, "GIT_REACHABILITY_CACHE_TTL", 60)
+    monkeypatch.setattr(git, "REF_CACHE_MAX_ENTRIES", 3)
+    git.ref_cache_set("expired", "sha")
+    git.ref_cache_set("reachable", True)
+    freezer.tick(61)
+    for key in ["a", "b", "c"]:
+        git.ref_cache_set(key, "sha")
+        freezer.tick(1)
+
+    cache = json.loads((config.GIT_REPO_DIR / git.REF_CACHE_FILE).read_text())
+    # the expired entry goes first, and then the oldest remaining one
+    assert set(cache) == {"a", "b", "c"}
+
+
+def test_commit_reachable_from_ref_local_cached(tmp_work_dir, monkeypatch):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    missing_sha = "0" * 40
+    assert commit_reachable_from_ref(REPO_FIXTURE, commit_sha, "v1")
+    assert not commit_reachable_from_ref(REPO_FIXTURE, missing_sha, "v1")
+
+    monkeypatch.setattr(git, "subprocess_run", no_subprocesses)
+    assert commit_reachable_from_ref(REPO_FIXTURE, commit_sha, "v1")
+    assert not commit_reachable_from_ref(REPO_FIXTURE, missing_sha, "v1")
+
+    # reachable commits stay cached indefinitely, unreachable ones don't
+    monkeypatch.setattr(config, "GIT_REACHABILITY_CACHE_TTL", -1)
+    assert commit_reachable_from_ref(REPO_FIXTURE, commit_sha, "v1")
+    with pytest.raises(AssertionError):
+        commit_reachable_from_ref(REPO_FIXTURE, missing_sha, "v1")
+
+
 def test_commit_already_fetched(tmp_path):
     commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
     repo_dir = tmp_path / "repo"
@@ -167,3 +283,233 @@ def test_commit_already_fetched(tmp_path):
     assert not commit_already_fetched(repo_dir, commit_sha)
     fetch_commit(repo_dir, REPO_FIXTURE, commit_sha)
     assert commit_already_fetched(repo_dir, commit_sha)
+
+
+def test_commit_already_fetched_uses_sentinel_tags(tmp_path):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    repo_dir = tmp_path / "repo"
+    ensure_git_init(repo_dir)
+    fetch_commit(repo_dir, REPO_FIXTURE, commit_sha)
+
+    # a fresh process only knows about the commit from the tags on disk
+    forget_fetched_commits(repo_dir)
+    assert commit_already_fetched(repo_dir, commit_sha)
+    assert not commit_already_fetched(repo_dir, "0" * 40)
+
+
+def test_commit_already_fetched_doesnt_rerun_git(tmp_path, mock_subprocess_run):
+    repo_dir = tmp_path / "repo"
+    ps = mock_subprocess_run.add_call(
+        [
+            "git",
+            "for-each-ref",
+            "--format=%(refname:strip=3) %(objectname)",
+            "refs/tags/fetched/",
+        ],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=str(repo_dir),
+    )
+    ps.stdout = f"{'a' * 40} {'a' * 40}\n{'b' * 40} {'c' * 40}\n"
+
+    assert commit_already_fetched(repo_dir, "a" * 40)
+    # tags which don't point at the named commit don't count
+    assert not commit_already_fetched(repo_dir, "b" * 40)
+
+    mock_subprocess_run.add_call(
+        ["git", "tag", "--force", "fetched/" + "d" * 40, "d" * 40],
+        check=True,
+        capture_output=True,
+        cwd=str(repo_dir),
+    )
+    mark_commmit_as_fetched(repo_dir, "d" * 40)
+    assert commit_already_fetched(repo_dir, "d" * 40)
+
+
+@pytest.fixture
+def large_repo(tmp_path):
+    """A local bare repo standing in for a GitHub repo with large committed files"""
+    work_tree = tmp_path / "large-repo-files"
+    (work_tree / "output").mkdir(parents=True)
+    (work_tree / "project.yaml").write_text("version: '3.0'\n")
+    (work_tree / "output" / "large.csv").write_text("x,y\n" * 10000)
+    repo_path = tmp_path / "large-repo.git"
+    env = {"GIT_WORK_TREE": str(work_tree), "GIT_DIR": str(repo_path)}
+    subprocess_run(["git", "init", "--bare", "--quiet", repo_path], check=True)
+    for key, value in [
+        ("user.email", "test@example.com"),
+        ("user.name", "Test"),
+        # as supported by GitHub
+        ("uploadpack.allowFilter", "true"),
+        ("uploadpack.allowAnySHA1InWant", "true"),
+    ]:
+        subprocess_run(["git", "config", key, value], check=True, env=env)
+    subprocess_run(["git", "add", "."], check=True, env=env)
+    subprocess_run(["git", "commit", "--quiet", "-m", "initial"], check=True, env=env)
+    response = subprocess_run(
+        ["git", "rev-parse", "HEAD"],
+        check=True,
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    return str(repo_path), response.stdout.strip()
+
+
+def missing_objects(repo_url, commit_sha):
+    response = subprocess_run(
+        ["git", "rev-list", "--objects", "--missing=print", commit_sha],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=get_local_repo_dir(repo_url),
+    )
+    return [line[1:] for line in response.stdout.splitlines() if line[0] == "?"]
+
+
+def test_partial_fetch_read_file_from_repo(tmp_work_dir, large_repo, monkeypatch):
+    monkeypatch.setattr(config, "GIT_PARTIAL_FETCH", True)
+    repo_url, commit_sha = large_repo
+
+    assert read_file_from_repo(repo_url, commit_sha, "project.yaml") == (
+        b"version: '3.0'\n"
+    )
+    # the large file hasn't been downloaded
+    assert len(missing_objects(repo_url, commit_sha)) == 1
+
+
+def test_partial_fetch_checkout_commit(tmp_work_dir, tmp_path, large_repo, monkeypatch):
+    monkeypatch.setattr(config, "GIT_PARTIAL_FETCH", True)
+    repo_url, commit_sha = large_repo
+    target_dir = tmp_path / "files"
+
+    checkout_commit(repo_url, commit_sha, target_dir)
+
+    # contents are fetched on demand
+    assert (target_dir / "output" / "large.csv").read_text() == "x,y\n" * 10000
+    assert missing_objects(repo_url, commit_sha) == []
+
+
+def test_sparse_checkout_commit(tmp_work_dir, tmp_path, large_repo, monkeypatch):
+    monkeypatch.setattr(config, "GIT_PARTIAL_FETCH", True)
+    monkeypatch.setattr(config, "GIT_CHECKOUT_EXCLUDE", ["output"])
+    repo_url, commit_sha = large_repo
+    target_dir = tmp_path / "files"
+
+    checkout_commit(repo_url, commit_sha, target_dir)
+
+    assert [f.name for f in target_dir.iterdir()] == ["project.yaml"]
+    assert len(missing_objects(repo_url, commit_sha)) == 1
+
+
+def test_partial_fetch_remote_not_written_to_config(
+    tmp_work_dir, large_repo, monkeypatch
+):
+    monkeypatch.setattr(config, "GIT_PARTIAL_FETCH", True)
+    repo_url, commit_sha = large_repo
+
+    read_file_from_repo(repo_url, commit_sha, "project.yaml")
+
+    # The remote URL (which may contain an access token) is only ever passed
+    # via the environment
+    repo_config = (get_local_repo_dir(repo_url) / "config").read_text()
+    assert "partialClone = origin" in repo_config
+    assert "[remote" not in repo_config
+
+
+def run_in_thread(target, *args):
+    """Start `target` in a thread, returning a function which waits for it and
+    returns a list of any errors raised"""
+    errors = []
+
+    def run():
+        try:
+            target(*args)
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+
+    def join():
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        return errors
+
+    return join
+
+
+def test_ensure_commit_fetched_coalesces_fetches(tmp_path, monkeypatch):
+    commit_sha = "cfbd0fe545d4e4c0747f0746adaa79ce5f8dfc74"
+    repo_dir = tmp_path / "repo"
+    fetches = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow_fetch_commit(repo_dir, repo_url, commit_sha):
+        fetches.append(commit_sha)
+        started.set()
+        release.wait(timeout=10)
+        fetch_commit(repo_dir, repo_url, commit_sha)
+
+    monkeypatch.setattr(git, "fetch_commit", slow_fetch_commit)
+
+    first = run_in_thread(ensure_commit_fetched, repo_dir, REPO_FIXTURE, commit_sha)
+    started.wait(timeout=10)
+    # everyone else turns up while the fetch is in progress
+    others = [
+        run_in_thread(ensure_commit_fetched, repo_dir, REPO_FIXTURE, commit_sha)
+        for _ in range(5)
+    ]
+    time.sleep(0.2)
+    release.set()
+
+    assert first() == []
+    assert [other() for other in others] == [[]] * 5
+    assert fetches == [commit_sha]
+    assert commit_already_fetched(repo_dir, commit_sha)
+
+
+def test_ensure_commit_fetched_shares_failures(tmp_path, monkeypatch):
+    repo_dir = tmp_path / "repo"
+    fetches = []
+    started = threading.Event()
+    waiting = threading.Event()
+
+    class WatchedFuture(git.Future):
+        def result(self, timeout=None):
+            waiting.set()
+            return super().result(timeout)
+
+    def failing_fetch_commit(repo_dir, repo_url, commit_sha):
+        fetches.append(commit_sha)
+        started.set()
+        # don't fail until the other caller is waiting on us
+        waiting.wait(timeout=10)
+        raise GitError("Network error")
+
+    monkeypatch.setattr(git, "Future", WatchedFuture)
+    monkeypatch.setattr(git, "fetch_commit", failing_fetch_commit)
+
+    first = run_in_thread(ensure_commit_fetched, repo_dir, REPO_FIXTURE, "a" * 40)
+    started.wait(timeout=10)
+    second = run_in_thread(ensure_commit_fetched, repo_dir, REPO_FIXTURE, "a" * 40)
+
+    assert [str(e) for e in first() + second()] == ["Network error"] * 2
+    assert fetches == ["a" * 40]
+
+
+def test_ensure_commit_fetched_different_repos_concurrently(tmp_path, monkeypatch):
+    # if fetches to different repos were serialised this would time out
+    barrier = threading.Barrier(2, timeout=5)
+    monkeypatch.setattr(git, "fetch_commit", lambda *args: barrier.wait())
+
+    first = run_in_thread(
+        ensure_commit_fetched, tmp_path / "repo1", REPO_FIXTURE, "a" * 40
+    )
+    second = run_in_thread(
+        ensure_commit_fetched, tmp_path / "repo2", REPO_FIXTURE, "a" * 40
+    )
+
+    assert first() + second() == []
@@ -0,0 +1,142 @@
+import gzip
+import sys
+
+import pytest
+
+from opensafely.jobrunner.executors import volumes
+from opensafely.jobrunner.lib import docker, log_capture
+
+
+def write_lines(path, lines, max_bytes, chunk_size=7):
+    data = b"".join(f"{line}\n".encode() for line in lines)
+    writer = log_capture.BoundedLogWriter(path, max_bytes)
+    for i in range(0, len(data), chunk_size):
+        writer.write(data[i : i + chunk_size])
+    writer.close()
+    return data
+
+
+def test_bounded_log_writer_under_budget(tmp_path):
+    path = tmp_path / "logs.txt"
+    data = write_lines(path, [f"line {i}" for i in range(10)], max_bytes=1000)
+    assert path.read_bytes() == data
+
+
+def test_bounded_log_writer_truncates_middle(tmp_path):
+    path = tmp_path / "logs.txt"
+    lines = [f"line {i:04}" for i in range(1000)]
+    data = write_lines(path, lines, max_bytes=200)
+
+    output = path.read_text()
+    head, marker, tail = output.partition("[... ")
+    assert marker
+    assert head.startswith("line 0000\nline 0001\n")
+    assert head.endswith("\n")
+    assert tail.endswith("line 0998\nline 0999\n")
+
+    marker_line, _, tail_lines = tail.partition("\n")
+    dropped = int(marker_line.split()[0])
+    # everything is accounted for
+    assert len(head) + dropped + len(tail_lines) == len(data)
+    # the tail only contains whole lines
+    assert tail_lines.splitlines()[0] in lines
+    # no blank lines, as they are used to delimit the log file metadata
+    assert "\n\n" not in output
+
+
+def test_bounded_log_writer_truncates_long_line(tmp_path):
+    path = tmp_path / "logs.txt"
+    write_lines(path, ["x" * 1000, "last"], max_bytes=100)
+
+    output = path.read_text()
+    assert output.startswith("x" * 50 + "\n[... ")
+    assert output.endswith("truncated ...]\nlast\n")
+    assert "\n\n" not in output
+
+
+def test_bounded_log_writer_does_not_modify_linked_copies(tmp_path):
+    path = tmp_path / "logs.txt"
+    write_lines(path, ["first run"], max_bytes=1000)
+    published = tmp_path / "published" / "logs.txt"
+    volumes.link_or_copy_file(path, published)
+
+    writer = log_capture.BoundedLogWriter(path, 1000)
+    writer.write(b"second run\n")
+    # the previous logs are untouched while the new ones are being written
+    assert path.read_text() == "first run\n"
+    writer.close()
+
+    assert path.read_text() == "second run\n"
+    assert published.read_text() == "first run\n"
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_bounded_log_writer_abandoned(tmp_path):
+    path = tmp_path / "logs.txt"
+    path.write_text("written by someone else\n")
+
+    writer = log_capture.BoundedLogWriter(path, 1000)
+    writer.write(b"stale logs\n")
+    writer.abandon()
+    writer.close()
+
+    assert path.read_text() == "written by someone else\n"
+    assert list(tmp_path.glob("*.tmp")) == []
+
+
+def test_stream_logs(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        log_capture,
+        "logs_command",
+        lambda container_name, follow: [sys.executable, "-c", "print('hello')"],
+    )
+    path = tmp_path / "logs.txt"
+    writer = log_capture.BoundedLogWriter(path, 1000)
+
+    assert log_capture.stream_logs("container", writer, timeout=10)
+    assert path.read_text() == "hello\n"
+
+
+def test_stream_logs_timeout(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        log_capture,
+        "logs_command",
+        lambda container_name, follow: [
+            sys.executable,
+            "-c",
+            "import time; print('hello', flush=True); time.sleep(60)",
+        ],
+    )
+    path = tmp_path / "logs.txt"
+    writer = log_capture.BoundedLogWriter(path, 1000)
+
+    with pytest.raises(docker.DockerTimeoutError):
+        log_capture.stream_logs("container", writer, timeout=0.5)
+    # we keep whatever we got
+    assert path.read_text() == "hello\n"
+
+
+def test_write_compressed_copy(tmp_path):
+    path = tmp_path / "logs.txt"
+    path.write_text("some logs\n" * 100)
+
+    compressed = log_capture.write_compressed_copy(path)
+
+    assert compressed == tmp_path / "logs.txt.gz"
+    assert gzip.decompress(compressed.read_bytes()) == path.read_bytes()
+
+
+def test_link_or_copy_file(tmp_path):
+    src = tmp_path / "src.txt"
+    src.write_text("logs")
+    dst = tmp_path / "other" / "dst.txt"
+
+    assert volumes.link_or_copy_file(src, dst) == 4
+    assert dst.read_text() == "logs"
+    assert dst.stat().st_ino == src.stat().st_ino
+
+    # replaces existing files
+    src2 = tmp_path / "src2.txt"
+    src2.write_text("new logs")
+    volumes.link_or_copy_file(src2, dst)
+    assert dst.read_text() == "new logs"
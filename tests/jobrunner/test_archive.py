@@ -0,0 +1,164 @@
+import random
+import time
+
+from opensafely.jobrunner import archive, config
+from opensafely.jobrunner.cli import archive_jobs as archive_jobs_cli
+from opensafely.jobrunner.create_or_update_jobs import related_jobs_exist
+from opensafely.jobrunner.lib import database
+from opensafely.jobrunner.models import Job, State
+from opensafely.jobrunner.queries import (
+    calculate_workspace_state,
+    iter_workspace_state,
+)
+from tests.jobrunner.factories import job_factory, job_request_factory
+
+
+DAY = 24 * 60 * 60
+
+
+def old_job(days=100, **kwargs):
+    kwargs.setdefault("state", State.SUCCEEDED)
+    timestamp = int(time.time()) - days * DAY
+    kwargs.setdefault("completed_at", timestamp)
+    return job_factory(created_at=timestamp, **kwargs)
+
+
+def archived_ids():
+    conn = database.get_connection(config.ARCHIVE_DATABASE_FILE)
+    return {row[0] for row in conn.execute("SELECT id FROM job")}
+
+
+def test_archive_jobs(tmp_work_dir):
+    superseded = old_job(action="action", outputs={"output.csv": "moderately"})
+    latest = old_job(days=99, action="action")
+    recent = job_factory(action="other", state=State.SUCCEEDED)
+
+    assert archive.archive_jobs(after_days=30) == 1
+
+    assert set(database.select_values(Job, "id")) == {latest.id, recent.id}
+    assert archived_ids() == {superseded.id}
+    conn = database.get_connection(config.ARCHIVE_DATABASE_FILE)
+    row = conn.execute("SELECT outputs FROM job").fetchone()
+    assert row[0] == '{"output.csv": "moderately"}'
+
+
+def test_archive_jobs_keeps_workspace_state(tmp_work_dir):
+    for action in ["action1", "action2"]:
+        old_job(days=101, action=action, state=State.FAILED)
+        old_job(action=action)
+    # cancelled jobs don't count towards the workspace state, so the job
+    # before this one has to be kept
+    old_job(days=99, action="action2", cancelled=True)
+    before = {job.id for job in calculate_workspace_state("workspace")}
+
+    assert archive.archive_jobs(after_days=30) == 3
+
+    assert {job.id for job in calculate_workspace_state("workspace")} == before
+
+
+def test_archive_jobs_never_changes_latest_jobs(tmp_work_dir):
+    # Readers of the latest job for each action only look in the live table,
+    # so archiving must never change what they see
+    rng = random.Random(42)
+    workspaces = ["workspace1", "workspace2"]
+    actions = ["action1", "action2", "action3", "__error__"]
+    for _ in range(100):
+        old_job(
+            days=rng.randint(31, 200),
+            workspace=rng.choice(workspaces),
+            action=rng.choice(actions),
+            state=rng.choice(archive.ARCHIVED_STATES),
+            cancelled=rng.random() < 0.2,
+        )
+
+    def latest_jobs():
+        return {
+            (workspace, action): [
+                job.id for job in iter_workspace_state(workspace, action=action)
+            ]
+            for workspace in workspaces
+            for action in actions
+        } | {
+            workspace: [job.id for job in calculate_workspace_state(workspace)]
+            for workspace in workspaces
+        }
+
+    before = latest_jobs()
+
+    assert archive.archive_jobs(after_days=30) > 0
+
+    assert latest_jobs() == before
+
+
+def test_archive_jobs_keeps_awaited_jobs(tmp_work_dir):
+    awaited = old_job(days=101, action="action")
+    old_job(action="action")
+    job_factory(action="other", wait_for_job_ids=[awaited.id])
+
+    assert archive.archive_jobs(after_days=30) == 0
+
+
+def test_archive_jobs_ignores_unfinished_jobs(tmp_work_dir):
+    old_job(days=101, action="action", state=State.PENDING)
+    old_job(action="action")
+
+    assert archive.archive_jobs(after_days=30) == 0
+
+
+def test_archive_jobs_uses_completion_time(tmp_work_dir):
+    # created long ago, but only just finished
+    old_job(days=101, action="action", completed_at=int(time.time()))
+    # finished, but we don't know when
+    old_job(days=101, action="action", completed_at=None)
+    old_job(action="action")
+
+    assert archive.archive_jobs(after_days=30) == 0
+
+
+def test_archive_jobs_in_batches(tmp_work_dir):
+    jobs = [old_job(days=100 + i, action="action") for i in range(7)]
+
+    assert archive.archive_jobs(after_days=30, batch_size=2) == 6
+
+    assert database.select_values(Job, "id") == [jobs[0].id]
+    assert len(archived_ids()) == 6
+
+
+def test_move_jobs_skips_jobs_changed_since_copying(tmp_work_dir, monkeypatch):
+    job = old_job(days=101, action="action")
+    old_job(action="action")
+    conn = archive.attach_archive()
+    transaction = database.transaction
+    calls = []
+
+    def modify_between_transactions():
+        calls.append(None)
+        if len(calls) == 2:
+            database.update_where(Job, {"cancelled": True}, id=job.id)
+        return transaction()
+
+    monkeypatch.setattr(database, "transaction", modify_between_transactions)
+
+    assert archive.move_jobs(conn, [job.id]) == 0
+    assert database.exists_where(Job, id=job.id)
+
+
+def test_archived_job_exists(tmp_work_dir):
+    assert not archive.archived_job_exists(job_request_id="request")
+
+    job_request = job_request_factory()
+    old_job(days=101, job_request=job_request)
+    old_job()
+    archive.archive_jobs(after_days=30)
+
+    assert archive.archived_job_exists(job_request_id=job_request.id)
+    assert related_jobs_exist(job_request)
+
+
+def test_archive_jobs_cli(tmp_work_dir, capsys):
+    old_job(days=101, action="action")
+    old_job(action="action")
+
+    archive_jobs_cli.run(["--after-days", "30"])
+
+    assert capsys.readouterr().out == "Archived 1 jobs\n"
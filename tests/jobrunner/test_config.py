@@ -6,7 +6,11 @@ from pathlib import Path
 
 import pytest
 
-from opensafely.jobrunner.config import _is_valid_backend_name, database_urls_from_env
+from opensafely.jobrunner.config import (
+    _is_valid_backend_name,
+    database_urls_from_env,
+    parse_database_pragmas,
+)
 
 
 script = """
@@ -139,3 +143,31 @@ def test_database_urls_from_env():
         "default": "mssql://localhost/db1",
         "include_t1oo": "mssql://localhost/db2",
     }
+
+
+def test_parse_database_pragmas():
+    assert parse_database_pragmas("") == {}
+    assert parse_database_pragmas("cache_size=-32000, synchronous = NORMAL") == {
+        "cache_size": "-32000",
+        "synchronous": "NORMAL",
+    }
+
+
+@pytest.mark.parametrize("value", ["cache_size", "cache_size=1;DROP TABLE job"])
+def test_parse_database_pragmas_invalid(value):
+    with pytest.raises(RuntimeError):
+        parse_database_pragmas(value)
+
+
+def test_config_invalid_database_profile():
+    with pytest.raises(subprocess.CalledProcessError) as err:
+        import_cfg({"DATABASE_PROFILE": "reckless"})
+
+    assert "DATABASE_PROFILE must be durable or fast" in err.value.stderr
+
+
+def test_config_invalid_loop_spans():
+    with pytest.raises(subprocess.CalledProcessError) as err:
+        import_cfg({"LOOP_SPANS": "some"})
+
+    assert "LOOP_SPANS must be all or changes" in err.value.stderr
@@ -1,10 +1,13 @@
+import json
 import re
 import uuid
 from pathlib import Path
 from unittest import mock
 
 import pytest
+from opensafely._vendor.pipeline import load_pipeline
 
+from opensafely.jobrunner.actions import DependencyCycleError
 from opensafely.jobrunner.create_or_update_jobs import (
     JobRequestError,
     NothingToDoError,
@@ -12,6 +15,7 @@ from opensafely.jobrunner.create_or_update_jobs import (
     create_job_from_exception,
     create_jobs,
     create_or_update_jobs,
+    get_new_jobs_to_run,
     validate_job_request,
 )
 from opensafely.jobrunner.lib.database import find_one, update_where
@@ -396,3 +400,57 @@ def test_create_or_update_jobs_with_out_of_date_codelists(
             create_jobs_with_project_file(job_request, project)
     else:
         assert create_jobs_with_project_file(job_request, project) == 1
+
+
+def test_get_new_jobs_to_run_detects_dependency_cycles():
+    project = """
+version: '3.0'
+expectations:
+  population_size: 1000
+actions:
+  a:
+    run: python:latest a.py
+    needs: [b]
+    outputs:
+      moderately_sensitive:
+        a: a.txt
+  b:
+    run: python:latest b.py
+    needs: [a]
+    outputs:
+      moderately_sensitive:
+        b: b.txt
+"""
+    with pytest.raises(DependencyCycleError, match="a -> b -> a"):
+        get_new_jobs_to_run(make_job_request(action="a"), load_pipeline(project), [])
+
+
+@pytest.mark.slow_test
+def test_get_new_jobs_to_run_long_dependency_chain():
+    # deep enough that a recursive walk would hit the recursion limit
+    count = 1500
+    actions = {
+        f"action_{i}": {
+            "run": f"python:latest action_{i}.py",
+            "needs": [f"action_{i - 1}"] if i else [],
+            "outputs": {"moderately_sensitive": {"output": f"output_{i}.txt"}},
+        }
+        for i in range(count)
+    }
+    project = json.dumps(
+        {
+            "version": "3.0",
+            "expectations": {"population_size": 1000},
+            "actions": actions,
+        }
+    )
+    job_request = make_job_request(action=f"action_{count - 1}")
+
+    jobs = get_new_jobs_to_run(job_request, load_pipeline(project), [])
+
+    assert len(jobs) == count
+    jobs_by_action = {job.action: job for job in jobs}
+    assert jobs_by_action["action_0"].wait_for_job_ids == []
+    for i in range(1, count):
+        job = jobs_by_action[f"action_{i}"]
+        assert job.wait_for_job_ids == [jobs_by_action[f"action_{i - 1}"].id]
@@ -0,0 +1,116 @@
+import time
+
+from opensafely.jobrunner import config, git_maintenance
+from opensafely.jobrunner.cli import git_maintenance as git_maintenance_cli
+from opensafely.jobrunner.lib import git
+from opensafely.jobrunner.lib.subprocess_utils import subprocess_run
+from opensafely.jobrunner.models import State
+from tests.jobrunner.factories import job_factory
+
+
+def make_commits(tmp_path, count):
+    """Make a local bare repo with `count` commits, returning its path and shas"""
+    work_tree = tmp_path / "source-files"
+    work_tree.mkdir()
+    repo_path = tmp_path / "source.git"
+    env = {"GIT_WORK_TREE": str(work_tree), "GIT_DIR": str(repo_path)}
+    subprocess_run(["git", "init", "--bare", "--quiet", repo_path], check=True)
+    subprocess_run(["git", "config", "user.email", "test@example.com"], env=env)
+    subprocess_run(["git", "config", "user.name", "Test"], env=env)
+    shas = []
+    for i in range(count):
+        # unique content per commit, so each has objects of its own
+        (work_tree / "project.yaml").write_text(f"version: '{i}'\n" * 1000)
+        subprocess_run(["git", "add", "."], check=True, env=env)
+        subprocess_run(
+            ["git", "commit", "--quiet", "-m", f"commit {i}"], check=True, env=env
+        )
+        response = subprocess_run(
+            ["git", "rev-parse", "HEAD"], check=True, env=env, capture_output=True
+        )
+        shas.append(response.stdout.decode().strip())
+    return str(repo_path), shas
+
+
+def object_exists(repo_dir, sha):
+    response = subprocess_run(
+        ["git", "cat-file", "-e", f"{sha}^{{commit}}"], cwd=repo_dir
+    )
+    return response.returncode == 0
+
+
+def test_maintain_repos(tmp_work_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "GIT_MAINTENANCE_GRACE_PERIOD", 0)
+    repo_url, (old, recent, active) = make_commits(tmp_path, 3)
+    repo_dir = git.get_local_repo_dir(repo_url)
+    for sha in [old, recent, active]:
+        git.ensure_commit_fetched(repo_dir, repo_url, sha)
+
+    long_ago = int(time.time()) - 60 * 24 * 60 * 60
+    job_factory(
+        repo_url=repo_url, commit=old, state=State.SUCCEEDED, created_at=long_ago
+    )
+    job_factory(repo_url=repo_url, commit=recent, state=State.SUCCEEDED)
+    job_factory(
+        repo_url=repo_url, commit=active, state=State.RUNNING, created_at=long_ago
+    )
+
+    (result,) = git_maintenance.maintain_repos(keep_days=30)
+
+    assert result.repo_dir == repo_dir
+    assert result.tags_pruned == 1
+    assert result.reclaimed == result.size_before - result.size_after
+    assert result.duration > 0
+
+    assert not git.commit_already_fetched(repo_dir, old)
+    assert not object_exists(repo_dir, old)
+    for sha in [recent, active]:
+        assert git.commit_already_fetched(repo_dir, sha)
+        assert object_exists(repo_dir, sha)
+
+    # and we can still fetch the pruned commit again
+    git.ensure_commit_fetched(repo_dir, repo_url, old)
+    assert object_exists(repo_dir, old)
+
+
+def test_maintain_repos_cli(tmp_work_dir, tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(config, "GIT_MAINTENANCE_GRACE_PERIOD", 0)
+    repo_url, (sha,) = make_commits(tmp_path, 1)
+    git.ensure_commit_fetched(git.get_local_repo_dir(repo_url), repo_url, sha)
+
+    git_maintenance_cli.run([])
+
+    assert capsys.readouterr().out.startswith("Reclaimed ")
+    assert not git.commit_already_fetched(git.get_local_repo_dir(repo_url), sha)
+
+
+def test_maintain_repos_keeps_recently_used_commits(
+    tmp_work_dir, tmp_path, monkeypatch
+):
+    monkeypatch.setattr(config, "GIT_MAINTENANCE_GRACE_PERIOD", 60)
+    repo_url, (sha,) = make_commits(tmp_path, 1)
+    repo_dir = git.get_local_repo_dir(repo_url)
+    # we read the project file before there are any jobs using the commit
+    git.read_file_from_repo(repo_url, sha, "project.yaml")
+
+    (result,) = git_maintenance.maintain_repos(keep_days=30)
+
+    assert result.tags_pruned == 0
+    assert git.commit_already_fetched(repo_dir, sha)
+    git.checkout_commit(repo_url, sha, tmp_path / "checkout")
+    assert (tmp_path / "checkout" / "project.yaml").exists()
+
+
+def test_maintain_repos_forgets_commits_used_before_grace_period(
+    tmp_work_dir, tmp_path, monkeypatch, freezer
+):
+    monkeypatch.setattr(config, "GIT_MAINTENANCE_GRACE_PERIOD", 60)
+    repo_url, (sha,) = make_commits(tmp_path, 1)
+    repo_dir = git.get_local_repo_dir(repo_url)
+    git.read_file_from_repo(repo_url, sha, "project.yaml")
+    freezer.tick(61)
+
+    (result,) = git_maintenance.maintain_repos(keep_days=30)
+
+    assert result.tags_pruned == 1
+    assert sha not in git.COMMITS_LAST_USED[repo_dir]
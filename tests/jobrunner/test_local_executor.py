@@ -14,7 +14,10 @@ from opensafely.jobrunner.job_executor import (
 )
 from opensafely.jobrunner.lib import datestr_to_ns_timestamp, docker
 from tests.jobrunner.conftest import SUPPORTED_VOLUME_APIS
-from tests.jobrunner.factories import ensure_docker_images_present
+from tests.jobrunner.factories import (
+    ensure_docker_images_present,
+    job_results_factory,
+)
 
 
 # this is parametized fixture, and test using it will run multiple times, once
@@ -957,6 +960,100 @@ def test_delete_files_bad_privacy(tmp_work_dir):
         api.delete_files("test", None, ["file.txt"])
 
 
+def test_results_persisted_across_restart(job_definition, tmp_work_dir):
+    results = job_results_factory(
+        outputs={"output/dataset.csv": "highly_sensitive"},
+        level4_excluded_files={"output/summary.txt": "too big"},
+    )
+    local.write_results(job_definition, results)
+    assert local.get_results_file(job_definition).exists()
+
+    # simulate a restart of the job-runner
+    local.RESULTS.clear()
+
+    api = local.LocalDockerAPI()
+    assert api.get_results(job_definition) == results
+    assert job_definition.id in local.RESULTS
+
+
+def test_load_results_reads_results_file(job_definition, tmp_work_dir):
+    results = job_results_factory()
+    local.write_results(job_definition, results)
+    results_file = local.get_results_file(job_definition)
+    assert results_file == (
+        config.JOB_LOG_DIR / local.RESULTS_DIR / f"{job_definition.id}.json"
+    )
+
+    local.RESULTS.clear()
+    assert local.load_results(job_definition) == results
+
+    # nothing is loaded once the file has gone
+    results_file.unlink()
+    local.RESULTS.clear()
+    assert local.load_results(job_definition) is None
+
+
+def test_results_not_finalized(job_definition, tmp_work_dir):
+    api = local.LocalDockerAPI()
+    status = api.get_results(job_definition)
+    assert status.state == ExecutorState.ERROR
+    assert local.load_results(job_definition) is None
+
+
+def test_delete_files_compressed(tmp_work_dir):
+    compressed = populate_workspace("test", "file.csv.zst")
+
+    api = local.LocalDockerAPI()
+    errors = api.delete_files("test", Privacy.HIGH, ["file.csv"])
+
+    assert errors == []
+    assert not compressed.exists()
+
+
+def test_persist_outputs_compressed(job_definition, tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(volumes, "DEFAULT_VOLUME_API", volumes.BindMountVolumeAPI)
+    monkeypatch.setattr(config, "COMPRESS_HIGHLY_SENSITIVE_OUTPUTS", True)
+    monkeypatch.setattr(config, "COMPRESSION_MIN_SIZE", 100)
+
+    contents = "patient_id,age\n" + "1,42\n" * 100
+    volume = volumes.host_volume_path(job_definition)
+    (volume / "output").mkdir(parents=True)
+    (volume / "output/dataset.csv").write_text(contents)
+    (volume / "output/small.csv").write_text("patient_id\n")
+    (volume / "output/summary.csv").write_text(contents)
+    outputs = {
+        "output/dataset.csv": "highly_sensitive",
+        "output/small.csv": "highly_sensitive",
+        "output/summary.csv": "moderately_sensitive",
+    }
+    job_definition.level4_max_csv_rows = 1000
+
+    local.persist_outputs(job_definition, outputs, {})
+
+    workspace = local.get_high_privacy_workspace(job_definition.workspace)
+    assert not (workspace / "output/dataset.csv").exists()
+    assert (workspace / "output/dataset.csv.zst").exists()
+    assert (workspace / "output/small.csv").exists()
+    assert (workspace / "output/summary.csv").exists()
+
+    level4_dir = local.get_medium_privacy_workspace(job_definition.workspace)
+    manifest = local.read_manifest_file(level4_dir, job_definition.workspace)
+    metadata = manifest["outputs"]["output/dataset.csv"]
+    assert metadata["size"] == len(contents)
+    assert metadata["compressed_size"] == (
+        (workspace / "output/dataset.csv.zst").stat().st_size
+    )
+    assert manifest["outputs"]["output/small.csv"]["compressed_size"] is None
+
+    # a downstream job gets the decompressed file in its volume
+    job_definition.id = "downstream"
+    job_definition.inputs = ["output/dataset.csv"]
+    volumes.BindMountVolumeAPI.create_volume(job_definition)
+    local.prepare_job(job_definition)
+    volume = volumes.host_volume_path(job_definition)
+    assert (volume / "output/dataset.csv").read_text() == contents
+
+
 @pytest.mark.needs_docker
 def test_get_status_timeout(tmp_work_dir, job_definition, monkeypatch):
     def inspect(*args, **kwargs):
@@ -0,0 +1,135 @@
+import time
+
+from opensafely.jobrunner import config, metrics
+from opensafely.jobrunner.lib import docker
+
+
+DAY = 24 * 60 * 60
+
+
+def usage(cpu, memory, block_read=0, block_write=0):
+    return {
+        "cpu_percentage": cpu,
+        "memory_used": memory,
+        "block_read": block_read,
+        "block_write": block_write,
+    }
+
+
+def samples():
+    conn = metrics.get_connection()
+    rows = conn.execute(
+        "SELECT * FROM job_sample ORDER BY job_id, resolution, timestamp"
+    )
+    return [dict(row) for row in rows]
+
+
+def test_get_connection_creates_schema_once(tmp_work_dir):
+    conn = metrics.get_connection()
+    conn.execute("DROP TABLE job_sample")
+
+    # the schema isn't recreated on every call
+    assert metrics.get_connection() is conn
+    assert not conn.execute(
+        "SELECT name FROM sqlite_master WHERE name = 'job_sample'"
+    ).fetchall()
+
+
+def test_record_stats(tmp_work_dir, monkeypatch, freezer):
+    monkeypatch.setattr(config, "STATS_POLL_INTERVAL", 10)
+    stats = {
+        "os-job-abc": usage(50.0, 1000, 10, 20),
+        "some-other-container": usage(100.0, 2000),
+    }
+    monkeypatch.setattr(
+        docker,
+        "container_stats",
+        lambda timeout, prefix: {
+            name: usage for name, usage in stats.items() if name.startswith(prefix)
+        },
+    )
+
+    assert metrics.record_stats() == 1
+
+    assert samples() == [
+        {
+            "job_id": "abc",
+            "resolution": 0,
+            "timestamp": int(time.time()),
+            "duration": 10,
+            "cpu_percentage": 50.0,
+            "cpu_peak": 50.0,
+            "memory_used": 1000,
+            "block_read": 10,
+            "block_write": 20,
+        }
+    ]
+
+
+def test_get_job_metrics(tmp_work_dir, monkeypatch, freezer):
+    monkeypatch.setattr(config, "STATS_POLL_INTERVAL", 10)
+    assert metrics.get_job_metrics("abc") == {}
+
+    for cpu, memory in [(20.0, 3000), (60.0, 1000)]:
+        monkeypatch.setattr(
+            docker,
+            "container_stats",
+            lambda timeout, prefix: {"os-job-abc": usage(cpu, memory)},
+        )
+        metrics.record_stats()
+        freezer.tick(10)
+
+    assert metrics.get_job_metrics("abc") == {
+        "duration": 20,
+        "cpu_mean": 40.0,
+        "cpu_peak": 60.0,
+        "cpu_sample": 60.0,
+        "mem_peak": 3000,
+        "mem_sample": 1000,
+        "block_read": 0,
+        "block_write": 0,
+    }
+    assert metrics.get_job_metrics("other") == {}
+
+
+def test_compact_stats(tmp_work_dir, monkeypatch):
+    monkeypatch.setattr(config, "METRICS_DOWNSAMPLE_AFTER_DAYS", 1)
+    monkeypatch.setattr(config, "METRICS_DOWNSAMPLE_INTERVAL", 300)
+    monkeypatch.setattr(config, "METRICS_RETENTION_DAYS", 30)
+    now = 100 * DAY
+    conn = metrics.get_connection()
+    rows = [
+        # expired
+        ("abc", now - 31 * DAY, 10, 50.0, 100),
+        # downsampled together
+        ("abc", now - 2 * DAY, 10, 20.0, 100),
+        ("abc", now - 2 * DAY + 10, 30, 60.0, 300),
+        # recent
+        ("abc", now - 10, 10, 10.0, 100),
+    ]
+    conn.executemany(
+        """
+        INSERT INTO job_sample (
+            job_id, resolution, timestamp, duration, cpu_percentage, cpu_peak,
+            memory_used, block_read, block_write
+        ) VALUES (?, 0, ?, ?, ?, ?, ?, 0, 0)
+        """,
+        [
+            (job_id, ts, duration, cpu, cpu, mem)
+            for job_id, ts, duration, cpu, mem in rows
+        ],
+    )
+
+    metrics.compact_stats(now)
+
+    assert [
+        (row["resolution"], row["timestamp"], row["duration"], row["cpu_percentage"])
+        for row in samples()
+    ] == [
+        (0, now - 10, 10, 10.0),
+        (300, now - 2 * DAY, 40, 50.0),
+    ]
+    # downsampling the same period again changes nothing
+    before = samples()
+    metrics.compact_stats(now + 60)
+    assert samples() == before
@@ -1,7 +1,12 @@
+import sqlite3
 import time
+from unittest import mock
 
-from opensafely.jobrunner.lib.database import get_connection
-from opensafely.jobrunner.queries import get_flag_value, set_flag
+from opensafely.jobrunner import config, queries
+from opensafely.jobrunner.lib.database import get_connection, update_where
+from opensafely.jobrunner.models import Job, State
+from opensafely.jobrunner.queries import get_active_jobs, get_flag_value, set_flag
+from tests.jobrunner.factories import job_factory
 
 
 def test_get_flag_no_table_does_not_error(tmp_work_dir):
@@ -28,3 +33,52 @@ def test_set_flag(tmp_work_dir):
     assert ts1 == ts2
     set_flag("foo", None)
     assert get_flag_value("foo") is None
+
+
+def test_get_flag_value_sees_writes_from_other_connections(tmp_work_dir):
+    assert get_flag_value("paused") is None
+
+    # e.g. an operator setting a flag from the command line
+    other = sqlite3.connect(config.DATABASE_FILE, isolation_level=None)
+    other.execute("INSERT INTO flags (id, value) VALUES ('paused', 'true')")
+
+    assert get_flag_value("paused") == "true"
+
+
+def test_get_flag_value_cached(tmp_work_dir, monkeypatch):
+    set_flag("foo", "bar")
+    assert get_flag_value("foo") == "bar"
+
+    fetch = mock.Mock(side_effect=AssertionError("should not query"))
+    monkeypatch.setattr(queries.FLAGS, "fetch", fetch)
+    assert get_flag_value("foo") == "bar"
+    assert get_flag_value("other", "default") == "default"
+
+
+def test_get_active_jobs(tmp_work_dir):
+    pending = job_factory(
+        state=State.PENDING, action="pending", wait_for_job_ids=[], outputs={}
+    )
+    job_factory(state=State.SUCCEEDED, action="succeeded")
+
+    (job,) = get_active_jobs()
+    assert job.id == pending.id
+
+    # callers get their own copies
+    job.status_message = "modified"
+    assert get_active_jobs()[0].status_message != "modified"
+    # including of the JSON fields, even once the cached jobs have been decoded
+    (cached,) = queries.ACTIVE_JOBS.get()
+    assert cached.wait_for_job_ids == [] and cached.outputs == {}
+    (job,) = get_active_jobs()
+    job.wait_for_job_ids.append("modified")
+    job.outputs["modified"] = "highly_sensitive"
+    (job,) = get_active_jobs()
+    assert "modified" not in job.wait_for_job_ids
+    assert "modified" not in job.outputs
+
+    running = job_factory(state=State.RUNNING, action="running")
+    assert {job.id for job in get_active_jobs()} == {pending.id, running.id}
+
+    update_where(Job, {"state": State.FAILED}, id=pending.id)
+    assert [job.id for job in get_active_jobs()] == [running.id]
@@ -1,3 +1,4 @@
+from types import SimpleNamespace
 from unittest import mock
 
 import pytest
@@ -8,6 +9,7 @@ from opensafely.jobrunner.lib.yaml_utils import YAMLError
 from opensafely.jobrunner.reusable_actions import ReusableAction
 
 
+@pytest.mark.usefixtures("tmp_work_dir")
 @mock.patch.multiple(
     "opensafely.jobrunner.lib.git",
     get_sha_from_remote_ref=mock.DEFAULT,
@@ -122,3 +124,68 @@ class TestHandleReusableAction:
         )
         with pytest.raises(reusable_actions.ReusableActionError):
             reusable_actions.apply_reusable_action(["foo:v1"], reusable_action)
+
+
+def reusable_action(image, tag):
+    return ReusableAction(
+        repo_url=f"https://github.com/opensafely-actions/{image}",
+        commit=f"{image}-{tag}-sha",
+        action_file=b"run: python:latest python main.py",
+    )
+
+
+def test_resolve_reusable_action_references_deduplicates():
+    jobs = [
+        SimpleNamespace(action=f"action_{i}", run_command=run_command)
+        for i, run_command in enumerate(
+            [
+                "action-a:v1 one",
+                "python:latest python analysis.py",
+                "action-a:v1 two",
+                "action-b:v2",
+                "action-a:v2",
+                "action-b:v2",
+            ]
+        )
+    ]
+    with mock.patch(
+        "opensafely.jobrunner.reusable_actions.fetch_reusable_action",
+        side_effect=reusable_action,
+    ) as fetch:
+        reusable_actions.resolve_reusable_action_references(jobs)
+
+    assert sorted(call.args for call in fetch.call_args_list) == [
+        ("action-a", "v1"),
+        ("action-a", "v2"),
+        ("action-b", "v2"),
+    ]
+    assert [(job.run_command, job.action_commit) for job in jobs] == [
+        ("python:latest python main.py one", "action-a-v1-sha"),
+        ("python:latest python analysis.py", None),
+        ("python:latest python main.py two", "action-a-v1-sha"),
+        ("python:latest python main.py", "action-b-v2-sha"),
+        ("python:latest python main.py", "action-a-v2-sha"),
+        ("python:latest python main.py", "action-b-v2-sha"),
+    ]
+
+
+def test_resolve_reusable_action_references_error_context():
+    def fetch(image, tag):
+        if image == "action-b":
+            raise reusable_actions.ReusableActionError("it broke")
+        return reusable_action(image, tag)
+
+    jobs = [
+        SimpleNamespace(action="first", run_command="action-a:v1"),
+        SimpleNamespace(action="second", run_command="action-b:v1"),
+        SimpleNamespace(action="third", run_command="action-b:v1"),
+    ]
+    with mock.patch(
+        "opensafely.jobrunner.reusable_actions.fetch_reusable_action",
+        side_effect=fetch,
+    ):
+        with pytest.raises(
+            reusable_actions.ReusableActionError,
+            match="^in 'second: action-b:v1' it broke$",
+        ):
+            reusable_actions.resolve_reusable_action_references(jobs)
@@ -4,7 +4,8 @@ import pytest
 
 from opensafely.jobrunner import config, run
 from opensafely.jobrunner.job_executor import ExecutorState, JobStatus, Privacy
-from opensafely.jobrunner.models import State, StatusCode
+from opensafely.jobrunner.lib.database import find_one, get_connection, update_where
+from opensafely.jobrunner.models import Job, State, StatusCode
 from opensafely.jobrunner.tracing import trace
 from tests.jobrunner.factories import StubExecutorAPI, get_trace, job_factory
 from tests.jobrunner.fakes import RecordingExecutor
@@ -318,6 +319,105 @@ def test_handle_job_stable_states(executor_state, status_code, message, db):
     assert len(get_trace("jobs")) == 0
 
 
+def test_handle_jobs_writes_heartbeats_together(db, monkeypatch, freezer):
+    api = StubExecutorAPI()
+    jobs = [
+        api.add_test_job(
+            ExecutorState.EXECUTING,
+            State.RUNNING,
+            StatusCode.EXECUTING,
+            status_message="Executing job on the backend",
+            action=action,
+        )
+        for action in ["action1", "action2"]
+    ]
+    freezer.tick(61)
+    updates = []
+    update_job = run.update_job
+
+    def recording_update_job(job):
+        updates.append((job.id, get_connection().in_transaction))
+        update_job(job)
+
+    monkeypatch.setattr(run, "update_job", recording_update_job)
+
+    run.handle_jobs(api)
+
+    # both timestamps are written at the end, inside a transaction
+    assert updates == [(job.id, True) for job in jobs]
+    assert not run.PENDING_HEARTBEATS
+    for job in jobs:
+        assert find_one(Job, id=job.id).updated_at == int(time.time())
+
+
+def test_handle_jobs_only_records_loop_spans_for_changes(db, monkeypatch):
+    monkeypatch.setattr(config, "LOOP_SPANS", "changes")
+    api = StubExecutorAPI()
+    unchanged = api.add_test_job(
+        ExecutorState.EXECUTING,
+        State.RUNNING,
+        StatusCode.EXECUTING,
+        status_message="Executing job on the backend",
+        action="action1",
+    )
+    changed = api.add_test_job(ExecutorState.UNKNOWN, State.PENDING, action="action2")
+
+    run.handle_jobs(api)
+
+    spans = get_trace("loop")
+    assert [span.name for span in spans] == ["LOOP_JOB", "LOOP"]
+    assert spans[0].attributes["job.id"] == changed.id
+    assert spans[1].attributes["loop.unrecorded_jobs"] == 1
+    assert spans[1].attributes["loop.unrecorded_jobs.EXECUTING"] == 1
+    assert not run.UNRECORDED_LOOP_SPANS
+    assert unchanged.status_code == StatusCode.EXECUTING
+
+
+def test_handle_jobs_samples_unchanged_loop_spans(db, monkeypatch):
+    monkeypatch.setattr(config, "LOOP_SPANS", "changes")
+    monkeypatch.setattr(config, "LOOP_SPAN_SAMPLE_RATE", 1)
+    api = StubExecutorAPI()
+    job = api.add_test_job(
+        ExecutorState.EXECUTING,
+        State.RUNNING,
+        StatusCode.EXECUTING,
+        status_message="Executing job on the backend",
+    )
+
+    run.handle_jobs(api)
+
+    spans = get_trace("loop")
+    # every job was recorded, so there's nothing to summarise
+    assert [span.name for span in spans] == ["LOOP_JOB"]
+    assert spans[0].attributes["job.id"] == job.id
+
+
+def test_handle_jobs_unrecorded_loop_spans_have_no_children(db, monkeypatch):
+    monkeypatch.setattr(config, "LOOP_SPANS", "changes")
+    api = StubExecutorAPI()
+    api.add_test_job(
+        ExecutorState.EXECUTING,
+        State.RUNNING,
+        StatusCode.EXECUTING,
+        status_message="Executing job on the backend",
+    )
+    handle_job = run.handle_job
+
+    def handle_job_with_child_span(*args, **kwargs):
+        run.tracer.start_span("CHILD").end()
+        return handle_job(*args, **kwargs)
+
+    monkeypatch.setattr(run, "handle_job", handle_job_with_child_span)
+
+    run.handle_jobs(api)
+
+    spans = get_trace("loop")
+    assert [span.name for span in spans] == ["CHILD", "LOOP"]
+    # not left pointing at a LOOP_JOB span which is never exported
+    assert spans[0].parent is None
+    assert spans[1].attributes["loop.unrecorded_jobs"] == 1
+
+
 def test_handle_job_initial_error(db):
     api = StubExecutorAPI()
     job = api.add_test_job(
@@ -410,6 +510,61 @@ def test_handle_pending_job_waiting_on_dependency(db):
     assert spans[-1].name == "CREATED"
 
 
+def test_handle_pending_job_only_queries_dependencies_once(db, monkeypatch):
+    api = StubExecutorAPI()
+    dependency = api.add_test_job(ExecutorState.EXECUTING, State.RUNNING)
+    job = api.add_test_job(
+        ExecutorState.UNKNOWN,
+        State.PENDING,
+        job_request_id=dependency.job_request_id,
+        action="action2",
+        wait_for_job_ids=[dependency.id],
+    )
+    queries = []
+    find_where = run.find_where
+
+    def recording_find_where(itemclass, columns=None, **query_params):
+        queries.append(query_params)
+        return find_where(itemclass, columns, **query_params)
+
+    monkeypatch.setattr(run, "find_where", recording_find_where)
+
+    run.handle_job(job, api)
+    run.handle_job(job, api)
+    assert job.status_code == StatusCode.WAITING_ON_DEPENDENCIES
+    assert queries == [{"id__in": [dependency.id]}]
+
+    run.set_code(dependency, StatusCode.SUCCEEDED, "Completed successfully")
+    assert run.AWAITED_STATES == {job.id: {dependency.id: State.SUCCEEDED}}
+
+    run.handle_job(job, api)
+    assert job.state == State.RUNNING
+    assert run.AWAITED_STATES == {}
+    assert run.DEPENDENTS == {}
+
+
+def test_forget_awaited_states(db):
+    api = StubExecutorAPI()
+    dependency = api.add_test_job(ExecutorState.EXECUTING, State.RUNNING)
+    job = api.add_test_job(
+        ExecutorState.UNKNOWN,
+        State.PENDING,
+        job_request_id=dependency.job_request_id,
+        action="action2",
+        wait_for_job_ids=[dependency.id],
+    )
+    run.handle_job(job, api)
+    assert job.status_code == StatusCode.WAITING_ON_DEPENDENCIES
+
+    # changing the state outside the run loop isn't tracked
+    update_where(Job, {"state": State.FAILED}, id=dependency.id)
+    run.forget_awaited_states()
+
+    run.handle_job(job, api)
+    assert job.state == State.FAILED
+    assert job.status_code == StatusCode.DEPENDENCY_FAILED
+
+
 def test_handle_job_waiting_on_workers(monkeypatch, db):
     monkeypatch.setattr(config, "MAX_WORKERS", 0)
     api = StubExecutorAPI()
@@ -872,7 +1027,7 @@ def test_handle_single_job_marks_as_failed(db, monkeypatch, capsys):
     assert spans[0].name == "LOOP_JOB"
     assert spans[0].attributes["job.id"] == job.id
     assert spans[0].attributes["job.workspace"] == job.workspace
-    assert spans[0].attributes["job.user"] == job._job_request["created_by"]
+    assert spans[0].attributes["job.user"] == "testuser"
     assert spans[0].attributes["job.initial_code"] == "EXECUTED"
     assert spans[0].attributes["job.initial_state"] == "RUNNING"
     assert "job.final_code" not in spans[0].attributes
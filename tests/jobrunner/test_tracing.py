@@ -5,11 +5,14 @@ from opentelemetry.exporter.otlp.proto.http import trace_exporter
 from opentelemetry.sdk.trace.export import ConsoleSpanExporter
 
 from opensafely.jobrunner import config, models, tracing
+from opensafely.jobrunner.lib import database
+from opensafely.jobrunner.lib.database import insert
 from opensafely.jobrunner.tracing import trace
 from tests.jobrunner.factories import (
     get_trace,
     job_factory,
     job_request_factory,
+    job_request_factory_raw,
     job_results_factory,
 )
 
@@ -122,6 +125,32 @@ def test_trace_attributes(db):
     }
 
 
+def test_trace_attributes_caches_job_request(db, monkeypatch):
+    jr = job_request_factory(original=dict(created_by="testuser"))
+    job1 = job_factory(jr, action="action1")
+    job2 = job_factory(jr, action="action2")
+    queries = []
+    find_one = database.find_one
+
+    def recording_find_one(itemclass, **query_params):
+        queries.append(query_params)
+        return find_one(itemclass, **query_params)
+
+    monkeypatch.setattr(database, "find_one", recording_find_one)
+
+    assert tracing.trace_attributes(job1)["job.user"] == "testuser"
+    assert tracing.trace_attributes(job2)["job.user"] == "testuser"
+    assert queries == [{"id": jr.id}]
+
+
+def test_trace_attributes_does_not_cache_missing_job_request(db):
+    job = job_factory(job_request_factory_raw(), action="action")
+    assert tracing.trace_attributes(job)["job.user"] == "unknown"
+
+    insert(models.SavedJobRequest(id=job.job_request_id, original={"created_by": "u"}))
+    assert tracing.trace_attributes(job)["job.user"] == "u"
+
+
 def test_trace_attributes_missing(db):
     jr = job_request_factory(
         original=dict(
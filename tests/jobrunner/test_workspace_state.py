@@ -1,3 +1,4 @@
+from opensafely.jobrunner.lib.database import get_connection
 from opensafely.jobrunner.models import State
 from opensafely.jobrunner.queries import calculate_workspace_state
 from tests.jobrunner.factories import job_factory
@@ -60,6 +61,29 @@ def test_doesnt_include_dummy_error_jobs(db):
     assert not jobs
 
 
+def test_ignores_other_workspaces(db):
+    job_factory(workspace="the-workspace", action="the-action", created_at=1000)
+    job_factory(workspace="other-workspace", action="the-action", created_at=2000)
+    job = only(calculate_workspace_state("the-workspace"))
+    assert job.workspace == "the-workspace"
+
+
+def test_gets_the_earliest_inserted_job_for_tied_timestamps(db):
+    first = job_factory(workspace="the-workspace", action="the-action", created_at=1)
+    job_factory(workspace="the-workspace", action="the-action", created_at=1)
+    job = only(calculate_workspace_state("the-workspace"))
+    assert job.id == first.id
+
+
+def test_uses_workspace_action_index(db):
+    conn = get_connection()
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM job WHERE workspace = ? AND cancelled = ?",
+        ["the-workspace", False],
+    ).fetchall()
+    assert "idx_job__workspace_action" in str([tuple(row) for row in plan])
+
+
 def only(xs):
     assert len(xs) == 1
     return xs[0]